@@ -2,18 +2,27 @@ import os
 import time
 import json
 import subprocess
+import uuid
 import pyautogui
-from PIL import ImageGrab
 import webbrowser
+from action_plan import execute_plan
+from parse_client import ParseClient
+from result_channel import ResultChannel, default_control_path, ssh_options
+from screen_capture import open_capture
+from screen_settle import SettleDetector
+from screenshot_upload import encode_screenshot, screenshot_name, upload_scale
 
-def perform_action(json_data):
+def perform_action(json_data, settle):
 
     """
     Perform the action based on the extracted action and coordinates from the JSON.
-    Currently, it supports 'click' actions.
+    It supports 'click', 'type' (click the element, type DETAILS and press Enter, unless the
+    server planning several actions set "PRESS_ENTER" to false), 'submit' (type, then always
+    press Enter) and 'wait'.
 
     :param action: The action to be performed (e.g., 'click')
     :param coordinates: The coordinates where the action will be performed
+    :param settle: The SettleDetector a 'wait' action waits on
     """
     action = json_data.get("ACTION")
     element = json_data.get("ELEMENT")
@@ -28,9 +37,8 @@ def perform_action(json_data):
         y = y1+(y2/2)
         print(f"Clicking at ({x}, {y})")
         pyautogui.click(x, y)
-        time.sleep(1)  # Adding a short delay to avoid too fast execution
         
-    elif action == "type" and coordinates:
+    elif action in ("type", "submit") and coordinates:
         x1, y1, x2, y2 = coordinates
         x = x1+(x2/2)
         y = y1+(y2/2)
@@ -39,28 +47,46 @@ def perform_action(json_data):
         # If the action was 'type', you could use pyautogui to type at certain coordinates
         print(f"Typing at {coordinates}")
         pyautogui.write(details)  # Example text to type, can be modified
-        pyautogui.press("enter")
+        # a planning server marks 'type' not to press Enter, so that typing into one field of a form does not send it
+        if action == "submit" or json_data.get("PRESS_ENTER", True):
+            pyautogui.press("enter")
     elif action == "wait":
-        time.sleep(5)
+        result = settle.wait(min_wait=1.0)
+        print(f"Waited {result.seconds:.1f}s")
     else:
         print("Unsupported action or missing coordinates!")
 
-def open_link_in_fullscreen(url):
+def perform_plan(json_data, settle):
+    """
+    Perform the action of a result and, without asking the server, the actions it PLANs after it,
+    as long as each one changes the screen as expected (see action_plan.execute_plan).
+
+    :return: The report on the plan for the server, None if there was no plan
+    """
+    return execute_plan(json_data, settle, perform_action, max_change=float(os.getenv('PLAN_MAX_CHANGE') or 0.5))
+
+def open_link_in_fullscreen(url, settle):
     # Open the URL in the default browser
     webbrowser.open(url)
     
-    # Wait a few seconds for the browser to load
-    time.sleep(15)
+    # Wait for the browser to appear and the page to stop changing
+    result = settle.wait(min_wait=1.0, max_wait=15.0, require_change=True)
+    print(f"Page {'loaded' if result.settled else 'still changing'} after {result.seconds:.1f}s")
     
     # Press F11 to enter full-screen mode
     pyautogui.press('f11')
 
-def load_task(task_local_path, remote_user, remote_host, task_remote_base_path):
-    # Prompt for task input
-    task_input = input("Please enter a task: ")
+def load_task(task_input, task_local_path, remote_user, remote_host, task_remote_base_path, control_path=None,
+              screen_scale=1.0):
+    """Upload the task; returns the id of this run, which the server stamps on every result it streams."""
+    run = uuid.uuid4().hex
     json_task = {
-        "task": task_input
+        "task": task_input,
+        "run": run
     }
+    if screen_scale != 1.0:
+        # the server maps the coordinates of its results back to screen pixels
+        json_task["screen_scale"] = screen_scale
     filename = 'task.json'
     with open(filename, 'w') as file:
         json.dump(json_task, file, indent=4)
@@ -69,7 +95,7 @@ def load_task(task_local_path, remote_user, remote_host, task_remote_base_path):
 
     # Construct the scp command
     scp_command = [
-        "scp",
+        "scp", *ssh_options(control_path),
         task_local_path,
         f"{remote_user}@{remote_host}:{task_remote_base_path}",
     ]
@@ -80,21 +106,57 @@ def load_task(task_local_path, remote_user, remote_host, task_remote_base_path):
         print("Task successfully copied to remote server.")
     except subprocess.CalledProcessError as e:
         print(f"Error copying task: {e}")
+    return run
 
-
+def open_start_page(settle):
     url_input = input("Please enter a valid url: ")
-    open_link_in_fullscreen(url_input)
+    open_link_in_fullscreen(url_input, settle)
+
+def settle_detector():
+    """The SettleDetector configured by SETTLE_MIN_WAIT, SETTLE_MAX_WAIT (seconds) and SETTLE_THRESHOLD (share of pixels),
+    grabbing the screen with the CAPTURE_BACKEND (xshm, mss or pil; by default the fastest that works)."""
+    settings = {}
+    for name, key in (('SETTLE_MIN_WAIT', 'min_wait'), ('SETTLE_MAX_WAIT', 'max_wait'), ('SETTLE_THRESHOLD', 'threshold')):
+        if os.getenv(name):
+            settings[key] = float(os.getenv(name))
+    return SettleDetector(capture=open_capture(os.getenv('CAPTURE_BACKEND') or None), **settings)
 
-def load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path):
+def upload_settings():
+    """How screenshots are encoded for upload: UPLOAD_CODEC (png, webp or jpeg), UPLOAD_QUALITY, UPLOAD_MAX_WIDTH."""
+    quality = os.getenv('UPLOAD_QUALITY')
+    max_width = os.getenv('UPLOAD_MAX_WIDTH')
+    return {
+        "codec": os.getenv('UPLOAD_CODEC') or "png",
+        "quality": int(quality) if quality else None,
+        "max_width": int(max_width) if max_width else None,
+    }
+
+def capture_screenshot(img_local_path, settle, upload=None):
+    """Wait for the screen to settle, encode it as configured by `upload` (see upload_settings) and save it;
+    returns (bytes, content type)."""
+    result = settle.wait()
+    print(f"Screen {'settled' if result.settled else 'still changing'} after {result.seconds:.1f}s")
+    image_bytes, content_type, _ = encode_screenshot(result.frame, **(upload or {}))
     # Save the screenshot to the specified file path
-    screenshot = ImageGrab.grab()
-    screenshot.save(img_local_path)
-    print(f"Screenshot saved to {img_local_path}")
-    time.sleep(2)
+    with open(img_local_path, 'wb') as img_file:
+        img_file.write(image_bytes)
+    print(f"Screenshot saved to {img_local_path} ({len(image_bytes) // 1024} KB, {content_type})")
+    return image_bytes, content_type
+
+def load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path, settle, control_path=None, upload=None,
+                    plan_report=None):
+    capture_screenshot(img_local_path, settle, upload)
+    sources = [img_local_path]
+    if plan_report:
+        # the report on the previous plan goes next to the screenshot, and is copied before it
+        report_local_path = os.path.splitext(img_local_path)[0] + ".json"
+        with open(report_local_path, 'w') as report_file:
+            json.dump(plan_report, report_file)
+        sources.insert(0, report_local_path)
     # Construct the scp command
     scp_command = [
-        "scp",
-        img_local_path,
+        "scp", *ssh_options(control_path),
+        *sources,
         f"{remote_user}@{remote_host}:{img_remote_base_path}",
     ]
 
@@ -106,67 +168,127 @@ def load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_pat
         print(f"Error copying screenshot: {e}")
 
 
-remote_user = os.getenv('REMOTE_USER'),
-remote_host = os.getenv('REMOTE_HOST'),
-img_remote_base_path = os.getenv('IMG_REMOTE_BASE_PATH')
-img_local_base_path = os.getenv('IMG_LOCAL_BASE_PATH')
-remote_base_path = os.getenv('REMOTE_BASE_PATH')
-local_base_path = os.getenv('LOCAL_BASE_PATH')
-task_remote_base_path = os.getenv('TASK_REMOTE_BASE_PATH')
-task_local_path = os.getenv('TASK_LOCAL_PATH')
+def reap_downloads(downloads):
+    """Drop the finished labeled screenshot downloads from `downloads`, reporting the failed ones."""
+    for process in [process for process in downloads if process.poll() is not None]:
+        downloads.remove(process)
+        if process.returncode != 0:
+            print(f"Failed to download {os.path.basename(process.args[-1])}.")
 
+def run_over_ssh():
+    remote_user = os.getenv('REMOTE_USER')
+    remote_host = os.getenv('REMOTE_HOST')
+    img_remote_base_path = os.getenv('IMG_REMOTE_BASE_PATH')
+    img_local_base_path = os.getenv('IMG_LOCAL_BASE_PATH')
+    remote_base_path = os.getenv('REMOTE_BASE_PATH')
+    local_base_path = os.getenv('LOCAL_BASE_PATH')
+    task_remote_base_path = os.getenv('TASK_REMOTE_BASE_PATH')
+    task_local_path = os.getenv('TASK_LOCAL_PATH')
+    # every ssh and scp call reuses one connection to the server (not supported by Windows' OpenSSH)
+    control_path = default_control_path()
+    upload = upload_settings()
+    settle = settle_detector()
+    screen_scale = upload_scale(settle.capture.size[0], upload["max_width"])
 
-# Load a task from user input
-load_task(task_local_path, remote_user, remote_host, task_remote_base_path)
 
-# Construct the dynamic file name
-img_file_name = f"screenshot_0.png"
-img_local_path = os.path.join(img_local_base_path, img_file_name)
-load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path)
+    # Load a task from user input
+    task_input = input("Please enter a task: ")
+    run = load_task(task_input, task_local_path, remote_user, remote_host, task_remote_base_path, control_path, screen_scale)
 
+    # The server pushes every result down this connection as soon as it is written
+    channel = ResultChannel(remote_user, remote_host, f"{remote_base_path}/results.jsonl", run, control_path)
+    channel.open()
+    open_start_page(settle)
 
-i = 0
-while True:
     # Construct the dynamic file name
-    file_name = f"result_{i}.json"
-    remote_path = f"{remote_base_path}/{file_name}"
-    local_path = os.path.join(local_base_path, file_name)
-
-    # Use SSH to check if the file exists on the remote server
-    result = subprocess.run(
-        ["ssh", f"{remote_user}@{remote_host}", f"test -f {remote_path} && echo 1 || echo 0"],
-        capture_output=True, text=True
-    )
-    
-    # Check the result from the SSH command (if the file exists, result.stdout will be '1')
-    if result.stdout.strip() == '1':
+    img_file_name = screenshot_name(0, upload["codec"])
+    img_local_path = os.path.join(img_local_base_path, img_file_name)
+    load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path, settle, control_path, upload)
+
 
-        # Download result file
-        print(f"File {file_name} exists. Downloading...")
-        scp_command = ["scp",f"{remote_user}@{remote_host}:{remote_path}",local_path]
-        scp_result = subprocess.run(scp_command)
+    # Parsed screenshots are downloaded in the background, so that the next screenshot does not wait for them;
+    # DOWNLOAD_LABELED=0 leaves them on the server
+    downloads = []
 
-        # Download parsed screenshot file
-        scp_command = ["scp",f"{remote_user}@{remote_host}:{f"{remote_base_path}/{"labled_screenshot_"+str(i)+".png"}"}",
-            os.path.join(local_base_path, f"labled_screenshot_"+str(i)+".png")
+    def download_labeled(step):
+        reap_downloads(downloads)
+        if os.getenv('DOWNLOAD_LABELED', '1') == '0' or not channel.annotated:
+            return
+        scp_command = ["scp", "-q", *ssh_options(control_path),
+            f"{remote_user}@{remote_host}:{remote_base_path}/labled_screenshot_{step}.png",
+            os.path.join(local_base_path, f"labled_screenshot_"+str(step)+".png")
         ]
-        scp_result = subprocess.run(scp_command)
-        
-        # Check if the file was downloaded successfully
-        if scp_result.returncode == 0:
-            print(f"Downloaded {file_name} successfully.")
-            with open(local_path, 'r') as json_file:
-                json_data = json.load(json_file)
+        downloads.append(subprocess.Popen(scp_command, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    i, received = 0, None
+    try:
+        while True:
+            json_data = channel.wait(i)
+            received = i
+            print(f"Received result {i} {1000 * channel.latencies[-1]:.0f} ms after it was written")
+            # The server has finished the previous step, labeled screenshot included even when drawn in the background
+            if i > 0:
+                download_labeled(i - 1)
+            with open(os.path.join(local_base_path, f"result_{i}.json"), 'w') as json_file:
+                json.dump(json_data, json_file, indent=4)
 
-            perform_action(json_data)
+            plan_report = perform_plan(json_data, settle)
 
             # Construct the dynamic file name
-            img_file_name = f"screenshot_{i+1}.png"
+            img_file_name = screenshot_name(i + 1, upload["codec"])
             img_local_path = os.path.join(img_local_base_path, img_file_name)
-            load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path)
+            load_screenshot(img_local_path,remote_user, remote_host, img_remote_base_path, settle, control_path, upload,
+                            plan_report)
 
             i += 1  # Increment the file index for the next result
-        else:
-            print(f"Failed to download {file_name}.")
+    finally:
+        channel.close()
+        if received is not None:
+            download_labeled(received)
+        for process in downloads:
+            process.wait()
+        reap_downloads(downloads)
+
+
+def run_over_http(server_url):
+    img_local_base_path = os.getenv('IMG_LOCAL_BASE_PATH')
+    local_base_path = os.getenv('LOCAL_BASE_PATH')
+
+    client = ParseClient(server_url)
+    upload = upload_settings()
+    settle = settle_detector()
+    # CAPTION_PROFILE (accurate, balanced or fast) overrides the server's icon caption decoding
+    client.start_session(input("Please enter a task: "), caption_profile=os.getenv('CAPTION_PROFILE'),
+                         screen_scale=upload_scale(settle.capture.size[0], upload["max_width"]))
+    print(f"Session {client.session_id} opened on {server_url}")
+    open_start_page(settle)
+
+    i = 0
+    plan_report = None
+    try:
+        while True:
+            img_local_path = os.path.join(img_local_base_path, screenshot_name(i, upload["codec"]))
+            image_bytes, content_type = capture_screenshot(img_local_path, settle, upload)
+
+            try:
+                json_data = client.step(image_bytes, content_type, plan_report)
+            except RuntimeError as e:
+                # the server did not produce an action for this screenshot, send a new one
+                print(f"Error: {e}")
+                continue
+
+            with open(os.path.join(local_base_path, f"result_{i}.json"), 'w') as json_file:
+                json.dump(json_data, json_file, indent=4)
+            plan_report = perform_plan(json_data, settle)
+            i += 1
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    # SERVER_URL selects the HTTP service, otherwise fall back to the scp/ssh file protocol
+    server_url = os.getenv('SERVER_URL')
+    if server_url:
+        run_over_http(server_url)
     else:
-        print(f"File {file_name} does not exist yet. Waiting...")
+        run_over_ssh()
@@ -0,0 +1,71 @@
+from screen_capture import to_image
+from screen_settle import changed_share
+
+
+def element_region(coordinates, screen_size, margin):
+    """(left, top, right, bottom) of the element at `coordinates` (x, y, width, height) and `margin` pixels around it."""
+    x, y, width, height = coordinates
+    return (max(0, int(x - margin)), max(0, int(y - margin)),
+            min(screen_size[0], int(x + width + margin)), min(screen_size[1], int(y + height + margin)))
+
+
+def execute_plan(json_data, settle, perform, max_change=0.5, margin=50):
+    """
+    Performs the action of a result and then the actions in its PLAN, back to back,
+    checking after each one that it had the expected effect before going on.
+
+    After every action but the last the screen is left to settle, and the plan stops
+    at the first surprise: the screen did not settle, nothing changed around the
+    action's element nor anywhere else on the screen (compared at full resolution
+    around the element, subsampled elsewhere), or more than `max_change` of the screen
+    changed, e.g. because another page loaded, so that the coordinates planned for the
+    following actions may be wrong. The next screenshot shows the server what the last
+    executed action did.
+
+    Args:
+        json_data (dict): The result, as received from the server
+        settle (SettleDetector): Grabs the screen and waits for it to settle
+        perform (Callable): Called as perform(action, settle) for every action
+    Returns:
+        dict: {"executed": int, "planned": int, "stopped": str or None} for the server,
+            None if the result planned no further action
+    """
+    actions = [json_data] + list(json_data.get("PLAN") or [])
+    if len(actions) == 1:
+        perform(json_data, settle)
+        return None
+    frame, overview = settle.sample()
+    before = to_image(frame)
+    for executed, action in enumerate(actions, 1):
+        perform(action, settle)
+        if executed == len(actions):
+            break
+        result = settle.wait()
+        screen_change = changed_share(overview, result.sample, settle.pixel_delta)
+        if not result.settled:
+            stopped = f"the screen was still changing {result.seconds:.1f}s after it"
+        elif action.get("ACTION") == "wait":
+            stopped = None
+        elif screen_change > max_change:
+            stopped = f"it changed {screen_change:.0%} of the screen"
+        elif screen_change <= settle.threshold and not _changed_around(action, before, result.frame, settle, margin):
+            stopped = "it did not change the screen"
+        else:
+            stopped = None
+        if stopped:
+            stopped = f"action {executed} ({action.get('ACTION')} {action.get('ELEMENT')}): {stopped}"
+            print(f"Plan stopped after {executed} of {len(actions)} actions, {stopped}")
+            return {"executed": executed, "planned": len(actions), "stopped": stopped}
+        before, overview = result.frame, result.sample
+    print(f"Executed all {len(actions)} planned actions")
+    return {"executed": len(actions), "planned": len(actions), "stopped": None}
+
+
+def _changed_around(action, before, after, settle, margin):
+    """Whether the screen changed around the element of `action`, between the PIL images `before` and `after`."""
+    coordinates = action.get("COORDINATES")
+    if not coordinates:
+        return False
+    region = element_region(coordinates, before.size, margin)
+    crop = lambda image: image.crop(region).getchannel("G")
+    return changed_share(crop(before), crop(after), settle.pixel_delta) > settle.threshold
@@ -0,0 +1,92 @@
+import http.client
+import json
+from urllib.parse import urlsplit
+
+
+class ParseClient:
+    """
+    Talks to CAT_server's HTTP service over a single keep-alive connection.
+
+    The connection is opened lazily and reused for every request; if the server
+    dropped it while we were idle it is reopened once and the request is retried.
+    Only requests the server handles at most once are retried after they were sent:
+    steps carry their index (X-Step), so the server answers a repeated step with the
+    result it already sent instead of parsing the screenshot again.
+    """
+
+    def __init__(self, server_url, timeout=300):
+        url = urlsplit(server_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self.session_id = None
+        self.step_index = 0
+        self._conn = None
+
+    def _request(self, method, path, body=None, headers=None, retry=True):
+        """Send one request and return the decoded JSON response.
+
+        A request that could not be sent is retried once on a new connection. One that
+        was sent but got no response is retried only with `retry`, i.e. when handling it
+        twice is harmless.
+        """
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            sent = False
+            try:
+                self._conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                response = self._conn.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self._conn.close()
+                self._conn = None
+                if attempt or (sent and not retry):
+                    raise
+                continue
+            data = json.loads(payload)
+            if response.status != 200:
+                raise RuntimeError(f"Server returned {response.status}: {data.get('error')}")
+            return data
+
+    def start_session(self, task, caption_profile=None, screen_scale=1.0):
+        """Open a session for `task` on the server, optionally with its own icon caption profile.
+
+        `screen_scale` is the factor the screenshots will be scaled down by; the server
+        maps the action coordinates back to screen pixels.
+        """
+        request = {"task": task}
+        if caption_profile:
+            request["caption_profile"] = caption_profile
+        if screen_scale != 1.0:
+            request["screen_scale"] = screen_scale
+        body = json.dumps(request)
+        # sent twice, it would open a second session
+        data = self._request("POST", "/sessions", body=body, headers={"Content-Type": "application/json"}, retry=False)
+        self.session_id = data["session_id"]
+        self.step_index = 0
+        return self.session_id
+
+    def step(self, image_bytes, content_type="image/png", plan_report=None):
+        """Send one screenshot (PNG, WebP or JPEG) and return the action JSON for it.
+
+        `plan_report` tells the server how far the PLAN of the previous action got.
+        """
+        headers = {"Content-Type": content_type, "X-Step": str(self.step_index)}
+        if plan_report:
+            headers["X-Plan-Report"] = json.dumps(plan_report)
+        data = self._request("POST", f"/sessions/{self.session_id}/steps", body=image_bytes, headers=headers)
+        self.step_index += 1
+        return data
+
+    def close(self):
+        if self.session_id is not None:
+            try:
+                self._request("DELETE", f"/sessions/{self.session_id}")
+            except (RuntimeError, OSError):
+                pass
+            self.session_id = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
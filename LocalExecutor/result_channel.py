@@ -0,0 +1,97 @@
+import json
+import os
+import queue
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+
+def ssh_options(control_path):
+    """ssh/scp options that multiplex every connection to the host over one master connection."""
+    if not control_path:
+        return []
+    return ["-o", "ControlMaster=auto", "-o", f"ControlPath={control_path}", "-o", "ControlPersist=600"]
+
+
+def default_control_path():
+    """A control socket path for ssh multiplexing, or None where OpenSSH does not support it (Windows)."""
+    if os.name == 'nt':
+        return None
+    return os.path.join(tempfile.gettempdir(), "cat-ssh-%r@%h:%p")
+
+
+class ResultChannel:
+    """
+    Receives the server's results as they are written, over one long-lived SSH connection.
+
+    In file mode CAT_server appends every result as one JSON line to results.jsonl next
+    to result_<i>.json. The channel runs `tail -F` on that file on the server and reads
+    its output, so a result reaches the executor as soon as it is written, without
+    starting a new SSH connection per check. Only lines stamped with this run's id
+    (sent in task.json) are read; the rest is a stream left over from a previous run,
+    possibly of the same task, which the server has not truncated yet.
+
+    Attributes:
+        run (str): The id of the run whose results are expected
+        latencies (list): Seconds from a result being written on the server to being
+            received here, per step (as far as the two clocks agree)
+        annotated (bool): Whether the server writes labeled screenshots, as it reported
+            with its latest result (False with --annotate off)
+    """
+
+    def __init__(self, remote_user, remote_host, stream_path, run, control_path=None):
+        self.remote = f"{remote_user}@{remote_host}"
+        self.stream_path = stream_path
+        self.run = run
+        self.control_path = control_path
+        self.latencies = []
+        self.annotated = True
+        self._results = {}
+        self._lines = queue.Queue()
+        self._process = None
+
+    def _command(self):
+        return ["ssh", *ssh_options(self.control_path), self.remote,
+                f"tail -n +1 -F {shlex.quote(self.stream_path)} 2>/dev/null"]
+
+    def open(self):
+        self._process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+        threading.Thread(target=self._read, name='result-channel', daemon=True).start()
+
+    def _read(self):
+        for line in self._process.stdout:
+            self._lines.put((time.time(), line))
+        # the connection is gone
+        self._lines.put((time.time(), None))
+
+    def wait(self, step, timeout=None):
+        """Blocks until the result of `step` arrives and returns it; None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while step not in self._results:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                received_at, line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if line is None:
+                raise RuntimeError(f"the result channel to {self.remote} closed (ssh exit code {self._process.wait()})")
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("run") != self.run:
+                continue
+            self._results[entry["step"]] = entry["result"]
+            if "annotate" in entry:
+                self.annotated = entry["annotate"] != "off"
+            if "written_at" in entry:
+                self.latencies.append(received_at - entry["written_at"])
+        return self._results.pop(step)
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
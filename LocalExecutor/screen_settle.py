@@ -0,0 +1,80 @@
+import time
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageChops
+
+from screen_capture import open_capture, to_image
+
+SettleResult = namedtuple("SettleResult", ["settled", "seconds", "samples", "frame", "sample"])
+
+
+def changed_share(a, b, pixel_delta=8):
+    """Share of the pixels of two greyscale images of one size that differ by more than `pixel_delta`."""
+    if a.size != b.size:
+        return 1.0
+    histogram = ImageChops.difference(a, b).histogram()
+    return sum(histogram[pixel_delta + 1:]) / (a.width * a.height)
+
+
+class SettleDetector:
+    """
+    Waits for the screen to stop changing, in place of fixed sleeps after actions.
+
+    The screen is grabbed every `interval` seconds and compared, subsampled to about
+    `sample_width` pixels wide and in greyscale, with the previous grab. It has settled
+    once `stable_samples` grabs in a row changed at most `threshold` of the pixels, and at
+    least `min_wait` seconds have passed; after `max_wait` seconds the wait gives up. The
+    last full-resolution grab is returned, so it can be used as the screenshot.
+
+    Attributes:
+        capture: The screen_capture backend, the fastest available one by default
+    """
+
+    def __init__(self, min_wait=0.3, max_wait=5.0, threshold=0.001, interval=0.1, stable_samples=2,
+                 sample_width=320, pixel_delta=8, capture=None):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.threshold = threshold
+        self.interval = interval
+        self.stable_samples = stable_samples
+        self.sample_width = sample_width
+        self.pixel_delta = pixel_delta
+        self.capture = capture or open_capture()
+
+    def sample(self):
+        """Grabs the screen; returns (the BGRA frame, valid until the next grab, and a small greyscale copy)."""
+        frame = self.capture.grab()
+        factor = max(1, frame.shape[1] // self.sample_width)
+        # every factor-th pixel of the green channel is enough to see changes
+        return frame, Image.fromarray(np.ascontiguousarray(frame[::factor, ::factor, 1]))
+
+    def wait(self, min_wait=None, max_wait=None, require_change=False):
+        """
+        Blocks until the screen settles; with `require_change`, only once it has also
+        changed from how it looked when the wait started (e.g. while a page is opening).
+
+        Returns:
+            SettleResult: (settled, seconds waited, number of grabs, last full-resolution grab as a PIL image,
+                its small greyscale copy)
+        """
+        min_wait = self.min_wait if min_wait is None else min_wait
+        max_wait = self.max_wait if max_wait is None else max_wait
+        start = time.monotonic()
+        frame, first = self.sample()
+        previous, samples, stable, changed = first, 1, 0, False
+        while True:
+            elapsed = time.monotonic() - start
+            if stable >= self.stable_samples and elapsed >= min_wait and (changed or not require_change):
+                return SettleResult(True, elapsed, samples, to_image(frame), previous)
+            if elapsed >= max_wait:
+                return SettleResult(False, elapsed, samples, to_image(frame), previous)
+            time.sleep(self.interval)
+            frame, current = self.sample()
+            samples += 1
+            if changed_share(previous, current, self.pixel_delta) > self.threshold:
+                stable = 0
+            else:
+                stable += 1
+            changed = changed or changed_share(first, current, self.pixel_delta) > self.threshold
+            previous = current
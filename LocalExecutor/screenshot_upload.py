@@ -0,0 +1,55 @@
+import io
+
+from PIL import Image
+
+# codec -> (PIL format, Content-Type, file extension)
+CODECS = {
+    "png": ("PNG", "image/png", ".png"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+}
+
+
+def screenshot_name(step, codec="png"):
+    """The file name of screenshot `step` encoded with `codec`, e.g. screenshot_3.webp."""
+    return f"screenshot_{step}{CODECS[codec][2]}"
+
+
+def upload_scale(screen_width, max_width=None):
+    """The factor screenshots are scaled by before upload: 1.0, or less to fit `max_width`."""
+    if not max_width or screen_width <= max_width:
+        return 1.0
+    return max_width / screen_width
+
+
+def encode_screenshot(image, codec="png", quality=None, max_width=None):
+    """
+    Encodes a screenshot (a PIL image) for upload, optionally downscaled.
+
+    png   lossless, `quality` is the zlib level (0-9, default 1: much faster than
+          PIL's default 6 for a slightly larger file)
+    webp  lossless WebP, `quality` is the compression effort (0-100, default 0: fastest)
+    jpeg  `quality` 1-95 (default 90), without chroma subsampling so that small text stays sharp
+    max_width: scale the screenshot down to at most this width, keeping its aspect ratio
+
+    Returns:
+        tuple: (encoded bytes, Content-Type, scale), scale being upload_scale(image width, max_width)
+    """
+    if codec not in CODECS:
+        raise ValueError(f"unknown upload codec {codec!r}, expected one of {', '.join(CODECS)}")
+    scale = upload_scale(image.width, max_width)
+    if scale != 1.0:
+        # area averaging: suited to downscaling, and several times faster than Lanczos
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BOX)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image_format, content_type, _ = CODECS[codec]
+    if codec == "png":
+        options = {"compress_level": 1 if quality is None else quality}
+    elif codec == "webp":
+        options = {"lossless": True, "quality": 0 if quality is None else quality, "method": 0}
+    else:
+        options = {"quality": 90 if quality is None else quality, "subsampling": 0}
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue(), content_type, scale
@@ -2,25 +2,74 @@ import sys
 
 sys.path.append('OmniParser')
 
-from utils import get_som_labeled_img, check_ocr_box, get_caption_model_processor, get_yolo_model
-import torch
-from ultralytics import YOLO
+from utils import get_som_labeled_img, check_ocr_box, get_caption_model_processor, get_yolo_model, predict_yolo, load_frame, draw_som_labels, warm_up, CAPTION_PROFILES
+from util.incremental import IncrementalParser
+from util.caption_cache import CaptionCache
+from util.caption_quantization import CPU_PRECISIONS
+from util.intake import ScreenshotIntake
+from util.ocr_worker import OCRWorker
+from util.parse_service import ParseService
+from util.sessions import SessionManager
+from util.step_history import plan_outcome
+from util.annotation_writer import AnnotationWriter
+from util.instrumentation import metrics, serve_metrics
 from PIL import Image
 import base64
-import matplotlib.pyplot as plt
 import io
 import os
 import time
+import argparse
+import contextvars
+from types import SimpleNamespace
 
-from anthropic import Anthropic
 import json
 
 
-
-def initialize_models(device='cuda'):
-    """Initialize the YOLO and caption models."""
+# Configuration for drawing bounding boxes
+DRAW_BBOX_CONFIG = {
+    'text_scale': 0.8,
+    'text_thickness': 2,
+    'text_padding': 3,
+    'thickness': 3,
+}
+
+# Arguments for check_ocr_box, shared by full-frame and cropped OCR
+OCR_ARGS = {
+    'display_img': False,
+    'output_bb_format': 'xyxy',
+    'goal_filtering': None,
+    'easyocr_args': {'paragraph': False, 'text_threshold': 0.9},
+    'use_paddleocr': True,
+}
+OCR_ENGINE = 'paddle' if OCR_ARGS['use_paddleocr'] else 'easyocr'
+
+# Extensions of the screenshot codecs the executor can upload (UPLOAD_CODEC png, webp, jpeg)
+SCREENSHOT_EXTENSIONS = ('.png', '.webp', '.jpg')
+
+
+def screenshot_extension(image_bytes):
+    """The file extension matching an uploaded screenshot's format, from its first bytes."""
+    if image_bytes[:3] == b'\xff\xd8\xff':
+        return '.jpg'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return '.webp'
+    return '.png'
+
+
+def initialize_models(device='cuda', detector_backend='torch', detector_int8=False, caption_precision='fp32',
+                      share_detector_weights=False):
+    """Initialize the YOLO and caption models.
+
+    `detector_backend` 'onnx' or 'openvino' runs the icon detector with ONNX Runtime on
+    the CPU whatever `device` is, optionally with INT8 weights (see utils.get_yolo_model).
+    `share_detector_weights` memory-maps the PyTorch detector's weights so that several
+    server processes on one host share them, leaving its batch norms unfused on CPU.
+    `caption_precision` 'int8' or 'bf16' converts the caption model for the CPU (see
+    utils.get_caption_model_processor); it has no effect on GPU.
+    """
     # Initialize YOLO model
-    som_model = get_yolo_model(model_path='weights/icon_detect/best.pt')
+    som_model = get_yolo_model(model_path='weights/icon_detect/model.safetensors', backend=detector_backend, int8=detector_int8,
+                               share=share_detector_weights)
     som_model.to(device)
     print('model to {}'.format(device))
 
@@ -36,70 +85,88 @@ def initialize_models(device='cuda'):
     caption_model_processor = get_caption_model_processor(
         model_name="florence2",
         model_name_or_path="weights/icon_caption_florence",
-        device=device
+        device=device,
+        precision=caption_precision
     )
 
     return som_model, caption_model_processor
 
-def process_image(image_path, som_model, caption_model_processor, box_threshold=0.03):
-    """Process an image and return labeled results."""
-    # Configuration for drawing bounding boxes
-    draw_bbox_config = {
-        'text_scale': 0.8,
-        'text_thickness': 2,
-        'text_padding': 3,
-        'thickness': 3,
-    }
-
-    # Open and convert image
-    image = Image.open(image_path)
-    image_rgb = image.convert('RGB')
-
-    # Perform OCR
-    ocr_bbox_rslt, is_goal_filtered = check_ocr_box(
-        image_path,
-        display_img=False,
-        output_bb_format='xyxy',
-        goal_filtering=None,
-        easyocr_args={'paragraph': False, 'text_threshold': 0.9},
-        use_paddleocr=True
-    )
+def process_image(image_path, som_model, caption_model_processor, box_threshold=0.03, ocr_worker=None, render=True,
+                  ocr_result=None, known_captions=None, caption_profile='accurate'):
+    """Process an image and return labeled results.
+
+    `image_path` may also be the encoded screenshot bytes or a decoded RGB ndarray; the
+    image is decoded once and the same frame is shared by OCR, YOLO and captioning.
+    With an `ocr_worker`, OCR runs in the worker process while YOLO runs here, and the
+    two are joined at overlap removal. With `render=False` the labeled image is not drawn
+    and None is returned in its place.
+    `ocr_result` skips OCR with a (texts, xyxy boxes) result obtained otherwise, and
+    `known_captions` is passed on to get_som_labeled_img (see IncrementalParser).
+    `caption_profile` names the utils.CAPTION_PROFILES decoding settings for the icon captions.
+    """
+    # Decode the image once for every stage
+    frame = load_frame(image_path)
+
+    yolo_result = None
+    if ocr_result is not None:
+        ocr_bbox_rslt = ocr_result
+    elif ocr_worker is not None:
+        # Perform OCR and icon detection concurrently
+        ocr_future = ocr_worker.submit(frame, **OCR_ARGS)
+        with metrics.stage('detect'):
+            yolo_result = predict_yolo(model=som_model, image_path=frame, box_threshold=box_threshold, imgsz=640)
+        # only the part of OCR that detection did not hide
+        with metrics.stage('ocr'):
+            ocr_bbox_rslt, is_goal_filtered = ocr_future.result()
+    else:
+        # Perform OCR
+        with metrics.stage('ocr'):
+            ocr_bbox_rslt, is_goal_filtered = check_ocr_box(frame, **OCR_ARGS)
     text, ocr_bbox = ocr_bbox_rslt
 
     # Get labeled image and results
     dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(
-        image_path,
+        frame,
         som_model,
         BOX_TRESHOLD=box_threshold,
         output_coord_in_ratio=False,
         ocr_bbox=ocr_bbox,
-        draw_bbox_config=draw_bbox_config,
+        draw_bbox_config=DRAW_BBOX_CONFIG,
         caption_model_processor=caption_model_processor,
         ocr_text=text,
         use_local_semantics=True,
-        iou_threshold=0.1
+        iou_threshold=0.1,
+        yolo_result=yolo_result,
+        render=render,
+        known_captions=known_captions,
+        caption_profile=caption_profile
     )
 
     return dino_labled_img, label_coordinates, parsed_content_list
 
 class TaskAnalyzer:
+    """Asks the LLM for the next action; with `max_plan_actions` > 1 it may plan that many at once."""
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, max_plan_actions=1):
+        from anthropic import Anthropic
         self.client = Anthropic(api_key=api_key)
+        self.max_plan_actions = max_plan_actions
 
     def format_screen_elements(self, elements):
         """Convert the list of elements into a structured string format."""
         return "\n".join(elements)
 
     def create_system_prompt(self):
-        return """You are a task analyzer for a computer automation system. When given a task and a list of screen elements, you should:
+        # 'submit' only exists with plans, where typing into one field of a form must not send it
+        actions = "click/type/submit/wait" if self.max_plan_actions > 1 else "click/type/wait"
+        prompt = f"""You are a task analyzer for a computer automation system. When given a task and a list of screen elements, you should:
                     1. Analyze the available screen elements
                     2. Return one instruction in this exact format for the specific step to execute:
-                    {
-                        "ACTION": "[click/type/wait]",
+                    {{
+                        "ACTION": "[{actions}]",
                         "ELEMENT": "\"Text Box/Icon Box ID X: [exact element text]\"",
                         "DETAILS": "[text to type or additional info if needed]"
-                        }
+                        }}
 
                     Rules:
                     - You have the obligation to start with the instruction before saying anything else
@@ -108,79 +175,388 @@ class TaskAnalyzer:
                     - Be specific about whether to click or type
                     - If typing is needed, specify the exact text to type
                     - Keep responses focused only on achievable actions with the given elements"""
-
-    def analyze_task(self, task, screen_elements):
+        if self.max_plan_actions > 1:
+            prompt += f"""
+                    - Use submit to type and then press Enter, e.g. in a search box or the last field of a form; type does not press Enter
+                    - When the next steps are predictable from the current screen alone, e.g. filling in the fields of a form, you may instead return a JSON list of up to {self.max_plan_actions} instructions in this format, in the order to execute them
+                    - Every instruction in a list must reference an element of the current list, and the list must end with the first action that loads another page or opens a dialog
+                    - The list is executed until an action does not have the expected effect; the next outcome tells how many of its actions were executed"""
+        return prompt
+
+    def analyze_task(self, task, screen_elements, history=None, screen_prompt=None):
+        """Ask for the next action.
+
+        With a StepHistory, previous steps are replayed as conversation turns. With a
+        ScreenPrompt (util.element_tracker), the task and the baseline element list
+        form a cached prefix and only the changes since the baseline are sent as new.
+        """
         screen_content = self.format_screen_elements(screen_elements)
+        instructions = "Provide step-by-step instructions using only the available elements. Format each step as specified in your system prompt."
+
+        if screen_prompt is not None:
+            task_content = [{
+                "type": "text",
+                "text": f"""Task to complete: {task}
+
+Available screen elements at step {screen_prompt.baseline_step}:
+{screen_prompt.baseline_text()}""",
+                "cache_control": {"type": "ephemeral"},
+            }]
+            screen_message = screen_prompt.changes_text() + "\n\n" + instructions
+        else:
+            task_content = f"Task to complete: {task}"
+            screen_message = f"""Available screen elements:
+{screen_content}
+
+{instructions}"""
+
+        if history is not None:
+            messages = history.to_messages(task_content, screen_message)
+        elif screen_prompt is not None:
+            messages = [{"role": "user", "content": task_content + [{"type": "text", "text": screen_message}]}]
+        else:
+            messages = [{"role": "user", "content": task_content + "\n\n" + screen_message}]
 
         message = self.client.messages.create(
             model="claude-3-5-sonnet-20241022",
             max_tokens=1000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Task to complete: {task}
-
-Available screen elements:
-{screen_content}
-
-Provide step-by-step instructions using only the available elements. Format each step as specified in your system prompt."""
-                }
-            ],
+            messages=messages,
             system=self.create_system_prompt()
         )
+        usage = getattr(message, 'usage', None)
+        if usage is not None:
+            metrics.count('llm_input_tokens', usage.input_tokens)
+            metrics.count('llm_output_tokens', usage.output_tokens)
+            metrics.count('llm_cache_read_tokens', getattr(usage, 'cache_read_input_tokens', None) or 0)
 
         return message.content
-    
 
-# Initialize device and models
-device = 'cuda'
-
-som_model, caption_model_processor = initialize_models(device)
-analyzer = TaskAnalyzer(os.getenv('ANTHROPIC_API_KEY'))
-
-# Wait for the task to be available
-filepath = 'task.json'
-while not os.path.isfile(filepath):
-    print("Waiting for task.json to be available...")
-    time.sleep(1)  # Wait for 5 seconds before checking again
-
-# Once the file is available, open and read it
-with open(filepath, 'r') as file:
-    data = json.load(file)
-task = data["task"]
-
-i = 0
-while True:
-    next_image = 'screenshot_'+str(i)+'.png'
-    if next_image in os.listdir('imgs'):
-        time.sleep(3)
-        image_path = 'imgs/'+next_image
-
-        # Process the image
-        dino_labled_img, label_coordinates, screen_elements = process_image(image_path,som_model,caption_model_processor)
-        Image.open(io.BytesIO(base64.b64decode(dino_labled_img))).save('results/labled_'+next_image)
-    
-        # Task 
+
+class StubTaskAnalyzer:
+    """Stands in for TaskAnalyzer without calling the LLM: always clicks the first element, or with
+    `max_plan_actions` > 1 plans clicks on that many first elements."""
+
+    def __init__(self, max_plan_actions=1):
+        self.max_plan_actions = max_plan_actions
+
+    def analyze_task(self, task, screen_elements, history=None, screen_prompt=None):
+        elements = screen_elements[:self.max_plan_actions] or ["Text Box ID 0: none"]
+        actions = [{"ACTION": "click", "ELEMENT": element, "DETAILS": ""} for element in elements]
+        text = json.dumps(actions if len(actions) > 1 else actions[0], indent=4)
+        return [SimpleNamespace(text=text)]
+
+
+def locate_action(action, label_coordinates, screen_scale=1.0):
+    """Attach the coordinates of its element, in screen pixels, to one action of the LLM answer."""
+    action['COORDINATES'] = (label_coordinates[action['ELEMENT'].split()[3][:-1]] / screen_scale).tolist()
+    return action
+
+
+def parse_instruction(result, label_coordinates, screen_scale=1.0, max_actions=1):
+    """Extract the action JSON from the LLM answer and attach the element coordinates.
+
+    `screen_scale` is the factor the screenshot was scaled down by; the coordinates are
+    divided by it so that they are in screen pixels. The answer may be a list of
+    actions; the first one is returned as before and, with `max_actions` > 1, the
+    following ones up to that many in all go in its PLAN, for the executor to run
+    without a round trip. The plan ends before the first action whose element is not
+    on the screen. With plans, 'type' actions get "PRESS_ENTER": false, for the executor
+    to type without pressing Enter ('submit' presses it); without, 'type' presses Enter.
+    """
+    text = result[0].text
+    try:
+        answer, _ = json.JSONDecoder().raw_decode(text.lstrip())
+    except ValueError:
+        # an object cut short or followed by a stray line, as the LLM sometimes writes it
+        answer = json.loads('\n'.join(text.split('\n')[0:4]) + '\n}')
+    actions = answer if isinstance(answer, list) else [answer]
+    json_result = locate_action(actions[0], label_coordinates, screen_scale)
+    plan = []
+    for action in actions[1:max_actions]:
         try:
-            result = analyzer.analyze_task(task, screen_elements)
-            print(result)
-
-            # Extract the JSON part from the text
-            json_text = result[0].text.split('\n')[0:4]
-            json_result = json.loads('\n'.join(json_text) + '\n}')
-            json_result['COORDINATES'] = label_coordinates[json_result['ELEMENT'].split()[3][:-1]].tolist()
-            
-            # Define the file path where you want to save the result
-            file_path = "results/result_"+str(i)+".json"
-            # Write the result to the JSON file
-            with open(file_path, 'w') as json_file:
-                json.dump(json_result, json_file, indent=4)
-
-            print(f"Result has been saved to {file_path}")
-            task = task + 'knowing that in step '+str(i)+' you did this' + str(result)
-            
-        except Exception as e:
-            print(f"Error: {e}")
-
-        i+=1
+            plan.append(locate_action(action, label_coordinates, screen_scale))
+        except (KeyError, IndexError, AttributeError, TypeError):
+            break
+    if max_actions > 1:
+        for action in [json_result] + plan:
+            if action.get('ACTION') == 'type':
+                action['PRESS_ENTER'] = False
+    if plan:
+        json_result['PLAN'] = plan
+    return json_result
+
+
+class StepRunner:
+    """Turns one screenshot into one action; shared by the file and HTTP front ends.
+
+    Parsing is scheduled on `sessions` (one model set, sessions served round-robin);
+    the analyzer is called from the caller's thread so that one session waiting on the
+    LLM does not hold up the others' parses.
+    `annotate` controls the labeled screenshot: 'sync' draws it before the LLM call as
+    before, 'background' draws it on an AnnotationWriter thread once the action is
+    known, and 'off' skips it. Either way it is labeled with the session's stable
+    element IDs, the ones the analyzer and the executor see.
+    With `incremental`, each session's screenshots are parsed by an IncrementalParser
+    that reuses OCR and captions from the session's previous screenshot.
+    `caption_profile` is the default icon caption decoding profile; a session may ask
+    for another one.
+    `max_plan_actions` is how many actions one result may carry (see parse_instruction).
+    """
+
+    def __init__(self, sessions, som_model, caption_model_processor, analyzer, ocr_worker=None, annotate='sync',
+                 screen_prompt='full', incremental=False, caption_profile='accurate', max_plan_actions=1):
+        self.sessions = sessions
+        self.max_plan_actions = max_plan_actions
+        self.caption_profile = caption_profile
+        self.incremental = incremental
+        self.screen_prompt = screen_prompt
+        self.som_model = som_model
+        self.caption_model_processor = caption_model_processor
+        self.analyzer = analyzer
+        self.ocr_worker = ocr_worker
+        self.annotate = annotate
+        self.annotation_writer = AnnotationWriter(DRAW_BBOX_CONFIG) if annotate == 'background' else None
+
+    def parse(self, session, image_path):
+        """Parse one screenshot (a path or its encoded bytes); runs on the session scheduler."""
+        with metrics.stage('decode'):
+            frame = load_frame(image_path)
+        caption_profile = session.caption_profile or self.caption_profile
+        if self.incremental:
+            if session.parser is None:
+                session.parser = IncrementalParser(
+                    self.ocr, lambda frame, ocr_result, known_captions: self.parse_frame(
+                        frame, ocr_result, known_captions, caption_profile))
+            label_coordinates, screen_elements = session.parser(frame)
+            print(f"Parsed screenshot {session.step} ({session.parser.last_mode})")
+        else:
+            # the labeled screenshot is drawn once the element IDs are the session's stable ones
+            _, label_coordinates, screen_elements = process_image(
+                frame, self.som_model, self.caption_model_processor,
+                ocr_worker=self.ocr_worker, render=False, caption_profile=caption_profile)
+
+        cache = self.caption_model_processor.get('cache')
+        if cache is not None:
+            print("Caption cache: {hits} hits, {disk_hits} disk hits, {misses} misses".format(**cache.stats()))
+        scheduler = self.caption_model_processor.get('scheduler')
+        timings = scheduler.pop_timings() if scheduler is not None else []
+        if timings:
+            print("Captioned {} icons in {} batches ({}) in {:.2f}s".format(
+                sum(t.size for t in timings), len(timings), '/'.join(str(t.size) for t in timings),
+                sum(t.seconds for t in timings)))
+        for timing in timings:
+            # one observation per caption batch of this step
+            metrics.observe('caption_batch', timing.seconds)
+        return frame, label_coordinates, screen_elements
+
+    def warm_up(self):
+        """Run a dummy inference through every model so that the first step does not pay for lazy initialisation."""
+        # the OCR worker warms its engine up as it starts
+        timings = warm_up(self.som_model, self.caption_model_processor,
+                          ocr_engines=() if self.ocr_worker is not None else (OCR_ENGINE,))
+        print("Warmed up " + ", ".join(f"{name} in {seconds:.2f}s" for name, seconds in timings.items()))
+
+    def ocr(self, frame):
+        """OCR one frame or crop; returns (texts, xyxy boxes)."""
+        with metrics.stage('ocr'):
+            if self.ocr_worker is not None:
+                ocr_bbox_rslt, _ = self.ocr_worker.submit(frame, **OCR_ARGS).result()
+            else:
+                ocr_bbox_rslt, _ = check_ocr_box(frame, **OCR_ARGS)
+        return ocr_bbox_rslt
+
+    def parse_frame(self, frame, ocr_result=None, known_captions=None, caption_profile=None):
+        """process_image without rendering; returns (label_coordinates, parsed_content_list)."""
+        _, label_coordinates, parsed_content_list = process_image(
+            frame, self.som_model, self.caption_model_processor, ocr_worker=self.ocr_worker, render=False,
+            ocr_result=ocr_result, known_captions=known_captions, caption_profile=caption_profile or self.caption_profile)
+        return label_coordinates, parsed_content_list
+
+    def run_step(self, session, image_path, plan_report=None):
+        """Parse the current screenshot of `session` and ask the analyzer for the next action.
+
+        `plan_report` is the executor's report on the PLAN of the previous result, if it had one.
+        """
+        labeled_path = os.path.join(session.results_dir, 'labled_screenshot_'+str(session.step)+'.png')
+        # the parse runs on the scheduler thread, in this step's instrumentation context
+        frame, label_coordinates, screen_elements = self.sessions.submit(
+            session, contextvars.copy_context().run, self.parse, session, image_path).result()
+        metrics.count('elements', len(screen_elements))
+
+        # keep element IDs stable across the session's screenshots
+        update = session.tracker.update(screen_elements, label_coordinates)
+        screen_elements, label_coordinates = update.screen_elements, update.label_coordinates
+        if session.step > 0:
+            outcome = update.outcome()
+            if plan_report:
+                outcome = plan_outcome(plan_report, outcome)
+            session.history.set_outcome(session.step - 1, outcome)
+        session.screen_elements = screen_elements
+        if self.annotate == 'sync':
+            with metrics.stage('annotate'):
+                annotated_frame = draw_som_labels(frame, label_coordinates, **DRAW_BBOX_CONFIG)
+            with metrics.stage('write'):
+                Image.fromarray(annotated_frame).save(labeled_path)
+        screen_prompt = session.tracker.prompt(session.step) if self.screen_prompt == 'delta' else None
+
+        with metrics.stage('llm'):
+            result = self.analyzer.analyze_task(session.task, screen_elements, history=session.history,
+                                                screen_prompt=screen_prompt)
+        print(result)
+        json_result = parse_instruction(result, label_coordinates, session.screen_scale, self.max_plan_actions)
+
+        if self.annotation_writer is not None:
+            # the tracker's IDs, as sent to the analyzer and the executor
+            self.annotation_writer.submit(labeled_path, frame, label_coordinates)
+        session.record(json_result)
+        return json_result
+
+
+def serve_files(runner):
+    """Serve one task through the task.json / imgs/ / results/ file protocol."""
+    # Wait for the task to be available
+    filepath = 'task.json'
+    while not os.path.isfile(filepath):
+        print("Waiting for task.json to be available...")
+        time.sleep(1)  # Wait for 5 seconds before checking again
+
+    # Once the file is available, open and read it
+    with open(filepath, 'r') as file:
+        data = json.load(file)
+    session = runner.sessions.create(data["task"], per_session_dirs=False, caption_profile=data.get("caption_profile"),
+                                     screen_scale=float(data.get("screen_scale", 1.0)))
+
+    # Screenshots are picked up as soon as scp closes them
+    intake = ScreenshotIntake(session.imgs_dir)
+    print(f"Watching {session.imgs_dir}/ for screenshots ({intake.backend})")
+    # Every result is also appended to this stream, which the executor follows over ssh
+    stream = open(os.path.join(session.results_dir, 'results.jsonl'), 'w')
+
+    while True:
+        i = session.step
+        # the executor names screenshots after its upload codec
+        image_path = intake.wait_for(['screenshot_'+str(i)+ext for ext in SCREENSHOT_EXTENSIONS])
+        if image_path:
+            try:
+                # the executor uploads its report on the previous result's PLAN just before the screenshot
+                plan_report = None
+                report_path = os.path.join(session.imgs_dir, 'screenshot_'+str(i)+'.json')
+                if os.path.isfile(report_path):
+                    with open(report_path) as report_file:
+                        plan_report = json.load(report_file)
+                with metrics.step(f'{session.id}:{i}', session=session.id, step=i):
+                    json_result = runner.run_step(session, image_path, plan_report)
+
+                    # Define the file path where you want to save the result
+                    file_path = os.path.join(session.results_dir, "result_"+str(i)+".json")
+                    # Write the result to the JSON file, renamed into place so it is never seen half-written
+                    with metrics.stage('write'):
+                        with open(file_path + '.partial', 'w') as json_file:
+                            json.dump(json_result, json_file, indent=4)
+                        os.replace(file_path + '.partial', file_path)
+                        stream.write(json.dumps({"task": session.task, "run": data.get("run"), "step": i, "annotate": runner.annotate, "written_at": time.time(),
+                                                 "result": json_result}) + '\n')
+                        stream.flush()
+
+                print(f"Result has been saved to {file_path}")
+
+            except Exception as e:
+                print(f"Error: {e}")
+                # the step is not recorded, move on to the next screenshot anyway
+                session.step += 1
+
+
+def serve_http(runner, host, port):
+    """Serve tasks over HTTP, see util.parse_service.ParseService for the endpoints."""
+
+    def handle_step(session, image_bytes, plan_report=None):
+        step = session.step
+        with metrics.step(f'{session.id}:{step}', session=session.id, step=step):
+            image_path = os.path.join(session.imgs_dir, 'screenshot_'+str(step)+screenshot_extension(image_bytes))
+            with metrics.stage('write'), open(image_path, 'wb') as f:
+                f.write(image_bytes)
+            # parse straight from the request body rather than reading the file back
+            return runner.run_step(session, image_bytes, plan_report)
+
+    service = ParseService(handle_step, runner.sessions, host=host, port=port, caption_profiles=CAPTION_PROFILES,
+                           metrics=metrics if metrics.enabled else None)
+    print("Serving on http://{}:{}".format(*service.address))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CAT parse-and-plan server")
+    parser.add_argument('--mode', choices=['files', 'http'], default='files',
+                        help="'files': task.json + imgs/ + results/ (scp); 'http': persistent HTTP service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--stub-llm', action='store_true', help="answer every step without calling the LLM")
+    parser.add_argument('--detector-backend', choices=['torch', 'onnx', 'openvino'], default='torch',
+                        help="run the icon detector with ultralytics/PyTorch, or exported to ONNX with ONNX Runtime on the CPU")
+    parser.add_argument('--detector-int8', action='store_true', help="with an ONNX detector backend, use INT8-quantized weights")
+    parser.add_argument('--share-detector-weights', action='store_true',
+                        help="when several server processes run on one host, memory-map the detector weights so that they share one copy; Conv+BN then stay unfused on CPU, which is slower per frame")
+    parser.add_argument('--caption-precision', choices=CPU_PRECISIONS, default='fp32',
+                        help="with --device cpu, run the caption model with INT8 linear layers or in bfloat16 (only with native bf16 support, fp32 otherwise), cached in weights/icon_caption_florence/cpu_cache/")
+    parser.add_argument('--parse-mode', choices=['serial', 'pipelined'], default='serial',
+                        help="'pipelined' runs OCR in a worker process concurrently with icon detection")
+    parser.add_argument('--caption-cache-size', type=int, default=0,
+                        help="number of icon captions kept in memory, e.g. 4096; 0 (the default) disables the caption cache, which reuses the caption of a near-identical crop")
+    parser.add_argument('--caption-cache-db', default=None,
+                        help="with --caption-cache-size, SQLite file that keeps icon captions across restarts, e.g. weights/caption_cache.db")
+    parser.add_argument('--caption-profile', choices=list(CAPTION_PROFILES), default='accurate',
+                        help="icon caption decoding: 'accurate' (3-beam, as OmniParser, the default), 'balanced' (2-beam, 20 tokens) or 'fast' (greedy, 12 tokens); sessions may override it")
+    parser.add_argument('--incremental', action='store_true',
+                        help="reuse OCR and captions for the regions that did not change since the session's previous screenshot")
+    parser.add_argument('--history-tokens', type=int, default=2000,
+                        help="approximate token budget for the step history replayed to the analyzer")
+    parser.add_argument('--screen-prompt', choices=['full', 'delta'], default='full',
+                        help="'full' (the default) sends the whole element list every step, 'delta' sends a cached baseline element list plus the changes since it instead of the full list")
+    parser.add_argument('--annotate', choices=['sync', 'background', 'off'], default='sync',
+                        help="when to draw results/labled_*.png: before the LLM call (the default), after the action is sent, or never")
+    parser.add_argument('--metrics', action='store_true',
+                        help="time every stage and count elements, crops, cache hits and tokens; served as /metrics in http mode")
+    parser.add_argument('--metrics-log', default=None,
+                        help="append one JSON line per step with its stage times and counters to this file (implies --metrics)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="in files mode, serve /metrics on this port (implies --metrics)")
+    parser.add_argument('--max-plan-actions', type=int, default=1,
+                        help="let the analyzer plan up to this many actions per result, which the executor runs back to back")
+    parser.add_argument('--no-warmup', action='store_true',
+                        help="skip the dummy inference through every model at startup; the first step then pays for it")
+    args = parser.parse_args()
+
+    if args.metrics or args.metrics_log or args.metrics_port:
+        metrics.enable(args.metrics_log)
+
+    som_model, caption_model_processor = initialize_models(args.device, args.detector_backend, args.detector_int8,
+                                                           args.caption_precision, args.share_detector_weights)
+    if args.caption_cache_size > 0:
+        caption_model_processor['cache'] = CaptionCache(args.caption_cache_size, args.caption_cache_db)
+    ocr_worker = OCRWorker(engines=(OCR_ENGINE,)) if args.parse_mode == 'pipelined' else None
+    if args.stub_llm:
+        analyzer = StubTaskAnalyzer(args.max_plan_actions)
+    else:
+        analyzer = TaskAnalyzer(os.getenv('ANTHROPIC_API_KEY'), args.max_plan_actions)
+
+    runner = StepRunner(SessionManager(history_tokens=args.history_tokens), som_model, caption_model_processor, analyzer, ocr_worker,
+                        annotate=args.annotate, screen_prompt=args.screen_prompt, incremental=args.incremental,
+                        caption_profile=args.caption_profile, max_plan_actions=args.max_plan_actions)
+    if not args.no_warmup:
+        runner.warm_up()
+
+    if args.mode == 'http':
+        serve_http(runner, args.host, args.port)
+    else:
+        if args.metrics_port:
+            serve_metrics(metrics, args.host, args.metrics_port)
+        serve_files(runner)
+
+
+if __name__ == '__main__':
+    main()
     
@@ -0,0 +1,131 @@
+"""
+Measures what multi-action results (CAT_server --max-plan-actions) save on a form:
+round trips to the server and time to fill it in, one action per result against
+plans run by LocalExecutor (action_plan.execute_plan) with their checks between
+actions.
+
+The screen is a synthetic one in memory (--screen WxH) with --fields text fields
+one under another; typing into a field draws a few characters in it. The actions
+are those the analyzer is asked for: 'type' for every field but the last, 'submit'
+for the last one. Enter sends the form and replaces the screen with another page.
+As in CAT_local.perform_action, 'submit' presses it and so does 'type' unless the
+server marked it "PRESS_ENTER": false, which it does when it plans several actions;
+with one action per result (plan 1) the form is therefore sent after the first field,
+as without plans. --enter-after-type ignores the mark, as an executor predating it
+would. Every round
+trip costs --step-seconds, for the upload, the parse and the LLM call; the executor
+time per round trip covers its actions, the checks between them and the settle wait
+before the next screenshot, as in CAT_local. With --dead N the Nth field ignores the
+first attempt to type into it, so the plan has to stop there and hand back to the
+server.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/action_plans.py --fields 8 --step-seconds 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'LocalExecutor'))
+
+from action_plan import execute_plan
+from screen_settle import SettleDetector
+
+
+class FormScreen:
+    """A screen capture backend grabbing an in-memory form instead of the screen."""
+
+    name = 'form'
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.frame = np.full((height, width, 4), 255, dtype=np.uint8)
+
+    def grab(self, region=None):
+        left, top, right, bottom = region or (0, 0, *self.size)
+        return self.frame[top:bottom, left:right]
+
+    def close(self):
+        pass
+
+
+def field_action(i, fields, max_plan_actions):
+    action = {"ACTION": "submit" if i == fields - 1 else "type", "ELEMENT": f"Text Box ID {i}: field {i}",
+              "DETAILS": f"value {i}", "COORDINATES": [200, 200 + 80 * i, 600, 40]}
+    if max_plan_actions > 1 and action["ACTION"] == "type":
+        # as CAT_server.parse_instruction marks it
+        action["PRESS_ENTER"] = False
+    return action
+
+
+def run(args, max_plan_actions):
+    screen = FormScreen(*args.screen)
+    settle = SettleDetector(capture=screen)
+    typed, ignored, sent = set(), set(), []
+
+    def perform(action, settle):
+        x, y, width, height = action["COORDINATES"]
+        i = (y - 200) // 80
+        if i == args.dead - 1 and i not in ignored:
+            # the dead field ignores the first attempt, e.g. a focus it did not take
+            ignored.add(i)
+            return
+        screen.frame[y + 10:y + 30, x + 10:x + 10 + 12 * len(action["DETAILS"]), :3] = 0
+        typed.add(i)
+        if action["ACTION"] == "submit" or action.get("PRESS_ENTER", True) or args.enter_after_type:
+            # Enter sends the form with the fields filled in so far, and the next page loads
+            sent.append(len(typed))
+            screen.frame[:, :, :3] = 64
+
+    start = time.perf_counter()
+    round_trips, executor_seconds, filled = 0, 0.0, 0
+    while not sent:
+        time.sleep(args.step_seconds)
+        round_trips += 1
+        # the server plans the fields the previous screenshot shows empty
+        actions = [field_action(i, args.fields, max_plan_actions) for i in range(filled, min(args.fields, filled + max_plan_actions))]
+        result = dict(actions[0], PLAN=actions[1:]) if len(actions) > 1 else actions[0]
+        executor_start = time.perf_counter()
+        execute_plan(result, settle, perform)
+        # the screenshot for the next round trip waits for the screen to settle
+        settle.wait()
+        executor_seconds += time.perf_counter() - executor_start
+        while filled in typed:
+            filled += 1
+    return {'round_trips': round_trips, 'seconds': time.perf_counter() - start,
+            'executor_seconds_per_round_trip': executor_seconds / round_trips, 'fields_sent': sent[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fields', type=int, default=8)
+    parser.add_argument('--step-seconds', type=float, default=4.0, help="time of one round trip to the server")
+    parser.add_argument('--screen', type=lambda s: tuple(int(v) for v in s.split('x')), default=(3840, 2160),
+                        help="WxH")
+    parser.add_argument('--dead', type=int, default=0, help="this field (from 1) ignores the first attempt to type into it")
+    parser.add_argument('--enter-after-type', action='store_true',
+                        help="press Enter after every 'type' even when marked \"PRESS_ENTER\": false, as an older executor would")
+    parser.add_argument('--plans', type=int, nargs='+', default=[1, 4, 8], help="values of --max-plan-actions")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {str(n): run(args, n) for n in args.plans}
+
+    print(f"{args.fields} fields, {args.step_seconds}s per round trip, {args.screen[0]}x{args.screen[1]} screen"
+          + (f", field {args.dead} dead" if args.dead else ""))
+    print(f"{'plan':>5} {'round trips':>12} {'total':>8} {'executor/round trip':>19} {'fields sent':>12}")
+    for n, result in results.items():
+        print(f"{n:>5} {result['round_trips']:>12} {result['seconds']:>7.1f}s "
+              f"{result['executor_seconds_per_round_trip']:>18.2f}s {result['fields_sent']:>6}/{args.fields}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Measures the icon caption decoding profiles (utils.CAPTION_PROFILES) on a fixed set of crops.
+
+Every profile captions the same crops; the script reports the time per crop and how
+close the captions are to those of the 'accurate' profile: the share of identical
+captions and the mean similarity (difflib ratio, 1.0 = identical).
+
+The crops are the *.png files in CROPS. With --screenshots DIR, icon crops are first
+extracted from the screenshots in DIR with the icon detector and saved to CROPS, so
+the same set can be reused across runs and machines.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/caption_profiles.py bench_crops --screenshots imgs/ --device cpu
+"""
+import argparse
+import difflib
+import glob
+import json
+import os
+import sys
+import time
+
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import CAPTION_PROFILES, caption_images, get_caption_model_processor, get_yolo_model, load_frame, predict_yolo, remove_overlap
+
+
+def extract_crops(screenshots, crops_dir, detector_path, device, box_threshold=0.03):
+    """Saves the icon crops the detector finds in `screenshots` to `crops_dir`."""
+    som_model = get_yolo_model(detector_path)
+    som_model.to(device)
+    os.makedirs(crops_dir, exist_ok=True)
+    count = 0
+    for path in sorted(glob.glob(os.path.join(screenshots, '*.png'))):
+        frame = load_frame(path)
+        xyxy, _, _ = predict_yolo(som_model, frame, box_threshold, imgsz=640)
+        for x1, y1, x2, y2 in remove_overlap(xyxy.cpu(), iou_threshold=0.1).tolist():
+            crop = frame[int(y1):int(y2), int(x1):int(x2)]
+            if crop.size:
+                Image.fromarray(crop).save(os.path.join(crops_dir, f'crop_{count:05d}.png'))
+                count += 1
+    return count
+
+
+def caption_all(crops, caption_model_processor, prompt, profile):
+    start = time.perf_counter()
+    captions = caption_images(crops, caption_model_processor, prompt, profile)
+    return captions, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('crops', help="directory of icon crops (*.png)")
+    parser.add_argument('--screenshots', help="extract the crops from the screenshots in this directory first")
+    parser.add_argument('--detector', default='weights/icon_detect/model.safetensors')
+    parser.add_argument('--caption-model', default='weights/icon_caption_florence')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--limit', type=int, default=200, help="caption at most this many crops")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.screenshots:
+        print(f"Extracted {extract_crops(args.screenshots, args.crops, args.detector, args.device)} crops")
+    paths = sorted(glob.glob(os.path.join(args.crops, '*.png')))[:args.limit]
+    if not paths:
+        sys.exit(f"no crops in {args.crops}")
+    crops = [Image.open(path).convert('RGB') for path in paths]
+
+    caption_model_processor = get_caption_model_processor(
+        model_name="florence2", model_name_or_path=args.caption_model, device=args.device)
+    prompt = "<CAPTION>"
+    # the first generate call pays for lazy initialisation, keep it out of the measurements
+    caption_images(crops[:2], caption_model_processor, prompt, 'fast')
+
+    reference = None
+    results = {}
+    for profile in ['accurate'] + [name for name in CAPTION_PROFILES if name != 'accurate']:
+        captions, seconds = caption_all(crops, caption_model_processor, prompt, profile)
+        if reference is None:
+            reference = captions
+        identical = sum(a == b for a, b in zip(reference, captions)) / len(crops)
+        similarity = sum(difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(reference, captions)) / len(crops)
+        results[profile] = {
+            'seconds': seconds,
+            'ms_per_crop': 1000 * seconds / len(crops),
+            'identical': identical,
+            'similarity': similarity,
+            'examples': list(zip([os.path.basename(p) for p in paths[:5]], captions[:5])),
+        }
+
+    print(f"{len(crops)} crops on {args.device}")
+    print(f"{'profile':<10} {'total':>8} {'ms/crop':>8} {'identical':>10} {'similarity':>11}")
+    for profile, result in results.items():
+        print(f"{profile:<10} {result['seconds']:>7.2f}s {result['ms_per_crop']:>8.1f} "
+              f"{result['identical']:>10.1%} {result['similarity']:>11.3f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'crops': len(crops), 'device': args.device, 'profiles': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Checks the CPU caption precisions (util.caption_quantization) against float32 on a fixed set of crops.
+
+Florence-2 is loaded on the CPU at every precision and captions the same crops; the
+script reports the load time (the first load of a precision converts the weights and
+caches them, later ones read the cache), the time per crop, and how close the captions are
+to the fp32 ones: the share of identical captions and the mean similarity (difflib
+ratio, 1.0 = identical). It exits with status 1 if the mean similarity of a precision
+falls below --min-similarity. bf16 is skipped on CPUs without native bfloat16, where
+the server runs fp32 instead.
+
+The crops are the *.png files in CROPS; with --screenshots DIR they are first extracted
+from the screenshots in DIR, as in caption_profiles.py.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/caption_quantization.py bench_crops --screenshots imgs/ --precisions int8 bf16
+"""
+import argparse
+import difflib
+import glob
+import json
+import os
+import sys
+import time
+
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from caption_profiles import extract_crops
+from util.caption_quantization import CPU_PRECISIONS, bf16_supported
+from utils import caption_images, get_caption_model_processor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('crops', help="directory of icon crops (*.png)")
+    parser.add_argument('--screenshots', help="extract the crops from the screenshots in this directory first")
+    parser.add_argument('--detector', default='weights/icon_detect/model.safetensors')
+    parser.add_argument('--caption-model', default='weights/icon_caption_florence')
+    parser.add_argument('--precisions', nargs='+', choices=[p for p in CPU_PRECISIONS if p != 'fp32'], default=['int8'])
+    parser.add_argument('--profile', default='accurate', help="the utils.CAPTION_PROFILES decoding profile")
+    parser.add_argument('--limit', type=int, default=100, help="caption at most this many crops")
+    parser.add_argument('--min-similarity', type=float, default=0.9)
+    parser.add_argument('--threads', type=int, help="torch CPU threads")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.screenshots:
+        print(f"Extracted {extract_crops(args.screenshots, args.crops, args.detector, 'cpu')} crops")
+    paths = sorted(glob.glob(os.path.join(args.crops, '*.png')))[:args.limit]
+    if not paths:
+        sys.exit(f"no crops in {args.crops}")
+    crops = [Image.open(path).convert('RGB') for path in paths]
+    if 'bf16' in args.precisions and not bf16_supported():
+        print("This CPU has no native bfloat16 support, skipping bf16")
+        args.precisions = [p for p in args.precisions if p != 'bf16']
+
+    prompt = "<CAPTION>"
+    reference, results = None, {}
+    for precision in ['fp32'] + args.precisions:
+        start = time.perf_counter()
+        caption_model_processor = get_caption_model_processor(
+            model_name="florence2", model_name_or_path=args.caption_model, device='cpu', precision=precision)
+        load_seconds = time.perf_counter() - start
+        # the first generate call pays for lazy initialisation, keep it out of the measurements
+        caption_images(crops[:2], caption_model_processor, prompt, args.profile)
+        start = time.perf_counter()
+        captions = caption_images(crops, caption_model_processor, prompt, args.profile)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = captions
+        results[precision] = {
+            'load_seconds': load_seconds,
+            'ms_per_crop': 1000 * seconds / len(crops),
+            'identical': sum(a == b for a, b in zip(reference, captions)) / len(crops),
+            'similarity': sum(difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(reference, captions)) / len(crops),
+            'differences': [(os.path.basename(p), a, b) for p, a, b in zip(paths, reference, captions) if a != b][:10],
+        }
+        del caption_model_processor
+
+    print(f"{len(crops)} crops, profile {args.profile}, {torch.get_num_threads()} threads")
+    print(f"{'precision':<10} {'load':>7} {'ms/crop':>8} {'speedup':>8} {'identical':>10} {'similarity':>11}")
+    for precision, result in results.items():
+        print(f"{precision:<10} {result['load_seconds']:>6.1f}s {result['ms_per_crop']:>8.1f} "
+              f"{results['fp32']['ms_per_crop'] / result['ms_per_crop']:>7.2f}x "
+              f"{result['identical']:>10.1%} {result['similarity']:>11.3f}")
+    for precision in args.precisions:
+        for name, a, b in results[precision]['differences'][:3]:
+            print(f"  {precision} {name}: {a!r} -> {b!r}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'crops': len(crops), 'profile': args.profile, 'precisions': results}, f, indent=4)
+    if any(results[p]['similarity'] < args.min_similarity for p in args.precisions):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Compares the icon detector backends on CPU: ultralytics/PyTorch against the ONNX export
+run with ONNX Runtime (fp32, and INT8 and OpenVINO if asked for).
+
+Every backend detects icons on the same screenshots through utils.predict_yolo. The
+script reports the p50/p95 latency of each backend and how well its boxes agree with
+the PyTorch ones: a box agrees if the other backend found a box whose coordinates are
+all within --tolerance pixels of it, and the agreement of a screenshot is the share of
+agreeing boxes out of the larger of the two box counts. It exits with status 1 if the
+lowest agreement of the fp32 ONNX backend falls below --min-agreement, or that of the
+INT8 one below --min-agreement-int8.
+
+The screenshots are the *.png files of SCREENSHOTS, or synthetic ones (see
+parse_pipeline.py) if no directory is given.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/detector_backends.py imgs/ --int8 --json detector.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_yolo_model, load_frame, predict_yolo
+
+
+def agreement(reference, candidate, tolerance):
+    """Share of boxes matched one to one within `tolerance` pixels, out of the larger box count."""
+    if not len(reference) and not len(candidate):
+        return 1.0, 0.0
+    if not len(reference) or not len(candidate):
+        return 0.0, float('inf')
+    distance = np.abs(reference[:, None, :] - candidate[None, :, :]).max(axis=2)
+    used = np.zeros(len(candidate), dtype=bool)
+    matched, worst = 0, 0.0
+    for i in np.argsort(distance.min(axis=1)):
+        available = np.where(used, np.inf, distance[i])
+        j = int(available.argmin())
+        if available[j] <= tolerance:
+            used[j] = True
+            matched += 1
+            worst = max(worst, float(available[j]))
+    return matched / max(len(reference), len(candidate)), worst
+
+
+def load_screenshots(directory, count, seed):
+    if directory:
+        paths = sorted(glob.glob(os.path.join(directory, '*.png')))[:count]
+        if not paths:
+            sys.exit(f"no screenshots in {directory}")
+        return [load_frame(path) for path in paths]
+    from parse_pipeline import synthetic_screenshot
+    rng = np.random.default_rng(seed)
+    sizes = [(1280, 720), (1920, 1080), (2560, 1440)]
+    return [synthetic_screenshot(rng, *sizes[i % len(sizes)], 120, 0.5) for i in range(count)]
+
+
+def run_backend(model, frames, box_threshold, warmup):
+    for frame in frames[:warmup]:
+        predict_yolo(model, frame, box_threshold, imgsz=640)
+    boxes, latencies = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        xyxy, _, _ = predict_yolo(model, frame, box_threshold, imgsz=640)
+        latencies.append(time.perf_counter() - start)
+        boxes.append(xyxy.cpu().numpy())
+    return boxes, 1000 * np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('screenshots', nargs='?', help="directory of screenshots (*.png); synthetic ones if omitted")
+    parser.add_argument('--detector', default='weights/icon_detect/model.safetensors')
+    parser.add_argument('--count', type=int, default=30, help="number of screenshots")
+    parser.add_argument('--box-threshold', type=float, default=0.03, help="as CAT_server.process_image")
+    parser.add_argument('--int8', action='store_true', help="also measure the INT8-quantized ONNX model")
+    parser.add_argument('--openvino', action='store_true', help="also measure ONNX Runtime's OpenVINO execution provider")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="pixels within which two boxes agree")
+    parser.add_argument('--min-agreement', type=float, default=0.98)
+    parser.add_argument('--min-agreement-int8', type=float, default=0.9)
+    parser.add_argument('--threads', type=int, help="torch CPU threads")
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    frames = load_screenshots(args.screenshots, args.count, args.seed)
+
+    backends = [('torch', 'torch', False), ('onnx', 'onnx', False)]
+    if args.int8:
+        backends.append(('onnx-int8', 'onnx', True))
+    if args.openvino:
+        backends.append(('openvino', 'openvino', False))
+
+    reference, results = None, {}
+    for name, backend, int8 in backends:
+        model = get_yolo_model(args.detector, backend=backend, int8=int8)
+        model.to('cpu')
+        boxes, latencies = run_backend(model, frames, args.box_threshold, args.warmup)
+        if reference is None:
+            reference = boxes
+        agreements = [agreement(r, b, args.tolerance) for r, b in zip(reference, boxes)]
+        results[name] = {
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'boxes_per_screenshot': float(np.mean([len(b) for b in boxes])),
+            'min_agreement': min(a for a, _ in agreements),
+            'mean_agreement': float(np.mean([a for a, _ in agreements])),
+            'max_deviation_px': max(d for _, d in agreements),
+        }
+
+    print(f"{len(frames)} screenshots, tolerance {args.tolerance}px")
+    print(f"{'backend':<10} {'p50':>9} {'p95':>9} {'speedup':>8} {'boxes':>6} {'agreement':>10} {'lowest':>7} {'max dev':>8}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms "
+              f"{results['torch']['p50_ms'] / result['p50_ms']:>7.2f}x {result['boxes_per_screenshot']:>6.1f} "
+              f"{result['mean_agreement']:>10.1%} {result['min_agreement']:>7.1%} {result['max_deviation_px']:>6.2f}px")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'screenshots': len(frames), 'tolerance': args.tolerance, 'backends': results}, f, indent=4)
+
+    failed = results['onnx']['min_agreement'] < args.min_agreement
+    if 'onnx-int8' in results:
+        failed = failed or results['onnx-int8']['min_agreement'] < args.min_agreement_int8
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
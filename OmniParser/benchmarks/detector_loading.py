@@ -0,0 +1,112 @@
+"""
+Compares the ways of loading the icon detector: unpickling best.pt, memory-mapping
+model.safetensors (util.detector_weights with share=True, CAT_server
+--share-detector-weights), and copying the safetensors weights into the process (the
+default).
+
+For every mode, --processes processes load the detector at the same time, as server
+workers on one host would, and detect icons on one synthetic screenshot. Each process
+reports its load time and, while all of them are still alive, the memory the detector
+added to it: RSS, PSS (resident memory with every shared page divided among the
+processes mapping it) and private memory. Shared weights show up as a PSS well below
+the RSS; copied or unpickled ones as private memory in every process.
+
+Each process also times --frames detections after a warm-up one ('detect', the
+median per frame): on CPU the shared weights are not fused (Conv+BN), the copied
+ones are, so this is what sharing costs per frame.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/detector_loading.py --processes 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def memory():
+    """Rss, Pss and private memory of this process in MB, from /proc/self/smaps_rollup."""
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                values[key] = int(rest.split()[0]) / 1024
+    return {'rss_mb': values['Rss'], 'pss_mb': values['Pss'],
+            'private_mb': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def worker(mode, path, frames, barrier, results):
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    from ultralytics import YOLO
+    from util.detector_weights import load_detector
+    from utils import predict_yolo
+
+    frame = np.full((1080, 1920, 3), 255, dtype=np.uint8)
+    frame[200:300, 400:500] = (30, 90, 200)
+    before = memory()
+    start = time.perf_counter()
+    if mode == 'pickle':
+        model = YOLO(path)
+    else:
+        model = load_detector(path, share=mode == 'mmap')
+    load_seconds = time.perf_counter() - start
+    predict_yolo(model, frame, box_threshold=0.05, imgsz=640)
+    detect_seconds = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        predict_yolo(model, frame, box_threshold=0.05, imgsz=640)
+        detect_seconds.append(time.perf_counter() - start)
+    # measure once every process has its detector, so that PSS splits the shared pages
+    barrier.wait()
+    after = memory()
+    results.put({'load_seconds': load_seconds, 'detect_seconds': statistics.median(detect_seconds),
+                 **{key: after[key] - before[key] for key in after}})
+    barrier.wait()
+
+
+def run(mode, path, processes, frames):
+    context = multiprocessing.get_context('spawn')
+    barrier, results = context.Barrier(processes), context.Queue()
+    workers = [context.Process(target=worker, args=(mode, path, frames, barrier, results)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    measurements = [results.get(timeout=600) for _ in workers]
+    for process in workers:
+        process.join()
+    return {key: statistics.median(m[key] for m in measurements) for key in measurements[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default='weights/icon_detect/model.safetensors')
+    parser.add_argument('--pickle', default='weights/icon_detect/best.pt',
+                        help="the converted weights (weights/convert_safetensor_to_pt.py); skipped if missing")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--frames', type=int, default=10, help="detections timed per process")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    modes = [('mmap', args.weights), ('copy', args.weights)]
+    if os.path.exists(args.pickle):
+        modes.insert(0, ('pickle', args.pickle))
+    results = {mode: run(mode, path, args.processes, args.frames) for mode, path in modes}
+
+    print(f"{args.processes} processes, medians per process")
+    print(f"{'mode':<8} {'load':>8} {'detect':>8} {'RSS':>8} {'PSS':>8} {'private':>8}")
+    for mode, result in results.items():
+        print(f"{mode:<8} {1000 * result['load_seconds']:>6.0f}ms {1000 * result['detect_seconds']:>6.1f}ms "
+              f"{result['rss_mb']:>6.1f}MB {result['pss_mb']:>6.1f}MB {result['private_mb']:>6.1f}MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'processes': args.processes, 'frames': args.frames, 'modes': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Checks the incremental parse against a full parse on a recorded sequence of screenshots.
+
+Every screenshot is parsed twice: by an IncrementalParser that carries its state from
+one screenshot to the next, as a session does, and by a plain full parse. For each
+screenshot the script prints how it was parsed incrementally, both timings, and the
+share of the full parse's elements that the incremental parse found too (same kind,
+same text and IoU >= 0.5). It exits with status 1 if that share falls below
+--min-agreement for any screenshot.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/incremental_parse.py imgs/ --device cuda
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CAT_server import StepRunner, initialize_models
+from util.incremental import IncrementalParser, _iou
+from utils import load_frame
+
+
+def elements(label_coordinates, parsed_content_list):
+    """(kind, text, xyxy box) for every parsed element."""
+    result = []
+    for line in parsed_content_list:
+        head, text = line.split(': ', 1)
+        kind, element_id = head.rsplit(' ID ', 1)
+        x, y, w, h = (float(v) for v in label_coordinates[element_id])
+        result.append((kind, text, [x, y, x + w, y + h]))
+    return result
+
+
+def agreement(reference, candidate, min_iou=0.5):
+    """Share of the reference elements that have a candidate of the same kind and text overlapping it."""
+    if not reference:
+        return 1.0
+    found = 0
+    for kind, text, box in reference:
+        boxes = [b for k, t, b in candidate if k == kind and t == text]
+        if boxes and _iou(np.array([box]), np.array(boxes)).max() >= min_iou:
+            found += 1
+    return found / len(reference)
+
+
+def screenshot_index(path):
+    match = re.search(r'(\d+)\D*$', os.path.basename(path))
+    return int(match.group(1)) if match else -1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help="directory of consecutive screenshots, e.g. a session's imgs/")
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--min-agreement', type=float, default=0.95)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.directory, '*.png')), key=screenshot_index)
+    if not paths:
+        sys.exit(f"no screenshots in {args.directory}")
+
+    som_model, caption_model_processor = initialize_models(args.device)
+    runner = StepRunner(None, som_model, caption_model_processor, analyzer=None, annotate='off')
+    incremental = IncrementalParser(runner.ocr, runner.parse_frame)
+
+    worst = 1.0
+    incremental_total = full_total = 0.0
+    print(f"{'screenshot':<28} {'mode':<12} {'incremental':>12} {'full':>8} {'agreement':>10}")
+    for path in paths:
+        frame = load_frame(path)
+        start = time.perf_counter()
+        incremental_result = incremental(frame)
+        incremental_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        full_result = runner.parse_frame(frame)
+        full_time = time.perf_counter() - start
+
+        share = agreement(elements(*full_result), elements(*incremental_result))
+        worst = min(worst, share)
+        incremental_total += incremental_time
+        full_total += full_time
+        print(f"{os.path.basename(path):<28} {incremental.last_mode:<12} {incremental_time:>11.3f}s {full_time:>7.3f}s {share:>10.1%}")
+
+    print(f"total: incremental {incremental_total:.2f}s, full {full_total:.2f}s, lowest agreement {worst:.1%}")
+    if worst < args.min_agreement:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
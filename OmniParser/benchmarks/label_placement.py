@@ -0,0 +1,134 @@
+"""
+Micro-benchmark of the BoxAnnotator label placement against the original implementation.
+
+For every box count, random screen-like layouts are labelled by the original
+per-detection scan, by get_optimal_label_pos with a shared BoxIndex (what
+BoxAnnotator does by default) and by the one-pass resolve_label_positions. The first
+two must place every label identically; the script exits with status 1 if they do
+not. For all three it prints the time and the number of labels that overlap another
+label.
+
+Run from the OmniParser directory:
+    python benchmarks/label_placement.py --sizes 50 200 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import supervision as sv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.box_annotator import IoU, BoxIndex, get_optimal_label_pos, overlap_ratios, resolve_label_positions
+
+
+def get_optimal_label_pos_reference(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size):
+    """The original implementation, kept as the reference output."""
+
+    def get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size):
+        is_overlap = False
+        for i in range(len(detections)):
+            detection = detections.xyxy[i].astype(int)
+            if IoU([text_background_x1, text_background_y1, text_background_x2, text_background_y2], detection) > 0.3:
+                is_overlap = True
+                break
+        if text_background_x1 < 0 or text_background_x2 > image_size[0] or text_background_y1 < 0 or text_background_y2 > image_size[1]:
+            is_overlap = True
+        return is_overlap
+
+    positions = [
+        (x1 + text_padding, y1 - text_padding, x1, y1 - 2 * text_padding - text_height, x1 + 2 * text_padding + text_width, y1),
+        (x1 - text_padding - text_width, y1 + text_padding + text_height, x1 - 2 * text_padding - text_width, y1, x1, y1 + 2 * text_padding + text_height),
+        (x2 + text_padding, y1 + text_padding + text_height, x2, y1, x2 + 2 * text_padding + text_width, y1 + 2 * text_padding + text_height),
+        (x2 - text_padding - text_width, y1 - text_padding, x2 - 2 * text_padding - text_width, y1 - 2 * text_padding - text_height, x2, y1),
+    ]
+    for position in positions:
+        if not get_is_overlap(detections, *position[2:], image_size):
+            return position
+    return positions[-1]
+
+
+def random_layout(n, rng, image_size=(1920, 1080)):
+    """n pixel xyxy detections: mostly small widgets, some touching or nested, a few large panels."""
+    w, h = image_size
+    xy = rng.random((n, 2)) * [w, h]
+    wh = rng.random((n, 2)) * [60, 30] + [8, 8]
+    xyxy = np.concatenate([xy, np.minimum(xy + wh, [w, h])], axis=1)
+    panels = max(1, n // 50)
+    xyxy[:panels, 2:] = np.minimum(xyxy[:panels, :2] + rng.random((panels, 2)) * [800, 500], [w, h])
+    return sv.Detections(xyxy=xyxy.astype(np.float32))
+
+
+def label_sizes(n, text_scale=0.4, text_thickness=2):
+    return [cv2.getTextSize(str(i), cv2.FONT_HERSHEY_SIMPLEX, text_scale, text_thickness)[0] for i in range(n)]
+
+
+def label_collisions(positions):
+    """Number of labels whose background intersects that of another label."""
+    index = BoxIndex(np.array([position[2:] for position in positions]).reshape(-1, 4))
+    collisions = 0
+    for i, position in enumerate(positions):
+        others = index.candidates(position[2:])
+        others = others[others != i]
+        collisions += bool((overlap_ratios(position[2:], index.boxes[others]) > 0).any())
+    return collisions
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 500, 1000])
+    parser.add_argument('--text-padding', type=int, default=5)
+    parser.add_argument('--reference-limit', type=int, default=1000,
+                        help="skip the original scan above this many boxes (it is O(n^2) in Python)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    image_size = (1920, 1080)
+    mismatches = 0
+    print(f"{'boxes':>6} {'reference':>10} {'indexed':>9} {'one pass':>9} {'speedup':>8} "
+          f"{'collisions':>11} {'one pass':>9}  output")
+    for n in args.sizes:
+        detections = random_layout(n, rng, image_size)
+        boxes = detections.xyxy.astype(int)
+        sizes = label_sizes(n)
+
+        def indexed():
+            index = BoxIndex(boxes)
+            return [get_optimal_label_pos(args.text_padding, w, h, *boxes[i], detections, image_size, index)
+                    for i, (w, h) in enumerate(sizes)]
+
+        repeat = 3 if n <= 500 else 1
+        positions, indexed_time = timed(indexed, repeat)
+        resolved, resolved_time = timed(lambda: resolve_label_positions(args.text_padding, sizes, boxes, image_size), repeat)
+        same = True
+        if n <= args.reference_limit:
+            reference, reference_time = timed(lambda: [
+                get_optimal_label_pos_reference(args.text_padding, w, h, *boxes[i], detections, image_size)
+                for i, (w, h) in enumerate(sizes)], 1)
+            same = [tuple(map(int, p)) for p in reference] == [tuple(map(int, p)) for p in positions]
+            speedup = f"{reference_time / indexed_time:>7.0f}x"
+            reference_column = f"{reference_time:>9.3f}s"
+        else:
+            speedup, reference_column = f"{'-':>8}", f"{'-':>10}"
+        mismatches += not same
+        print(f"{n:>6} {reference_column} {indexed_time:>8.4f}s {resolved_time:>8.4f}s {speedup} "
+              f"{label_collisions(positions):>11} {label_collisions(resolved):>9}  {'identical' if same else 'MISMATCH'}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+End-to-end benchmark of CAT_server.process_image, on CPU, with stub or real models.
+
+Every scenario parses a set of screenshots: synthetic GUI screenshots drawn for each
+--resolutions x --elements combination (panels, icons, buttons and text lines, with
+--text-share of the elements being text), or the *.png files of --corpus. For each
+scenario the script reports the wall time of every stage (decode, OCR, icon
+detection, overlap removal, captioning, annotation and the rest, i.e. PNG encoding
+and glue code), the p50/p95/p99 latency of a whole parse, the throughput and the
+peak resident memory.
+
+By default all models are stubs that do a similar kind of work with OpenCV, so the
+benchmark needs no GPU and no weights and measures the pipeline code itself:
+    --detector stub       edge components stand in for the YOLO icon detector
+    --ocr stub            horizontally merged edge components stand in for OCR lines
+    --caption-model stub  a mean-colour "caption" per crop, batched through the real scheduler
+Pass --detector weights/icon_detect/model.safetensors, --ocr paddle|easyocr or
+--caption-model weights/icon_caption_florence to measure the real models on CPU.
+
+--json writes the results; --compare reads a previous --json file and exits with
+status 1 if the p50 latency of any scenario grew by more than --max-regression.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/parse_pipeline.py --json results.json
+    python benchmarks/parse_pipeline.py --compare results.json
+"""
+import argparse
+import functools
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CAT_server
+import utils
+from utils import get_caption_model_processor, get_yolo_model
+
+STAGES = ['decode', 'ocr', 'detect', 'overlap', 'caption', 'annotate']
+
+WORDS = ['File', 'Edit', 'View', 'Settings', 'Open', 'Save as', 'Cancel', 'OK', 'Search', 'Downloads',
+         'Recent documents', 'Network', 'Display', 'Apply', 'Help', 'Terminal', 'Properties', 'Close']
+
+
+def synthetic_screenshot(rng, width, height, elements, text_share):
+    """An RGB screenshot-like image: a few panels, then icons, buttons and text lines at random places."""
+    frame = np.full((height, width, 3), rng.integers(225, 250), dtype=np.uint8)
+    for _ in range(rng.integers(2, 5)):
+        x, y = int(rng.integers(0, width - 100)), int(rng.integers(0, height - 100))
+        w, h = int(rng.integers(200, width // 2)), int(rng.integers(100, height // 2))
+        cv2.rectangle(frame, (x, y), (x + w, y + h), [int(c) for c in rng.integers(200, 240, 3)], cv2.FILLED)
+    for _ in range(elements):
+        x, y = int(rng.integers(0, width - 200)), int(rng.integers(30, height - 40))
+        color = [int(c) for c in rng.integers(0, 160, 3)]
+        kind = rng.random()
+        if kind < text_share:
+            text = ' '.join(rng.choice(WORDS, rng.integers(1, 4)))
+            cv2.putText(frame, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, float(rng.uniform(0.4, 0.7)), (20, 20, 20), 1, cv2.LINE_AA)
+        elif kind < text_share + (1 - text_share) / 2:
+            size = int(rng.integers(16, 48))
+            cv2.rectangle(frame, (x, y), (x + size, y + size), color, cv2.FILLED)
+            cv2.circle(frame, (x + size // 2, y + size // 2), size // 4, (255, 255, 255), cv2.FILLED)
+        else:
+            w, h = int(rng.integers(60, 160)), int(rng.integers(24, 36))
+            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+            cv2.putText(frame, str(rng.choice(WORDS)), (x + 8, y + h - 9), cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1, cv2.LINE_AA)
+    return frame
+
+
+def edge_components(frame, kernel, min_size=8):
+    """xyxy boxes of the connected components of the dilated edges of an RGB or BGR frame."""
+    edges = cv2.Canny(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 50, 150)
+    mask = cv2.dilate(edges, np.ones(kernel, np.uint8))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    x, y, w, h = stats[1:, 0], stats[1:, 1], stats[1:, 2], stats[1:, 3]
+    keep = (w >= min_size) & (h >= min_size) & (w * h < frame.shape[0] * frame.shape[1] // 2)
+    return np.stack([x, y, x + w, y + h], axis=1)[keep]
+
+
+class StubDetector:
+    """Stands in for the ultralytics YOLO model in utils.predict_yolo."""
+
+    def predict(self, source, conf, imgsz):
+        boxes = edge_components(source, (3, 3))
+        result = SimpleNamespace(xyxy=torch.tensor(boxes, dtype=torch.float32).reshape(-1, 4),
+                                 conf=torch.full((len(boxes),), 0.5))
+        return [SimpleNamespace(boxes=result)]
+
+
+def stub_check_ocr_box(image, **ocr_args):
+    """Stands in for utils.check_ocr_box: wide components of the horizontally dilated edges are text lines."""
+    boxes = edge_components(image, (3, 9))
+    w, h = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+    boxes = boxes[(w >= 2 * h) & (h <= 60)]
+    return ([f"text {i}" for i in range(len(boxes))], boxes.tolist()), None
+
+
+class StubCaptionProcessor:
+    """Turns PIL crops into a batch of 8x8 thumbnails, and generated ids back into text."""
+
+    def __call__(self, images, text, return_tensors):
+        thumbnails = [np.asarray(image.resize((8, 8))) for image in images]
+        pixel_values = torch.tensor(np.stack(thumbnails), dtype=torch.float32).permute(0, 3, 1, 2) / 255
+        return StubInputs(input_ids=torch.zeros((len(images), 1), dtype=torch.long), pixel_values=pixel_values)
+
+    def batch_decode(self, ids, skip_special_tokens=True):
+        return [f"icon {'-'.join(str(int(v)) for v in row)}" for row in ids]
+
+
+class StubInputs(dict):
+
+    def to(self, device=None, dtype=None):
+        return self
+
+
+class StubCaptionModel(torch.nn.Module):
+    """A 'Florence' caption model whose caption is the quantized mean colour of the crop."""
+
+    def __init__(self):
+        super().__init__()
+        self.config = SimpleNamespace(name_or_path='stub_florence', model_type='stub')
+        self.pool = torch.nn.AdaptiveAvgPool2d(1)
+
+    @property
+    def device(self):
+        return torch.device('cpu')
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def generate(self, input_ids, pixel_values, **generate_args):
+        return (self.pool(pixel_values).flatten(1) * 7).round().long()
+
+
+class StageTimer:
+    """Accumulates the wall time spent in wrapped functions, by stage; nested stages count once, in the outer one."""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._depth = 0
+
+    def wrap(self, module, name, stage):
+        fn = getattr(module, name)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if self._depth:
+                return fn(*args, **kwargs)
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self._depth -= 1
+
+        setattr(module, name, timed)
+
+    def reset(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux), or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def load_models(args):
+    if args.detector == 'stub':
+        som_model = StubDetector()
+    else:
+        som_model = get_yolo_model(args.detector)
+        som_model.to('cpu')
+    if args.caption_model == 'stub':
+        caption_model_processor = {'model': StubCaptionModel(), 'processor': StubCaptionProcessor()}
+    else:
+        caption_model_processor = get_caption_model_processor(
+            model_name="florence2", model_name_or_path=args.caption_model, device='cpu')
+    if args.ocr == 'stub':
+        CAT_server.check_ocr_box = stub_check_ocr_box
+    else:
+        CAT_server.OCR_ARGS['use_paddleocr'] = args.ocr == 'paddle'
+    return som_model, caption_model_processor
+
+
+def scenarios(args):
+    """(name, list of PNG-encoded screenshots) pairs."""
+    if args.corpus:
+        paths = sorted(glob.glob(os.path.join(args.corpus, '*.png')))
+        if not paths:
+            sys.exit(f"no screenshots in {args.corpus}")
+        images = []
+        for path in paths[:args.images]:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        yield os.path.basename(os.path.normpath(args.corpus)), images
+        return
+    rng = np.random.default_rng(args.seed)
+    for resolution in args.resolutions:
+        width, height = (int(v) for v in resolution.lower().split('x'))
+        for elements in args.elements:
+            images = []
+            for _ in range(args.images):
+                frame = synthetic_screenshot(rng, width, height, elements, args.text_share)
+                images.append(cv2.imencode('.png', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))[1].tobytes())
+            yield f'{resolution}-{elements}', images
+
+
+def run_scenario(images, som_model, caption_model_processor, timer, args):
+    # the first parses pay for lazy initialisation, keep them out of the measurements
+    for image in images[:args.warmup]:
+        CAT_server.process_image(image, som_model, caption_model_processor, render=not args.no_render,
+                                 caption_profile=args.caption_profile)
+    latencies, stages, elements = [], dict.fromkeys(STAGES + ['other'], 0.0), 0
+    for image in images:
+        timer.reset()
+        start = time.perf_counter()
+        _, label_coordinates, _ = CAT_server.process_image(
+            image, som_model, caption_model_processor, render=not args.no_render, caption_profile=args.caption_profile)
+        latency = time.perf_counter() - start
+        latencies.append(latency)
+        elements += len(label_coordinates)
+        for stage, seconds in timer.seconds.items():
+            stages[stage] += seconds
+        stages['other'] += latency - sum(timer.seconds.values())
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        'images': len(images),
+        'elements_per_image': elements / len(images),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'mean_ms': float(latencies_ms.mean()),
+        'throughput': len(images) / sum(latencies),
+        'stages_ms': {stage: 1000 * seconds / len(images) for stage, seconds in stages.items()},
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline_path, max_regression):
+    """Prints the p50 change of every scenario also in the baseline; returns the number of regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    regressions = 0
+    print(f"\n{'scenario':<18} {'baseline p50':>13} {'p50':>9} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['p50_ms'], result['p50_ms']
+        change = after / before - 1
+        regressed = change > max_regression
+        regressions += regressed
+        print(f"{name:<18} {before:>11.1f}ms {after:>7.1f}ms {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help="directory of screenshots (*.png) to parse instead of synthetic ones")
+    parser.add_argument('--resolutions', nargs='+', default=['1280x720', '1920x1080', '2560x1440'])
+    parser.add_argument('--elements', type=int, nargs='+', default=[40, 150], help="elements per synthetic screenshot")
+    parser.add_argument('--text-share', type=float, default=0.5, help="share of the synthetic elements that are text lines")
+    parser.add_argument('--images', type=int, default=20, help="screenshots per scenario")
+    parser.add_argument('--warmup', type=int, default=2, help="unmeasured parses at the start of each scenario")
+    parser.add_argument('--detector', default='stub', help="'stub' or the path of the YOLO weights")
+    parser.add_argument('--ocr', choices=['stub', 'paddle', 'easyocr'], default='stub')
+    parser.add_argument('--caption-model', default='stub', help="'stub' or the path of the Florence-2 weights")
+    parser.add_argument('--caption-profile', choices=list(utils.CAPTION_PROFILES), default='accurate')
+    parser.add_argument('--no-render', action='store_true', help="parse without drawing the labeled screenshot")
+    parser.add_argument('--threads', type=int, help="torch CPU threads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="a previous --json file to compare the p50 latencies with")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="with --compare, exit with status 1 if a p50 latency grew by more than this share")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    som_model, caption_model_processor = load_models(args)
+    timer = StageTimer()
+    timer.wrap(CAT_server, 'load_frame', 'decode')
+    timer.wrap(CAT_server, 'check_ocr_box', 'ocr')
+    timer.wrap(utils, 'predict_yolo', 'detect')
+    timer.wrap(utils, 'remove_overlap', 'overlap')
+    timer.wrap(utils, 'get_parsed_content_icon', 'caption')
+    timer.wrap(utils, 'get_parsed_content_icon_phi3v', 'caption')
+    timer.wrap(utils, 'annotate', 'annotate')
+
+    results = {}
+    print(f"{'scenario':<18} {'elements':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'img/s':>6} {'peak RSS':>9}  "
+          + ' '.join(f'{stage:>8}' for stage in STAGES + ['other']))
+    for name, images in scenarios(args):
+        result = run_scenario(images, som_model, caption_model_processor, timer, args)
+        results[name] = result
+        print(f"{name:<18} {result['elements_per_image']:>8.0f} {result['p50_ms']:>6.1f}ms {result['p95_ms']:>6.1f}ms "
+              f"{result['p99_ms']:>6.1f}ms {result['throughput']:>6.2f} {result['peak_rss_mb']:>7.0f}MB  "
+              + ' '.join(f"{result['stages_ms'][stage]:>6.1f}ms" for stage in STAGES + ['other']))
+
+    if args.json:
+        config = {k: v for k, v in vars(args).items() if k not in ('json', 'compare')}
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'config': config, 'scenarios': results}, f, indent=4)
+    if args.compare and compare(results, args.compare, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
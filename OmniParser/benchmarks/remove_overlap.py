@@ -0,0 +1,128 @@
+"""
+Micro-benchmark of utils.remove_overlap against the original pure-Python implementation.
+
+For every box count, random screen-like layouts (normalized xyxy detections plus a
+third as many OCR boxes) are filtered by the original nested loop, the vectorized
+version and the vectorized version with grid bucketing. The outputs must be identical;
+the script exits with status 1 if they are not.
+
+Run from the OmniParser directory:
+    python benchmarks/remove_overlap.py --sizes 50 200 1000 5000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import remove_overlap
+
+
+def remove_overlap_reference(boxes, iou_threshold, ocr_bbox=None):
+    """The original implementation, kept as the reference output."""
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def IoU(box1, box2):
+        intersection = intersection_area(box1, box2)
+        union = box_area(box1) + box_area(box2) - intersection + 1e-6
+        if box_area(box1) > 0 and box_area(box2) > 0:
+            ratio1 = intersection / box_area(box1)
+            ratio2 = intersection / box_area(box2)
+        else:
+            ratio1, ratio2 = 0, 0
+        return max(intersection / union, ratio1, ratio2)
+
+    boxes = boxes.tolist()
+    filtered_boxes = []
+    if ocr_bbox:
+        filtered_boxes.extend(ocr_bbox)
+    for i, box1 in enumerate(boxes):
+        is_valid_box = True
+        for j, box2 in enumerate(boxes):
+            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
+                is_valid_box = False
+                break
+        if is_valid_box:
+            if ocr_bbox:
+                if not any(IoU(box1, box3) > iou_threshold for k, box3 in enumerate(ocr_bbox)):
+                    filtered_boxes.append(box1)
+            else:
+                filtered_boxes.append(box1)
+    return torch.tensor(filtered_boxes)
+
+
+def random_layout(n, rng):
+    """n detections and n // 3 OCR boxes: mostly small widgets, some nested or duplicated, a few large panels."""
+    def boxes(count, max_size):
+        xy = rng.random((count, 2))
+        wh = rng.random((count, 2)) * max_size + 0.002
+        return np.concatenate([xy, np.minimum(xy + wh, 1.0)], axis=1)
+
+    detections = boxes(n, 0.05)
+    # near-duplicates and nested boxes, as the detector produces
+    duplicates = rng.choice(n, n // 5, replace=False)
+    detections[duplicates[: len(duplicates) // 2]] += rng.normal(0, 0.002, (len(duplicates) // 2, 4))
+    detections[: max(1, n // 50)] = boxes(max(1, n // 50), 0.4)
+    detections = np.clip(detections, 0, 1)
+    detections[:, 2:] = np.maximum(detections[:, 2:], detections[:, :2])
+    ocr = boxes(max(1, n // 3), 0.08).tolist()
+    return torch.tensor(detections, dtype=torch.float32), ocr
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 500, 1000, 2000, 5000])
+    parser.add_argument('--iou-threshold', type=float, default=0.1)
+    parser.add_argument('--grid-size', type=int, default=32)
+    parser.add_argument('--reference-limit', type=int, default=2000,
+                        help="skip the pure-Python reference above this many boxes (it is O(n^2) in Python)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    print(f"{'boxes':>6} {'reference':>10} {'vectorized':>11} {'grid':>9} {'speedup':>8}  output")
+    for n in args.sizes:
+        boxes, ocr = random_layout(n, rng)
+        repeat = 3 if n <= 1000 else 1
+        vectorized, vectorized_time = timed(lambda: remove_overlap(boxes, args.iou_threshold, ocr), repeat)
+        grid, grid_time = timed(lambda: remove_overlap(boxes, args.iou_threshold, ocr, grid_size=args.grid_size), repeat)
+        same = torch.equal(vectorized, grid)
+        if n <= args.reference_limit:
+            reference, reference_time = timed(lambda: remove_overlap_reference(boxes, args.iou_threshold, ocr), 1)
+            same = same and torch.equal(reference, vectorized)
+            speedup = f"{reference_time / min(vectorized_time, grid_time):>7.0f}x"
+            reference_column = f"{reference_time:>9.3f}s"
+        else:
+            speedup, reference_column = f"{'-':>8}", f"{'-':>10}"
+        mismatches += not same
+        print(f"{n:>6} {reference_column} {vectorized_time:>10.4f}s {grid_time:>8.4f}s {speedup}  "
+              f"{'identical' if same else 'MISMATCH'} ({len(vectorized)} boxes kept)")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Measures how long a result takes from being written by CAT_server (file mode) to being
+in the executor's hands, and what the waiting costs the executor.
+
+A writer thread plays the server: every --interval seconds it writes result_<i>.json
+and appends the result to results.jsonl, as serve_files does. The executor side is
+either
+    poll      the previous CAT_local loop: `test -f result_<i>.json` in a new process,
+              again and again without pause, then reading the file
+    stream    LocalExecutor's ResultChannel, following results.jsonl with `tail -F`
+              over one connection
+The script reports the median and p95 latency and the CPU time the executor side used
+per second of waiting (1.0 = one core busy). With --ssh user@host the commands run on
+that host over ssh, against --remote-dir there (which must be writable); otherwise they
+run locally, which leaves out the SSH handshakes the poll loop pays on every check.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/result_delivery.py --steps 20
+"""
+import argparse
+import json
+import os
+import resource
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'LocalExecutor'))
+
+from result_channel import ResultChannel, default_control_path, ssh_options
+
+
+class LocalResultChannel(ResultChannel):
+    """A ResultChannel following the stream on this machine instead of over ssh."""
+
+    def _command(self):
+        return ["sh", "-c", f"tail -n +1 -F {shlex.quote(self.stream_path)} 2>/dev/null"]
+
+
+def remote_command(ssh, control_path, command):
+    return ["ssh", *ssh_options(control_path), ssh, command] if ssh else ["sh", "-c", command]
+
+
+def write_results(ssh, control_path, directory, run, steps, interval, written):
+    """Writes one result per interval, like CAT_server.serve_files; records when each was written."""
+    time.sleep(interval)
+    for i in range(steps):
+        result = json.dumps({"ACTION": "click", "ELEMENT": f"Icon Box ID {i}", "COORDINATES": [i, i, 10, 10]})
+        line = json.dumps({"task": "benchmark", "run": run, "step": i, "written_at": time.time(), "result": json.loads(result)})
+        path = f"{directory}/result_{i}.json"
+        command = (f"printf '%s' {shlex.quote(result)} > {path}.partial && mv {path}.partial {path} && "
+                   f"printf '%s\\n' {shlex.quote(line)} >> {directory}/results.jsonl")
+        written[i] = time.time()
+        subprocess.run(remote_command(ssh, control_path, command), check=True)
+        time.sleep(interval)
+
+
+def poll(ssh, directory, step):
+    """The previous CAT_local loop, without its prints."""
+    path = f"{directory}/result_{step}.json"
+    while True:
+        check = subprocess.run(remote_command(ssh, None, f"test -f {path} && echo 1 || echo 0"),
+                               capture_output=True, text=True)
+        if check.stdout.strip() == '1':
+            return json.loads(subprocess.run(remote_command(ssh, None, f"cat {path}"),
+                                             capture_output=True, text=True).stdout)
+
+
+def cpu_seconds():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def run(mode, args, directory):
+    run = uuid.uuid4().hex
+    control_path = default_control_path() if args.ssh else None
+    subprocess.run(remote_command(args.ssh, control_path,
+                                  f"mkdir -p {directory} && rm -f {directory}/result_*.json && : > {directory}/results.jsonl"),
+                   check=True)
+    channel = None
+    if mode == 'stream':
+        user, _, host = args.ssh.rpartition('@') if args.ssh else ('', '', '')
+        channel = (ResultChannel(user, host, f"{directory}/results.jsonl", run, control_path) if args.ssh else
+                   LocalResultChannel(None, None, f"{directory}/results.jsonl", run))
+        channel.open()
+
+    written = {}
+    writer = threading.Thread(target=write_results,
+                              args=(args.ssh, control_path, directory, run, args.steps, args.interval, written))
+    start_cpu, start = cpu_seconds(), time.perf_counter()
+    writer.start()
+    latencies = []
+    for i in range(args.steps):
+        channel.wait(i) if channel else poll(args.ssh, directory, i)
+        latencies.append(time.time() - written[i])
+    writer.join()
+    wall = time.perf_counter() - start
+    if channel:
+        channel.close()
+    cpu = cpu_seconds() - start_cpu
+    latencies = sorted(1000 * latency for latency in latencies)
+    return {
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        'cpu_per_second': cpu / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between two results")
+    parser.add_argument('--ssh', help="user@host to run the server side on")
+    parser.add_argument('--remote-dir', default='/tmp/cat_result_delivery')
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    directory = args.remote_dir if args.ssh else tempfile.mkdtemp(prefix='cat_result_delivery_')
+    results = {mode: run(mode, args, directory) for mode in ('poll', 'stream')}
+
+    print(f"{args.steps} results, one every {args.interval}s, {'over ssh to ' + args.ssh if args.ssh else 'locally'}")
+    print(f"{'mode':<8} {'p50':>9} {'p95':>9} {'CPU/s':>7}")
+    for mode, result in results.items():
+        print(f"{mode:<8} {result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms {result['cpu_per_second']:>7.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
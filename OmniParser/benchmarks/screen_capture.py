@@ -0,0 +1,102 @@
+"""
+Measures the screen capture backends shared by LocalExecutor and TaskRecorder
+(screen_capture/screen_capture.py, installed with pip install -e ../screen_capture):
+frames per second and CPU time per frame, for the whole screen and for a region.
+
+Every backend grabs --frames frames. The CPU time is that of this process and, when
+the script started the X server itself (--xvfb), that of the server too, which does
+part of the work of every grab. For 'pil', as for the previous capture code, each
+frame also goes through np.array, which the other backends avoid.
+
+Run from the OmniParser directory, under a virtual X server, e.g.:
+    python benchmarks/screen_capture.py --xvfb 3840x2160
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from screen_capture import BACKENDS, open_capture
+
+
+def start_xvfb(size):
+    """Starts Xvfb on a free display with a screen of `size` (WxH) and points DISPLAY at it."""
+    if shutil.which('Xvfb') is None:
+        sys.exit("Xvfb is not installed")
+    display = next(n for n in range(99, 200) if not os.path.exists(f'/tmp/.X11-unix/X{n}'))
+    server = subprocess.Popen(['Xvfb', f':{display}', '-screen', '0', f'{size}x24', '-nolisten', 'tcp'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        if os.path.exists(f'/tmp/.X11-unix/X{display}'):
+            break
+        time.sleep(0.05)
+    os.environ['DISPLAY'] = f':{display}'
+    return server
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of process `pid`, from /proc."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def measure(capture, frames, region, server):
+    capture.grab(region)
+    cpu, server_cpu, start = time.process_time(), server and cpu_seconds(server.pid), time.perf_counter()
+    for _ in range(frames):
+        frame = capture.grab(region)
+        if capture.name == 'pil':
+            frame = np.array(frame)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu + (cpu_seconds(server.pid) - server_cpu if server else 0)
+    return {'fps': frames / wall, 'cpu_ms_per_frame': 1000 * cpu / frames, 'shape': list(frame.shape)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--region', default='0,0,640,360', help="left,top,right,bottom of the region to grab")
+    parser.add_argument('--xvfb', metavar='WxH', help="start a virtual X server with a screen of this size")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = start_xvfb(args.xvfb) if args.xvfb else None
+    region = tuple(int(v) for v in args.region.split(','))
+    results = {}
+    try:
+        for backend in args.backends:
+            try:
+                capture = open_capture(backend)
+            except Exception as e:
+                print(f"{backend:<6} unavailable: {e}")
+                continue
+            results[backend] = {'screen': measure(capture, args.frames, None, server),
+                                'region': measure(capture, args.frames, region, server)}
+            capture.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(f"{args.frames} frames per measurement{', X server CPU included' if server else ''}")
+    print(f"{'backend':<8} {'screen':>10} {'fps':>7} {'CPU/frame':>10} {'region':>10} {'fps':>7} {'CPU/frame':>10}")
+    for backend, result in results.items():
+        line = f"{backend:<8}"
+        for key in ('screen', 'region'):
+            height, width = result[key]['shape'][:2]
+            line += f" {f'{width}x{height}':>10} {result[key]['fps']:>7.1f} {result[key]['cpu_ms_per_frame']:>8.1f}ms"
+        print(line)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures server startup: import time and resident memory of utils and CAT_server, with
+the OCR engines built lazily, against the previous eager behaviour.
+
+Every scenario runs in a fresh interpreter, --repeat times; the script reports the
+median time the scenario's code took and the resident memory (current and peak)
+of the process afterwards:
+    import utils             what importing utils costs now
+    import utils (eager)     the previous import: utils plus matplotlib, openai, requests and
+                             supervision, and both the EasyOCR and the PaddleOCR engine built
+    import CAT_server        the server module, without any model
+    paddle engine            importing utils and building the PaddleOCR engine process_image uses
+    models + warm-up         (with --models) initialize_models and StepRunner.warm_up, as at server start
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/startup.py --models --device cpu
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = """
+import json, os, resource, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss, 'peak_rss_mb': peak}}))
+"""
+
+SCENARIOS = {
+    'import utils': "import utils",
+    'import utils (eager)': "import matplotlib.pyplot, openai, requests, supervision\n"
+                            "import utils\n"
+                            "utils.get_ocr_engine('easyocr'); utils.get_ocr_engine('paddle')",
+    'import CAT_server': "import CAT_server",
+    'paddle engine': "import utils\nutils.get_ocr_engine('paddle')",
+}
+
+MODELS = """
+import CAT_server
+som_model, caption_model_processor = CAT_server.initialize_models({device!r})
+CAT_server.StepRunner(None, som_model, caption_model_processor, analyzer=None, annotate='off').warm_up()
+"""
+
+
+def run(code):
+    """Runs `code` in a fresh interpreter from the OmniParser directory; returns its measurements."""
+    result = subprocess.run([sys.executable, '-c', MEASURE.format(root=ROOT, code=code)], cwd=ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--models', action='store_true', help="also load the models and warm them up")
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = dict(SCENARIOS)
+    if args.models:
+        scenarios['models + warm-up'] = MODELS.format(device=args.device)
+
+    results = {}
+    print(f"{'scenario':<24} {'time':>8} {'RSS':>9} {'peak RSS':>9}")
+    for name, code in scenarios.items():
+        try:
+            runs = [run(code) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:<24} failed: {e}")
+            continue
+        results[name] = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+        print(f"{name:<24} {results[name]['seconds']:>7.2f}s {results[name]['rss_mb']:>7.0f}MB {results[name]['peak_rss_mb']:>7.0f}MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares the screenshot upload settings of LocalExecutor (screenshot_upload.encode_screenshot):
+encode time on the executor, bytes on the wire, and how much the parse of the
+uploaded screenshot differs from the parse of the original one.
+
+A setting is CODEC[:QUALITY][@MAX_WIDTH], e.g. png, webp, jpeg:90 or jpeg:90@1920 (see
+encode_screenshot for what QUALITY means per codec). Every screenshot is parsed once as
+captured (the reference) and once per setting, after encoding, decoding and mapping
+the boxes back to screen pixels, as the server does with COORDINATES. An element of
+the reference is found again if a parsed element overlaps it with an IoU of at least
+--iou; the script reports the share of reference elements found again (recall), the
+share of parsed elements that match one (precision), and the share of found elements
+with the same text or caption (labels).
+
+The screenshots are the *.png files of --corpus, or synthetic 4K ones (see
+parse_pipeline.py). The models are stubs by default, which makes the box figures
+meaningful but not the labels; pass --detector, --ocr and --caption-model as for
+parse_pipeline.py to measure the real parse.
+
+Run from the OmniParser directory, e.g.:
+    python benchmarks/upload_codecs.py --corpus imgs/ --ocr paddle --json codecs.json
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'LocalExecutor'))
+
+import CAT_server
+import utils
+from parse_pipeline import load_models, synthetic_screenshot
+from screenshot_upload import encode_screenshot
+
+SETTINGS = ['png:6', 'png', 'webp', 'jpeg:90', 'jpeg:95', 'png@1920', 'jpeg:90@1920', 'jpeg:90@1280']
+
+
+def parse_setting(setting):
+    """'jpeg:90@1920' -> {'codec': 'jpeg', 'quality': 90, 'max_width': 1920}"""
+    setting, _, max_width = setting.partition('@')
+    codec, _, quality = setting.partition(':')
+    return {'codec': codec, 'quality': int(quality) if quality else None, 'max_width': int(max_width) if max_width else None}
+
+
+def parse(frame, som_model, caption_model_processor, args):
+    """[(xyxy in frame pixels, label)] of the elements process_image finds in `frame`."""
+    _, label_coordinates, parsed_content_list = CAT_server.process_image(
+        frame, som_model, caption_model_processor, render=False, caption_profile=args.caption_profile)
+    elements = []
+    for line in parsed_content_list:
+        prefix, _, label = line.partition(': ')
+        x, y, w, h = (float(v) for v in label_coordinates[prefix.split()[3]])
+        elements.append((np.array([x, y, x + w, y + h]), label))
+    return elements
+
+
+def compare(reference, elements, scale, iou_threshold):
+    """(recall, precision, labels) of `elements`, parsed from a frame scaled by `scale`, against `reference`."""
+    if not reference or not elements:
+        return float(not reference), float(not elements), 1.0
+    ref_boxes = np.stack([box for box, _ in reference])
+    boxes = np.stack([box for box, _ in elements]) / scale
+    lt = np.maximum(ref_boxes[:, None, :2], boxes[None, :, :2])
+    rb = np.minimum(ref_boxes[:, None, 2:], boxes[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area = lambda b: (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    iou = inter / (area(ref_boxes)[:, None] + area(boxes)[None, :] - inter)
+    best = iou.argmax(axis=1)
+    found = iou[np.arange(len(reference)), best] >= iou_threshold
+    same_label = [reference[i][1] == elements[best[i]][1] for i in np.flatnonzero(found)]
+    return (float(found.mean()), float((iou.max(axis=0) >= iou_threshold).mean()),
+            float(np.mean(same_label)) if same_label else 1.0)
+
+
+def load_screenshots(args):
+    if args.corpus:
+        paths = sorted(glob.glob(os.path.join(args.corpus, '*.png')))[:args.images]
+        if not paths:
+            sys.exit(f"no screenshots in {args.corpus}")
+        return [Image.open(path).convert('RGB') for path in paths]
+    rng = np.random.default_rng(args.seed)
+    return [Image.fromarray(synthetic_screenshot(rng, 3840, 2160, args.elements, 0.5)) for _ in range(args.images)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('settings', nargs='*', default=SETTINGS, help="CODEC[:QUALITY][@MAX_WIDTH]")
+    parser.add_argument('--corpus', help="directory of screenshots (*.png) instead of synthetic 4K ones")
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--elements', type=int, default=150, help="elements per synthetic screenshot")
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU at which two elements are the same")
+    parser.add_argument('--detector', default='stub', help="'stub' or the path of the YOLO weights")
+    parser.add_argument('--ocr', choices=['stub', 'paddle', 'easyocr'], default='stub')
+    parser.add_argument('--caption-model', default='stub', help="'stub' or the path of the Florence-2 weights")
+    parser.add_argument('--caption-profile', choices=list(utils.CAPTION_PROFILES), default='accurate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    som_model, caption_model_processor = load_models(args)
+    screenshots = load_screenshots(args)
+    references = [parse(np.asarray(image), som_model, caption_model_processor, args) for image in screenshots]
+
+    results = {}
+    for setting in args.settings:
+        options = parse_setting(setting)
+        runs = []
+        for image, reference in zip(screenshots, references):
+            start = time.perf_counter()
+            data, _, scale = encode_screenshot(image, **options)
+            encode_ms = 1000 * (time.perf_counter() - start)
+            elements = parse(utils.load_frame(data), som_model, caption_model_processor, args)
+            runs.append((encode_ms, len(data), *compare(reference, elements, scale, args.iou)))
+        encode_ms, size, recall, precision, labels = (statistics.mean(values) for values in zip(*runs))
+        results[setting] = {'encode_ms': encode_ms, 'kb': size / 1024, 'recall': recall, 'precision': precision,
+                            'labels': labels}
+
+    width, height = screenshots[0].size
+    print(f"{len(screenshots)} screenshots of {width}x{height}, {statistics.mean(len(r) for r in references):.0f} elements each")
+    print(f"{'setting':<14} {'encode':>8} {'size':>9} {'recall':>7} {'precision':>10} {'labels':>7}")
+    for setting, result in results.items():
+        print(f"{setting:<14} {result['encode_ms']:>6.0f}ms {result['kb']:>7.0f}KB {result['recall']:>7.1%} "
+              f"{result['precision']:>10.1%} {result['labels']:>7.1%}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
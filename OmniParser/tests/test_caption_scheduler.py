@@ -0,0 +1,61 @@
+"""
+Checks how CaptionScheduler assigns crops to batches.
+
+The caption model is a stub that records every batch it is given and "captions" a
+crop with its size, so the tests see both the batches and the order of the captions.
+
+Run from the OmniParser directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.caption_scheduler import CaptionScheduler, resized_bucket, shape_bucket
+
+
+# icon crops as the detector cuts them: squares of several sizes, wide buttons and tall bars
+SIZES = [(24, 24), (32, 32), (180, 40), (24, 26), (64, 64), (20, 120), (30, 30), (200, 36),
+         (28, 28), (48, 48), (16, 16), (90, 30)]
+
+
+def crops(sizes=SIZES):
+    return [Image.new('RGB', size, 'white') for size in sizes]
+
+
+def run(scheduler, items, **kwargs):
+    batches = []
+
+    def run_batch(batch):
+        batches.append([image.size for image in batch])
+        return [f"{image.size}" for image in batch]
+
+    captions = scheduler.run(items, run_batch, key='model', **kwargs)
+    assert captions == [f"{image.size}" for image in items]
+    return batches
+
+
+def test_resized_crops_share_batches_whatever_their_shape():
+    # Florence-2 and BLIP-2 resize every crop to one input size
+    batches = run(CaptionScheduler(initial_batch_size=8), crops(), bucket=resized_bucket)
+    assert [len(batch) for batch in batches] == [8, 4]
+
+
+def test_shape_buckets_never_share_a_batch():
+    # Phi-3-vision keeps the aspect ratio
+    batches = run(CaptionScheduler(initial_batch_size=8), crops())
+    assert sum(len(batch) for batch in batches) == len(SIZES)
+    for batch in batches:
+        assert len({shape_bucket(Image.new('RGB', size)) for size in batch}) == 1
+    buckets = [shape_bucket(Image.new('RGB', batch[0])) for batch in batches]
+    assert len(buckets) == len(set(buckets))
+
+
+def test_batches_follow_the_batch_size():
+    scheduler = CaptionScheduler(initial_batch_size=4, max_batch_size=4)
+    batches = run(scheduler, crops(SIZES * 2), bucket=resized_bucket)
+    assert [len(batch) for batch in batches] == [4] * 6
+    assert [timing.size for timing in scheduler.pop_timings()] == [4] * 6
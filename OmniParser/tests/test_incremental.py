@@ -0,0 +1,133 @@
+"""
+Checks that IncrementalParser returns what a full parse of the same frame returns.
+
+The models are stubs that read the frame itself: text boxes are grey rectangles whose
+grey level is their text, icons are red rectangles whose green level is their caption.
+So a full parse and an incremental one agree exactly when the incremental parser
+carries forward and re-reads the right boxes.
+
+Run from the OmniParser directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.incremental import IncrementalParser
+
+
+def components(mask):
+    """xyxy boxes of the connected regions of a mask, in reading order."""
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    boxes = [[x, y, x + w, y + h] for x, y, w, h, _ in stats[1:count].tolist()]
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def stub_ocr(frame):
+    """Reads every grey rectangle as the text 'text <grey level>'."""
+    grey = (frame[:, :, 0] == frame[:, :, 1]) & (frame[:, :, 1] == frame[:, :, 2]) & (frame[:, :, 0] < 128)
+    boxes = components(grey)
+    return [f"text {frame[y1, x1, 0]}" for x1, y1, _, _ in boxes], boxes
+
+
+class StubParse:
+    """parse(frame, ocr_result, known_captions) as StepRunner.parse_frame, with stub models; counts its work."""
+
+    def __init__(self):
+        self.captioned = 0
+
+    def __call__(self, frame, ocr_result=None, known_captions=None):
+        texts, text_boxes = ocr_result if ocr_result is not None else stub_ocr(frame)
+        h, w = frame.shape[:2]
+        icon_boxes = components((frame[:, :, 0] > 200) & (frame[:, :, 1] < 128) & (frame[:, :, 2] == 0))
+        normalized = np.array([[x1 / w, y1 / h, x2 / w, y2 / h] for x1, y1, x2, y2 in icon_boxes]).reshape(-1, 4)
+        captions = known_captions(normalized) if known_captions is not None else [None] * len(icon_boxes)
+        label_coordinates, parsed_content_list = {}, []
+        for kind, labels, boxes in (('Text Box', texts, text_boxes), ('Icon Box', captions, icon_boxes)):
+            for label, (x1, y1, x2, y2) in zip(labels, boxes):
+                if label is None:
+                    self.captioned += 1
+                    label = f"icon {frame[int(y1), int(x1), 1]}"
+                element_id = str(len(label_coordinates))
+                label_coordinates[element_id] = np.array([x1, y1, x2 - x1, y2 - y1], dtype=float)
+                parsed_content_list.append(f"{kind} ID {element_id}: {label}")
+        return label_coordinates, parsed_content_list
+
+
+def screen(texts, icons, size=(720, 1280)):
+    """A white frame with grey text rectangles {(x, y): level} and red icons {(x, y): level}."""
+    frame = np.full((*size, 3), 255, dtype=np.uint8)
+    for (x, y), level in texts.items():
+        frame[y:y + 20, x:x + 120] = level
+    for (x, y), level in icons.items():
+        frame[y:y + 32, x:x + 32] = (255, level, 0)
+    return frame
+
+
+TEXTS = {(40 + 300 * col, 40 + 60 * row): 10 + 4 * (4 * row + col) for row in range(10) for col in range(4)}
+ICONS = {(1220, 40 + 60 * row): 10 * row for row in range(10)}
+
+
+def assert_same_parse(result, expected):
+    label_coordinates, parsed_content_list = result
+    expected_coordinates, expected_list = expected
+    assert parsed_content_list == expected_list
+    assert label_coordinates.keys() == expected_coordinates.keys()
+    for element_id, coordinates in expected_coordinates.items():
+        np.testing.assert_allclose(label_coordinates[element_id], coordinates)
+
+
+def incremental_parser():
+    crops = []
+
+    def ocr(crop):
+        crops.append(crop.shape[:2])
+        return stub_ocr(crop)
+
+    parse = StubParse()
+    return IncrementalParser(ocr, parse), parse, crops
+
+
+def test_unchanged_frame_returns_the_full_parse():
+    parser, parse, crops = incremental_parser()
+    frame = screen(TEXTS, ICONS)
+    parser(frame)
+    captioned = parse.captioned
+    # a re-encoded copy differs by noise below the pixel threshold
+    noisy = np.clip(frame.astype(int) + np.random.default_rng(0).integers(-3, 4, frame.shape), 0, 255).astype(np.uint8)
+    for copy in (frame.copy(), noisy):
+        assert_same_parse(parser(copy), StubParse()(frame))
+        assert parser.last_mode == 'identical'
+    assert parse.captioned == captioned and not crops
+
+
+def test_small_change_reparses_only_the_dirty_region():
+    parser, parse, crops = incremental_parser()
+    parser(screen(TEXTS, ICONS))
+    captioned = parse.captioned
+    texts, icons = dict(TEXTS), dict(ICONS)
+    texts[(340, 160)] = 99
+    icons[(1220, 160)] = 77
+    frame = screen(texts, icons)
+
+    assert_same_parse(parser(frame), StubParse()(frame))
+    assert parser.last_mode == 'incremental'
+    # OCR on one small crop per change, one icon captioned again
+    assert len(crops) == 2 and all(h * w < frame.shape[0] * frame.shape[1] // 100 for h, w in crops)
+    assert parse.captioned == captioned + 1
+
+
+def test_large_change_falls_back_to_a_full_parse():
+    parser, parse, crops = incremental_parser()
+    parser(screen(TEXTS, ICONS))
+    # the page scrolled by half a row
+    frame = screen({(x, y + 30): level for (x, y), level in TEXTS.items()},
+                   {(x, y + 30): level for (x, y), level in ICONS.items()})
+
+    assert_same_parse(parser(frame), StubParse()(frame))
+    assert parser.last_mode == 'full'
+    assert not crops
@@ -0,0 +1,73 @@
+"""
+Checks that ParseService parses a step posted twice only once.
+
+The executor posts a step again when it lost the response, e.g. when the connection
+dropped; the X-Step header tells the server which step it is. The step handler is a
+stub that counts its calls and records the step in the session as StepRunner does.
+
+Run from the OmniParser directory:
+    python -m pytest tests
+"""
+import http.client
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.parse_service import ParseService
+from util.sessions import SessionManager
+
+
+def start_service():
+    calls = []
+
+    def run_step(session, image_bytes, plan_report):
+        calls.append(session.step)
+        result = {"ACTION": "click", "ELEMENT": f"Text Box ID {session.step}: {image_bytes.decode()}", "DETAILS": ""}
+        session.record(result)
+        return result
+
+    service = ParseService(run_step, SessionManager(), port=0)
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+    return service, calls
+
+
+def post(service, path, body, headers=None):
+    conn = http.client.HTTPConnection(*service.address)
+    conn.request('POST', path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    data = json.loads(response.read())
+    conn.close()
+    return response.status, data
+
+
+def open_session(service):
+    return post(service, '/sessions', json.dumps({"task": "t"}))[1]['session_id']
+
+
+def test_repeated_step_returns_the_first_result():
+    service, calls = start_service()
+    try:
+        steps = f'/sessions/{open_session(service)}/steps'
+        first = post(service, steps, b'a', {'X-Step': '0'})
+        assert post(service, steps, b'a again', {'X-Step': '0'}) == first
+        status, second = post(service, steps, b'b', {'X-Step': '1'})
+        assert status == 200 and second['ELEMENT'] == 'Text Box ID 1: b'
+        assert calls == [0, 1]
+    finally:
+        service.shutdown()
+
+
+def test_step_ahead_of_the_session_is_refused():
+    service, calls = start_service()
+    try:
+        steps = f'/sessions/{open_session(service)}/steps'
+        assert post(service, steps, b'a', {'X-Step': '2'})[0] == 409
+        assert post(service, steps, b'a', {'X-Step': 'x'})[0] == 400
+        # without X-Step every post is a new step, as before
+        assert post(service, steps, b'a')[0] == post(service, steps, b'a')[0] == 200
+        assert calls == [0, 1]
+    finally:
+        service.shutdown()
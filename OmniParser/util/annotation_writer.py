@@ -0,0 +1,51 @@
+import queue
+import threading
+
+from PIL import Image
+
+from util.instrumentation import metrics
+
+
+class AnnotationWriter:
+    """
+    Renders and saves annotated screenshots on a background thread.
+
+    The executor only needs the action, so drawing the boxes and PNG-encoding the
+    result is done after the action has been handed back. If rendering falls
+    behind by more than `max_pending` screenshots, new ones are dropped rather than
+    slowing down the parse loop.
+    """
+
+    def __init__(self, draw_bbox_config=None, max_pending=8):
+        self.draw_bbox_config = draw_bbox_config or {}
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='annotation-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, path, image_source, label_coordinates):
+        """Queues `image_source` (RGB ndarray) to be annotated with `label_coordinates` and saved to `path`."""
+        try:
+            self._queue.put_nowait((path, image_source, label_coordinates))
+        except queue.Full:
+            print(f"Annotation writer is behind, skipping {path}")
+
+    def close(self):
+        """Waits for the pending screenshots to be written."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        from utils import draw_som_labels
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            path, image_source, label_coordinates = job
+            try:
+                with metrics.stage('annotate'):
+                    annotated_frame = draw_som_labels(image_source, label_coordinates, **self.draw_bbox_config)
+                with metrics.stage('write'):
+                    Image.fromarray(annotated_frame).save(path)
+            except Exception as e:
+                print(f"Error writing {path}: {e}")
@@ -21,6 +21,13 @@ class BoxAnnotator:
             default is 1
         text_padding (int): The padding around the text on the bounding box,
             default is 5
+        avoid_overlap (bool): Moves a label to another corner of its box when it
+            would cover a detection or leave the image
+        resolve_labels (bool): With avoid_overlap, places all labels in one pass
+            that also keeps labels from covering each other, moving a label up to
+            four label sizes away from its box when its four corners are taken; a
+            label only covers another when all of those positions are taken too.
+            The placement of the default (False) does not depend on the other labels
 
     """
 
@@ -33,6 +40,7 @@ class BoxAnnotator:
         text_thickness: int = 2, #1, # 2 for demo
         text_padding: int = 10,
         avoid_overlap: bool = True,
+        resolve_labels: bool = False,
     ):
         self.color: Union[Color, ColorPalette] = color
         self.thickness: int = thickness
@@ -41,6 +49,7 @@ class BoxAnnotator:
         self.text_thickness: int = text_thickness
         self.text_padding: int = text_padding
         self.avoid_overlap: bool = avoid_overlap
+        self.resolve_labels: bool = resolve_labels
 
     def annotate(
         self,
@@ -85,8 +94,38 @@ class BoxAnnotator:
             ```
         """
         font = cv2.FONT_HERSHEY_SIMPLEX
+        boxes = detections.xyxy.astype(int)
+        texts, sizes = [], []
         for i in range(len(detections)):
-            x1, y1, x2, y2 = detections.xyxy[i].astype(int)
+            class_id = (
+                detections.class_id[i] if detections.class_id is not None else None
+            )
+            texts.append(
+                f"{class_id}"
+                if (labels is None or len(detections) != len(labels))
+                else labels[i]
+            )
+            if not skip_label:
+                sizes.append(cv2.getTextSize(
+                    text=texts[i],
+                    fontFace=font,
+                    fontScale=self.text_scale,
+                    thickness=self.text_thickness,
+                )[0])
+
+        positions = None
+        if not skip_label and self.avoid_overlap:
+            index = BoxIndex(boxes)
+            if self.resolve_labels:
+                positions = resolve_label_positions(self.text_padding, sizes, boxes, image_size, index)
+            else:
+                positions = [
+                    get_optimal_label_pos(self.text_padding, text_width, text_height, *boxes[i], detections, image_size, index)
+                    for i, (text_width, text_height) in enumerate(sizes)
+                ]
+
+        for i in range(len(detections)):
+            x1, y1, x2, y2 = boxes[i]
             class_id = (
                 detections.class_id[i] if detections.class_id is not None else None
             )
@@ -106,18 +145,8 @@ class BoxAnnotator:
             if skip_label:
                 continue
 
-            text = (
-                f"{class_id}"
-                if (labels is None or len(detections) != len(labels))
-                else labels[i]
-            )
-
-            text_width, text_height = cv2.getTextSize(
-                text=text,
-                fontFace=font,
-                fontScale=self.text_scale,
-                thickness=self.text_thickness,
-            )[0]
+            text = texts[i]
+            text_width, text_height = sizes[i]
 
             if not self.avoid_overlap:
                 text_x = x1 + self.text_padding
@@ -135,7 +164,7 @@ class BoxAnnotator:
                 # text_background_x2 = x1
                 # text_background_y2 = y1 + 2 * self.text_padding + text_height
             else:
-                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = get_optimal_label_pos(self.text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size)
+                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = positions[i]
 
             cv2.rectangle(
                 img=scene,
@@ -186,77 +215,151 @@ def IoU(box1, box2, return_max=True):
         return intersection / union
 
 
-def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size):
+class BoxIndex:
+    """
+    Uniform grid over integer xyxy boxes, so that the boxes a label may overlap are
+    found without testing every detection. Boxes without area are left out, they
+    cannot overlap anything.
+
+    Attributes:
+        cell_size (int): Side of a grid cell in pixels
+    """
+
+    def __init__(self, boxes: Optional[np.ndarray] = None, cell_size: int = 64):
+        self.cell_size = cell_size
+        self._boxes = np.zeros((0, 4), dtype=np.int64)
+        self._count = 0
+        self._cells = {}  # (column, row) -> list of box indices
+        if boxes is not None and len(boxes):
+            self.add_many(boxes)
+
+    @property
+    def boxes(self) -> np.ndarray:
+        return self._boxes[:self._count]
+
+    def add(self, box):
+        self.add_many(np.asarray([box]))
+
+    def add_many(self, boxes: np.ndarray):
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        if self._count + len(boxes) > len(self._boxes):
+            grown = np.zeros((max(2 * len(self._boxes), self._count + len(boxes)), 4), dtype=np.int64)
+            grown[:self._count] = self.boxes
+            self._boxes = grown
+        self._boxes[self._count:self._count + len(boxes)] = boxes
+        cells = boxes // self.cell_size
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        for i in np.flatnonzero(valid):
+            c1, r1, c2, r2 = cells[i].tolist()
+            for column in range(c1, c2 + 1):
+                for row in range(r1, r2 + 1):
+                    self._cells.setdefault((column, row), []).append(self._count + i)
+        self._count += len(boxes)
+
+    def candidates(self, box) -> np.ndarray:
+        """Indices of the boxes sharing a grid cell with `box`, a superset of those it intersects."""
+        c1, r1, c2, r2 = (int(v) // self.cell_size for v in box)
+        found = [self._cells[cell] for cell in
+                 ((column, row) for column in range(c1, c2 + 1) for row in range(r1, r2 + 1)) if cell in self._cells]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def overlaps(self, box, threshold: float = 0.3) -> bool:
+        """Whether IoU(box, other) > threshold for any indexed box."""
+        candidates = self.candidates(box)
+        return bool(len(candidates)) and bool((overlap_ratios(box, self._boxes[candidates]) > threshold).any())
+
+
+def overlap_ratios(box, boxes: np.ndarray) -> np.ndarray:
+    """ IoU(box, other, return_max=True) for every row of boxes, vectorized
+    """
+    box = np.asarray(box, dtype=np.int64)
+    width = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    height = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    intersection = width * height
+    area1 = box_area(box)
+    area2 = box_area(boxes.T)
+    union = area1 + area2 - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersection / union
+        ratios = np.where((area1 > 0) & (area2 > 0), np.maximum(intersection / area1, intersection / area2), 0)
+    return np.maximum(iou, ratios)
+
+
+def is_outside(box, image_size) -> bool:
+    return box[0] < 0 or box[2] > image_size[0] or box[1] < 0 or box[3] > image_size[1]
+
+
+def label_positions(text_padding, text_width, text_height, x1, y1, x2, y2):
+    """ candidate label positions for box (x1, y1, x2, y2), in order of preference: 'top left', 'outer left', 'outer right', 'top right'
+        each is (text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2)
+    """
+    return [
+        # top left
+        (x1 + text_padding, y1 - text_padding,
+         x1, y1 - 2 * text_padding - text_height, x1 + 2 * text_padding + text_width, y1),
+        # outer left
+        (x1 - text_padding - text_width, y1 + text_padding + text_height,
+         x1 - 2 * text_padding - text_width, y1, x1, y1 + 2 * text_padding + text_height),
+        # outer right
+        (x2 + text_padding, y1 + text_padding + text_height,
+         x2, y1, x2 + 2 * text_padding + text_width, y1 + 2 * text_padding + text_height),
+        # top right
+        (x2 - text_padding - text_width, y1 - text_padding,
+         x2 - 2 * text_padding - text_width, y1 - 2 * text_padding - text_height, x2, y1),
+    ]
+
+
+def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size, index=None):
     """ check overlap of text and background detection box, and get_optimal_label_pos, 
         pos: str, position of the text, must be one of 'top left', 'top right', 'outer left', 'outer right' TODO: if all are overlapping, return the last one, i.e. outer right
         Threshold: default to 0.3
+        index: BoxIndex over detections.xyxy.astype(int), pass it when placing several labels so it is built once
     """
-
-    def get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size):
-        is_overlap = False
-        for i in range(len(detections)):
-            detection = detections.xyxy[i].astype(int)
-            if IoU([text_background_x1, text_background_y1, text_background_x2, text_background_y2], detection) > 0.3:
-                is_overlap = True
-                break
-        # check if the text is out of the image
-        if text_background_x1 < 0 or text_background_x2 > image_size[0] or text_background_y1 < 0 or text_background_y2 > image_size[1]:
-            is_overlap = True
-        return is_overlap
-    
-    # if pos == 'top left':
-    text_x = x1 + text_padding
-    text_y = y1 - text_padding
-
-    text_background_x1 = x1
-    text_background_y1 = y1 - 2 * text_padding - text_height
-
-    text_background_x2 = x1 + 2 * text_padding + text_width
-    text_background_y2 = y1
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-    
-    # elif pos == 'outer left':
-    text_x = x1 - text_padding - text_width
-    text_y = y1 + text_padding + text_height
-
-    text_background_x1 = x1 - 2 * text_padding - text_width
-    text_background_y1 = y1
-
-    text_background_x2 = x1
-    text_background_y2 = y1 + 2 * text_padding + text_height
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-    
-
-    # elif pos == 'outer right':
-    text_x = x2 + text_padding
-    text_y = y1 + text_padding + text_height
-
-    text_background_x1 = x2
-    text_background_y1 = y1
-
-    text_background_x2 = x2 + 2 * text_padding + text_width
-    text_background_y2 = y1 + 2 * text_padding + text_height
-
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-
-    # elif pos == 'top right':
-    text_x = x2 - text_padding - text_width
-    text_y = y1 - text_padding
-
-    text_background_x1 = x2 - 2 * text_padding - text_width
-    text_background_y1 = y1 - 2 * text_padding - text_height
-
-    text_background_x2 = x2
-    text_background_y2 = y1
-
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-
-    return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
+    if index is None:
+        index = BoxIndex(detections.xyxy.astype(int))
+    positions = label_positions(text_padding, text_width, text_height, x1, y1, x2, y2)
+    for position in positions:
+        background = position[2:]
+        if not is_outside(background, image_size) and not index.overlaps(background):
+            return position
+    return positions[-1]
+
+
+def shifted_label_positions(positions, max_shift):
+    """ the candidate positions moved away from their box by 1 .. max_shift label heights (up, down) or widths (left, right), nearest first
+    """
+    for step in range(1, max_shift + 1):
+        for position in positions:
+            width, height = position[4] - position[2], position[5] - position[3]
+            for dx, dy in ((0, -height), (0, height), (-width, 0), (width, 0)):
+                dx, dy = dx * step, dy * step
+                yield (position[0] + dx, position[1] + dy,
+                       position[2] + dx, position[3] + dy, position[4] + dx, position[5] + dy)
+
+
+def resolve_label_positions(text_padding, sizes, boxes, image_size, index=None, max_shift=4):
+    """ label positions for all boxes in one pass; a label is kept off the detections as in get_optimal_label_pos and also off the labels placed before it
+        if every position is taken, the first one inside the image that covers no other label wins; failing that, the positions are
+        moved away from the box, up to max_shift label sizes, until one covers no other label; only if none does the last one is used
+        sizes: [(text_width, text_height)] per box, boxes: [n, 4] int xyxy
+    """
+    if index is None:
+        index = BoxIndex(boxes)
+    placed = BoxIndex(cell_size=index.cell_size)
+    result = []
+    for (text_width, text_height), (x1, y1, x2, y2) in zip(sizes, boxes):
+        positions = label_positions(text_padding, text_width, text_height, x1, y1, x2, y2)
+        inside = [position for position in positions if not is_outside(position[2:], image_size)]
+        free = [position for position in inside if not placed.overlaps(position[2:], 0)]
+        chosen = next((position for position in free if not index.overlaps(position[2:])), None)
+        if chosen is None and free:
+            chosen = free[0]
+        if chosen is None:
+            chosen = next((position for position in shifted_label_positions(positions, max_shift)
+                           if not is_outside(position[2:], image_size) and not placed.overlaps(position[2:], 0)),
+                          positions[-1])
+        placed.add(chosen[2:])
+        result.append(chosen)
+    return result
@@ -0,0 +1,148 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+def crop_hash(crop: np.ndarray) -> Tuple[str, int]:
+    """
+    Perceptual hash of an RGB icon crop.
+
+    Returns:
+        tuple: (bucket, bits); the bucket holds the mean colour (in steps of 32) and the
+            aspect ratio (in quarter octaves) and must match exactly, the bits are a
+            64-bit difference hash of the grey levels, compared by Hamming distance
+    """
+    h, w = crop.shape[:2]
+    if h == 0 or w == 0:
+        return 'empty', 0
+    grey = cv2.resize(cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY), (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    # a small margin keeps flat areas from hashing re-encoding noise
+    bits = int.from_bytes(np.packbits(grey[:, 1:] > grey[:, :-1] + 2).tobytes(), 'big')
+    color = ''.join(f'{int(c) // 32:x}' for c in crop.reshape(-1, crop.shape[2]).mean(axis=0)[:3])
+    aspect = int(round(np.log2(w / h) * 4))
+    return f'{color}{aspect:+d}', bits
+
+
+class CaptionCache:
+    """
+    Icon captions keyed by model, prompt and perceptual hash of the crop.
+
+    A crop matches a cached one with the same model, prompt, colour and aspect bucket
+    whose hash differs in at most `max_distance` bits, so the same icon found on another
+    screen, or re-encoded, is not captioned again. Lookups go to an in-memory LRU of
+    `max_entries` captions first, then, if `path` is set, to an SQLite file that
+    survives restarts and holds up to `max_disk_entries` captions (least recently used
+    ones are evicted). Safe to use from several threads.
+
+    Attributes:
+        hits (int): Lookups answered from memory
+        disk_hits (int): Lookups answered from the SQLite file
+        misses (int): Lookups that needed the caption model
+    """
+
+    def __init__(self, max_entries: int = 4096, path: Optional[str] = None, max_disk_entries: int = 100000,
+                 max_distance: int = 2):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_distance = max_distance
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # (prefix, bits) -> caption, least recently used first; prefix -> {bits} for the Hamming search
+        self._memory = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS captions '
+                             '(prefix TEXT, bits TEXT, caption TEXT, last_used REAL, PRIMARY KEY (prefix, bits))')
+            self._db.commit()
+
+    @staticmethod
+    def key(model_name: str, prompt: str, crop: np.ndarray) -> Tuple[str, int]:
+        bucket, bits = crop_hash(crop)
+        return f'{model_name}|{prompt}|{bucket}', bits
+
+    def get(self, key: Tuple[str, int]) -> Optional[str]:
+        prefix, bits = key
+        with self._lock:
+            cached = self._nearest(bits, self._buckets.get(prefix, ()))
+            if cached is not None:
+                self._memory.move_to_end((prefix, cached))
+                self.hits += 1
+                return self._memory[(prefix, cached)]
+            if self._db is not None:
+                rows = self._db.execute('SELECT bits, caption FROM captions WHERE prefix = ?', (prefix,)).fetchall()
+                captions = {int(row_bits, 16): caption for row_bits, caption in rows}
+                cached = self._nearest(bits, captions)
+                if cached is not None:
+                    self._db.execute('UPDATE captions SET last_used = ? WHERE prefix = ? AND bits = ?',
+                                     (time.time(), prefix, f'{cached:016x}'))
+                    self._db.commit()
+                    self._remember((prefix, cached), captions[cached])
+                    self.disk_hits += 1
+                    return captions[cached]
+            self.misses += 1
+            return None
+
+    def put_many(self, items):
+        """Stores (key, caption) pairs, with a single write to the SQLite file."""
+        items = list(items)
+        with self._lock:
+            for key, caption in items:
+                self._remember(key, caption)
+            if self._db is not None and items:
+                now = time.time()
+                self._db.executemany('INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?)',
+                                     [(prefix, f'{bits:016x}', caption, now) for (prefix, bits), caption in items])
+                self._db.execute('DELETE FROM captions WHERE rowid IN (SELECT rowid FROM captions '
+                                 'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_disk_entries,))
+                self._db.commit()
+
+    def put(self, key: Tuple[str, int], caption: str):
+        self.put_many([(key, caption)])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'entries': len(self._memory),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _nearest(self, bits, candidates):
+        if bits in candidates:
+            return bits
+        best, best_distance = None, self.max_distance + 1
+        for other in candidates:
+            distance = bin(bits ^ other).count('1')
+            if distance < best_distance:
+                best, best_distance = other, distance
+        return best
+
+    def _remember(self, key, caption):
+        prefix, bits = key
+        self._memory[key] = caption
+        self._memory.move_to_end(key)
+        self._buckets.setdefault(prefix, set()).add(bits)
+        while len(self._memory) > self.max_entries:
+            (old_prefix, old_bits), _ = self._memory.popitem(last=False)
+            bucket = self._buckets[old_prefix]
+            bucket.discard(old_bits)
+            if not bucket:
+                del self._buckets[old_prefix]
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from typing import Optional
+
+import torch
+
+# 'fp32' is the unmodified model
+CPU_PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+def bf16_supported() -> bool:
+    """Whether this CPU has native bfloat16 arithmetic (AVX512-BF16 or AMX); bf16 is slow without it."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def quantize(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    """
+    Prepares a float32 caption model for CPU inference.
+
+    'int8' replaces every nn.Linear, in the vision tower and in the language model,
+    by a dynamically quantized one (int8 weights, activations quantized on the fly);
+    convolutions, embeddings and norms stay in float32. 'bf16' casts the whole model.
+    """
+    if precision == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if precision == 'bf16':
+        return model.to(torch.bfloat16)
+    return model
+
+
+def cpu_precision(precision: str) -> str:
+    """
+    The precision to run the CPU caption model at when asked for `precision`: bf16
+    falls back to fp32 on CPUs without native bfloat16, where it would only be slower.
+    """
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"unknown caption precision {precision!r}, expected one of {', '.join(CPU_PRECISIONS)}")
+    if precision == 'bf16' and not bf16_supported():
+        print("This CPU has no native bfloat16 support, keeping the caption model in fp32")
+        return 'fp32'
+    return precision
+
+
+def load_cpu_caption_model(model_name_or_path: str, precision: str, cache_dir: Optional[str] = None):
+    """
+    Loads Florence-2 from `model_name_or_path` for the CPU at `precision` (see quantize).
+
+    The converted weights are saved as a state_dict to `cache_dir` (by default a
+    cpu_cache directory next to the weights, or ~/.cache/cat for a hub id) and, on the
+    next start, loaded with torch.load(weights_only=True) into an uninitialised model
+    converted the same way, unless the weights, torch or transformers changed since.
+    Only tensors are read from the cache, never code.
+    """
+    import transformers
+    from transformers import AutoConfig, AutoModelForCausalLM
+    from transformers.modeling_utils import no_init_weights
+
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"unknown caption precision {precision!r}, expected one of {', '.join(CPU_PRECISIONS)}")
+    if precision == 'fp32':
+        return AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
+
+    fingerprint = {
+        'precision': precision,
+        # plain strings: weights_only loads refuse torch's TorchVersion
+        'torch': str(torch.__version__),
+        'transformers': str(transformers.__version__),
+        'weights': _weights_signature(model_name_or_path),
+    }
+    if cache_dir is None:
+        if os.path.isdir(model_name_or_path):
+            cache_dir = os.path.join(model_name_or_path, 'cpu_cache')
+        else:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cat', model_name_or_path.replace('/', '--'))
+    cache_path = os.path.join(cache_dir, f'{precision}.pt')
+
+    if os.path.exists(cache_path):
+        try:
+            cached = torch.load(cache_path, map_location='cpu', weights_only=True)
+            if cached.get('fingerprint') == fingerprint:
+                # the same conversion of a model without weights, then the cached weights
+                config = AutoConfig.from_pretrained(model_name_or_path, trust_remote_code=True)
+                with no_init_weights():
+                    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32, trust_remote_code=True)
+                model = quantize(model.eval(), precision)
+                model.load_state_dict(cached['state_dict'])
+                print(f"Loaded {precision} caption model weights from {cache_path}")
+                return model
+        except Exception as e:
+            print(f"Ignoring caption model cache {cache_path}: {e}")
+
+    model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
+    model = quantize(model.eval(), precision)
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = cache_path + '.partial'
+    torch.save({'fingerprint': fingerprint, 'state_dict': model.state_dict()}, partial)
+    os.replace(partial, cache_path)
+    print(f"Saved {precision} caption model weights to {cache_path}")
+    return model
+
+
+def _weights_signature(model_name_or_path):
+    """Names, sizes and modification times of the weight files, or the hub id."""
+    if not os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(model_name_or_path)):
+        path = os.path.join(model_name_or_path, name)
+        if os.path.isfile(path) and name.endswith(('.safetensors', '.bin', '.json', '.py')):
+            stat = os.stat(path)
+            digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
@@ -0,0 +1,152 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Hashable
+
+import torch
+
+
+def shape_bucket(image) -> tuple:
+    """Groups PIL crops by aspect ratio (in half octaves) and size (in octaves of the longer side)."""
+    w, h = image.size
+    w, h = max(w, 1), max(h, 1)
+    return round(2 * math.log2(w / h)), round(math.log2(max(w, h)))
+
+
+def resized_bucket(image) -> tuple:
+    """One bucket for every crop, for processors that resize all crops to one input size (Florence-2, BLIP-2)."""
+    return ()
+
+
+class BatchTiming:
+    """How long one `generate` batch took."""
+
+    def __init__(self, key, bucket, size, seconds):
+        self.key = key
+        self.bucket = bucket
+        self.size = size
+        self.seconds = seconds
+
+    def __repr__(self):
+        return f"BatchTiming(bucket={self.bucket}, size={self.size}, seconds={self.seconds:.3f})"
+
+
+class CaptionScheduler:
+    """
+    Batches icon crops for the caption model.
+
+    Crops are grouped by `key` (the model, prompt and decoding settings, which must
+    match within a batch) and by bucket, the shape the model's processor turns them
+    into: a batch never spans two buckets. Florence-2 and BLIP-2 resize every crop to
+    one size, so all their crops share a bucket (resized_bucket); processors that keep
+    the aspect ratio, such as Phi-3-vision's, group them by shape_bucket so that tiny
+    and wide crops are not padded together. The server parses one frame at a time (SessionManager runs every parse on
+    one thread), so batches are made from the crops of one call to `run`.
+
+    The batch size is chosen per key: it starts at `initial_batch_size` and doubles
+    while the measured throughput (crops per second) keeps improving, up to
+    `max_batch_size` and, on CUDA, to what the free memory allows given the peak
+    memory measured per crop. A CUDA out-of-memory error halves the batch size and
+    retries.
+
+    Attributes:
+        timings (deque): The latest BatchTiming records, newest last
+    """
+
+    def __init__(self, initial_batch_size: int = 8, max_batch_size: int = 64, memory_fraction: float = 0.8,
+                 bucket: Callable = shape_bucket, max_timings: int = 1000):
+        self.initial_batch_size = initial_batch_size
+        self.max_batch_size = max_batch_size
+        self.memory_fraction = memory_fraction
+        self.bucket = bucket
+        self.timings = deque(maxlen=max_timings)
+        self._batch_size = {}  # key -> current batch size
+        self._throughput = {}  # key -> {batch size: crops per second}
+        self._memory_per_item = {}  # key -> peak CUDA bytes per crop
+        self._lock = threading.Lock()
+
+    def run(self, items: list, run_batch: Callable, key: Hashable, device=None, bucket: Callable = None) -> list:
+        """
+        Captions `items` (PIL images) and returns the captions in the same order.
+
+        Args:
+            items (list): The crops to caption
+            run_batch (Callable): run_batch(list of items) -> list of captions, for one batch
+            key (Hashable): Items may only share a batch if their keys are equal
+            device (torch.device): The model's device, used to size batches by free memory
+            bucket (Callable): bucket(item) -> the shape group of the item, `self.bucket` by default
+        """
+        bucket = bucket or self.bucket
+        captions = [None] * len(items)
+        buckets = {}
+        for index, item in enumerate(items):
+            buckets.setdefault(bucket(item), []).append(index)
+        with self._lock:
+            for bucket in sorted(buckets):
+                indices = buckets[bucket]
+                while indices:
+                    size = self._limit(key, device)
+                    batch, indices = indices[:size], indices[size:]
+                    for index, caption in zip(batch, self._execute(key, bucket, [items[i] for i in batch],
+                                                                   run_batch, device)):
+                        captions[index] = caption
+        return captions
+
+    def pop_timings(self) -> list:
+        """Returns and forgets the BatchTiming records collected so far."""
+        with self._lock:
+            timings = list(self.timings)
+            self.timings.clear()
+        return timings
+
+    def batch_size(self, key: Hashable) -> int:
+        return self._batch_size.get(key, self.initial_batch_size)
+
+    def _execute(self, key, bucket, items, run_batch, device):
+        cuda = device is not None and torch.device(device).type == 'cuda'
+        try:
+            if cuda:
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device)
+            start = time.perf_counter()
+            captions = run_batch(items)
+            seconds = time.perf_counter() - start
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+            if len(items) == 1:
+                raise
+            # retry in two halves and remember the smaller size for this key
+            self._batch_size[key] = max(1, len(items) // 2)
+            self.max_batch_size = min(self.max_batch_size, len(items) - 1)
+            half = len(items) // 2
+            return (self._execute(key, bucket, items[:half], run_batch, device)
+                    + self._execute(key, bucket, items[half:], run_batch, device))
+
+        self.timings.append(BatchTiming(key, bucket, len(items), seconds))
+        if cuda:
+            peak = (torch.cuda.max_memory_allocated(device) - base) / len(items)
+            self._memory_per_item[key] = max(self._memory_per_item.get(key, 0), peak)
+        self._adapt(key, len(items), len(items) / max(seconds, 1e-9))
+        return list(captions)
+
+    def _adapt(self, key, size, throughput):
+        current = self.batch_size(key)
+        if size < current:
+            # a partial batch says nothing about the current size
+            return
+        measured = self._throughput.setdefault(key, {})
+        measured[size] = throughput if size not in measured else 0.5 * (measured[size] + throughput)
+        smaller = measured.get(size // 2)
+        if smaller is not None and measured[size] < smaller:
+            self._batch_size[key] = size // 2
+        elif size * 2 not in measured or measured[size * 2] > measured[size]:
+            self._batch_size[key] = min(size * 2, self.max_batch_size)
+
+    def _limit(self, key, device):
+        size = min(self.batch_size(key), self.max_batch_size)
+        per_item = self._memory_per_item.get(key)
+        if per_item and device is not None and torch.device(device).type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(device)
+            size = min(size, max(1, int(free * self.memory_fraction / per_item)))
+        return size
@@ -0,0 +1,88 @@
+import json
+import mmap
+import os
+import struct
+import warnings
+
+import torch
+
+# safetensors dtype names -> torch dtypes
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def load_safetensors(path: str) -> dict:
+    """
+    Maps the safetensors file at `path` read-only into memory and returns its tensors as
+    views of the mapping, without copying or unpickling anything.
+
+    The mapping is shared: processes loading the same file use the same page cache pages,
+    which are read from disk only when first touched. The tensors must not be written to
+    (the pages are read-only, a write crashes the process); the file stays mapped as long
+    as any of them is alive.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_size, = struct.unpack('<Q', buffer[:8])
+    header = json.loads(buffer[8:8 + header_size])
+    header.pop('__metadata__', None)
+    tensors = {}
+    with warnings.catch_warnings():
+        # torch warns that the buffer is read-only, which is the point
+        warnings.simplefilter('ignore', UserWarning)
+        for name, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info['dtype']]
+            start, end = info['data_offsets']
+            if start == end:
+                tensors[name] = torch.empty(info['shape'], dtype=dtype)
+                continue
+            count = (end - start) // dtype.itemsize
+            tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=count,
+                                             offset=8 + header_size + start).reshape(info['shape'])
+    return tensors
+
+
+def load_detector(path: str, share: bool = False):
+    """
+    Builds the ultralytics icon detector from `path` (weights/icon_detect/model.safetensors)
+    and the model.yaml next to it, as weights/convert_safetensor_to_pt.py does, but
+    without the pickled best.pt.
+
+    By default the weights are copied into the process and fused, like best.pt. With
+    `share`, for several server processes on one host, the model's parameters are the
+    memory-mapped tensors of load_safetensors, so the processes share a single copy of
+    the weights. To keep it that way, ultralytics does not fuse the batch norms into the
+    convolutions while the model is on the CPU (fusing allocates new weights in every
+    process), which makes CPU detection slower; on a GPU it fuses as usual.
+
+    Returns:
+        ultralytics.YOLO: The detector
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(os.path.join(os.path.dirname(path), 'model.yaml'), task='detect')
+    # ultralytics runs the detector in float32; float32 weights stay views of the file
+    tensors = {name: tensor.float() if tensor.is_floating_point() else tensor
+               for name, tensor in load_safetensors(path).items()}
+    if not share:
+        tensors = {name: tensor.clone() for name, tensor in tensors.items()}
+    # assign: the module keeps the given tensors instead of copying them into its own
+    model.model.load_state_dict(tensors, assign=True)
+    model.model.eval()
+    if share:
+        _keep_unfused_on_cpu(model.model)
+    return model
+
+
+def _keep_unfused_on_cpu(detection_model):
+    fuse = type(detection_model).fuse
+
+    def fuse_off_cpu(verbose=True):
+        if next(detection_model.parameters()).device.type == 'cpu':
+            return detection_model
+        return fuse(detection_model, verbose=verbose)
+
+    detection_model.fuse = fuse_off_cpu
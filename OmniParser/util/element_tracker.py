@@ -0,0 +1,203 @@
+import numpy as np
+
+
+class Element:
+    """One parsed screen element: 'Text Box' or 'Icon Box', its text or caption, and its [x, y, w, h] box in pixels."""
+
+    def __init__(self, kind, text, box):
+        self.kind = kind
+        self.text = text
+        self.box = np.asarray(box, dtype=np.float64)
+
+    def label(self, element_id):
+        return f"{self.kind} ID {element_id}: {self.text}"
+
+
+class ScreenUpdate:
+    """
+    The result of ElementTracker.update for one screenshot.
+
+    Attributes:
+        screen_elements (list): 'Text Box ID i: text' lines, with stable IDs
+        label_coordinates (dict): Stable ID (str) -> [x, y, w, h], like get_som_labeled_img
+        added (list): IDs that appeared since the previous screenshot
+        removed (list): IDs that disappeared since the previous screenshot
+        changed (list): IDs whose text or position changed since the previous screenshot
+    """
+
+    def __init__(self, screen_elements, label_coordinates, added, removed, changed):
+        self.screen_elements = screen_elements
+        self.label_coordinates = label_coordinates
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def outcome(self):
+        """A one-line description of how the screen changed, for the step history."""
+        if not (self.added or self.removed or self.changed):
+            return 'screen did not change'
+        return f'screen changed ({len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed)'
+
+
+class ScreenPrompt:
+    """
+    The screen as sent to the analyzer: the full element list of a recent baseline
+    screenshot, which stays identical between steps so it can be cached, and the
+    changes from that baseline to the current screenshot.
+    """
+
+    def __init__(self, step, baseline_step, baseline_elements, added, removed, changed):
+        self.step = step
+        self.baseline_step = baseline_step
+        self.baseline_elements = baseline_elements
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def baseline_text(self):
+        return "\n".join(self.baseline_elements)
+
+    def changes_text(self):
+        if self.step == self.baseline_step:
+            return "The list above is the current screen."
+        if not (self.added or self.removed or self.changed):
+            return f"The screen has not changed since step {self.baseline_step}."
+        lines = [f"Changes since step {self.baseline_step}:"]
+        if self.added:
+            lines.append("Added:")
+            lines.extend(self.added)
+        if self.removed:
+            lines.append("Removed (no longer on screen):")
+            lines.extend(self.removed)
+        if self.changed:
+            lines.append("Changed (new text or position):")
+            lines.extend(self.changed)
+        return "\n".join(lines)
+
+
+class ElementTracker:
+    """
+    Matches the elements of consecutive screenshots so that their IDs stay stable.
+
+    An element is matched to an element of the same kind on the previous screenshot
+    if it has the same text and overlaps it, if it has the same text and that text is
+    unique on both screenshots (the element moved, e.g. after scrolling), or if it
+    sits at nearly the same place with a different text. Unmatched elements get a new
+    ID; IDs are never reused.
+
+    The tracker also keeps the baseline for ScreenPrompt: it is reset to the current
+    screenshot when more than `max_change_ratio` of the baseline elements were added,
+    removed or changed, in which case the prompt carries the full list again.
+
+    Attributes:
+        match_iou (float): Minimum IoU for two elements with the same text to match
+        position_iou (float): Minimum IoU for two elements with different texts to match
+        max_change_ratio (float): Fraction of changed elements that triggers a new baseline
+    """
+
+    def __init__(self, match_iou=0.3, position_iou=0.7, max_change_ratio=0.3):
+        self.match_iou = match_iou
+        self.position_iou = position_iou
+        self.max_change_ratio = max_change_ratio
+        self.elements = {}
+        self.next_id = 0
+        self.baseline = None
+        self.baseline_step = None
+
+    def reset(self):
+        self.elements = {}
+        self.baseline = None
+        self.baseline_step = None
+
+    def update(self, screen_elements, label_coordinates) -> ScreenUpdate:
+        """
+        Assigns stable IDs to the elements parsed from a new screenshot.
+
+        Args:
+            screen_elements (list): 'Text Box ID i: text' / 'Icon Box ID i: caption' lines from get_som_labeled_img
+            label_coordinates (dict): ID (str) -> [x, y, w, h] from get_som_labeled_img
+        """
+        current = []
+        for line in screen_elements:
+            head, text = line.split(': ', 1)
+            kind, local_id = head.rsplit(' ID ', 1)
+            current.append(Element(kind, text, label_coordinates[local_id]))
+
+        previous_ids = list(self.elements)
+        matches = _match(current, [self.elements[i] for i in previous_ids], self.match_iou, self.position_iou)
+
+        elements, added, changed = {}, [], []
+        for index, element in enumerate(current):
+            if index in matches:
+                element_id = previous_ids[matches[index]]
+                if _differs(self.elements[element_id], element, self.position_iou):
+                    changed.append(element_id)
+            else:
+                element_id = self.next_id
+                self.next_id += 1
+                added.append(element_id)
+            elements[element_id] = element
+        removed = [i for i in previous_ids if i not in elements]
+        self.elements = elements
+
+        return ScreenUpdate(
+            [element.label(i) for i, element in elements.items()],
+            {str(i): element.box for i, element in elements.items()},
+            added, removed, changed)
+
+    def prompt(self, step) -> ScreenPrompt:
+        """The baseline list and the changes since it, for the elements of the latest update."""
+        if self.baseline is not None:
+            added = [i for i in self.elements if i not in self.baseline]
+            removed = [i for i in self.baseline if i not in self.elements]
+            changed = [i for i in self.elements if i in self.baseline and _differs(self.baseline[i], self.elements[i], self.position_iou)]
+            if len(added) + len(removed) + len(changed) > self.max_change_ratio * max(len(self.baseline), 1):
+                self.baseline = None
+
+        if self.baseline is None:
+            self.baseline = dict(self.elements)
+            self.baseline_step = step
+            added, removed, changed = [], [], []
+
+        return ScreenPrompt(
+            step,
+            self.baseline_step,
+            [element.label(i) for i, element in self.baseline.items()],
+            [self.elements[i].label(i) for i in added],
+            [self.baseline[i].label(i) for i in removed],
+            [self.elements[i].label(i) for i in changed])
+
+
+def _differs(old, new, position_iou):
+    return old.text != new.text or _iou(old.box[None], new.box[None])[0, 0] < position_iou
+
+
+def _iou(a, b):
+    """Pairwise IoU between two [n, 4] and [m, 4] arrays of xywh boxes."""
+    a_x2, a_y2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    b_x2, b_y2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    w = np.clip(np.minimum(a_x2[:, None], b_x2[None]) - np.maximum(a[:, 0][:, None], b[:, 0][None]), 0, None)
+    h = np.clip(np.minimum(a_y2[:, None], b_y2[None]) - np.maximum(a[:, 1][:, None], b[:, 1][None]), 0, None)
+    intersection = w * h
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+
+def _match(current, previous, match_iou, position_iou):
+    """Greedy matching of current to previous elements; returns {current index: previous index}."""
+    if not current or not previous:
+        return {}
+    iou = _iou(np.stack([e.box for e in current]), np.stack([e.box for e in previous]))
+    same_kind = np.array([[c.kind == p.kind for p in previous] for c in current])
+    same_text = np.array([[c.text == p.text for p in previous] for c in current]) & same_kind
+    # texts that occur exactly once on each screenshot can be matched wherever they moved
+    unique_text = same_text & (same_text.sum(axis=0, keepdims=True) == 1) & (same_text.sum(axis=1, keepdims=True) == 1)
+
+    matches, used = {}, set()
+    for candidates in (same_text & (iou >= match_iou), unique_text, same_kind & (iou >= position_iou)):
+        pairs = np.argwhere(candidates)
+        for c, p in pairs[np.argsort(-iou[candidates], kind='stable')]:
+            if c not in matches and p not in used:
+                matches[int(c)] = int(p)
+                used.add(p)
+    return matches
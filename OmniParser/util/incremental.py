@@ -0,0 +1,216 @@
+import hashlib
+from typing import Callable
+
+import cv2
+import numpy as np
+
+
+def frame_digest(frame: np.ndarray) -> bytes:
+    """A hash of the decoded pixels (and shape), equal for byte-identical frames."""
+    digest = hashlib.blake2b(str(frame.shape).encode(), digest_size=16)
+    digest.update(np.ascontiguousarray(frame).data)
+    return digest.digest()
+
+
+def dirty_regions(previous: np.ndarray, frame: np.ndarray, pixel_threshold: int = 8, margin: int = 4) -> list:
+    """
+    Finds the rectangles where two frames of the same size differ.
+
+    Differences of at most `pixel_threshold` grey levels in every channel are ignored,
+    so re-encoding noise does not count as a change. Changed pixels closer than
+    `margin` are grouped, and overlapping rectangles are merged.
+
+    Returns:
+        list: [x1, y1, x2, y2] pixel rectangles, empty if the frames are perceptually identical
+    """
+    mask = (cv2.absdiff(previous, frame).max(axis=2) > pixel_threshold).astype(np.uint8)
+    if not mask.any():
+        return []
+    if margin > 0:
+        mask = cv2.dilate(mask, np.ones((2 * margin + 1, 2 * margin + 1), np.uint8))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    # row 0 is the background
+    regions = [[x, y, x + w, y + h] for x, y, w, h, _ in stats[1:count].tolist()]
+    return merge_regions(regions)
+
+
+def merge_regions(regions: list) -> list:
+    """Merges overlapping [x1, y1, x2, y2] rectangles until none overlap."""
+    regions = [list(r) for r in regions]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(len(regions) - 1, i, -1):
+                if _intersects(regions[i], regions[j]):
+                    regions[i] = _union(regions[i], regions.pop(j))
+                    merged = True
+    return regions
+
+
+def grow_regions(regions: list, boxes: list) -> list:
+    """Grows `regions` until every box in `boxes` that touches one lies entirely inside it."""
+    regions = [list(r) for r in regions]
+    grown = True
+    while grown:
+        grown = False
+        for box in boxes:
+            for i, region in enumerate(regions):
+                if _intersects(region, box) and not _contains(region, box):
+                    regions[i] = _union(region, box)
+                    grown = True
+        regions = merge_regions(regions)
+    return regions
+
+
+class ParseState:
+    """What IncrementalParser keeps of the previous frame to reuse on the next one."""
+
+    def __init__(self, frame, digest, ocr_text, ocr_bbox, icon_boxes, icon_captions, label_coordinates, parsed_content_list):
+        self.frame = frame
+        self.digest = digest
+        self.ocr_text = ocr_text
+        self.ocr_bbox = ocr_bbox
+        self.icon_boxes = icon_boxes
+        self.icon_captions = icon_captions
+        self.label_coordinates = label_coordinates
+        self.parsed_content_list = parsed_content_list
+
+
+class IncrementalParser:
+    """
+    Parses a session's screenshots, reusing what did not change since the previous one.
+
+    A frame that is byte- or perceptually identical to the previous one gets the
+    previous parse back without running any model. Otherwise the frame is diffed
+    against the previous one: OCR runs only on the changed rectangles (grown to cover
+    the text boxes they touch), and text boxes elsewhere are carried forward. Icon
+    detection still runs on the whole frame, since it is cheap and its overlap removal
+    needs every box, but icons away from the changed rectangles keep their previous
+    caption. When more than `max_dirty_ratio` of the frame changed, when it changed in
+    more than `max_regions` places (e.g. after scrolling), or when its size changed, a
+    full parse is run instead.
+
+    Attributes:
+        ocr (Callable): ocr(crop) -> (texts, xyxy pixel boxes), run on the changed rectangles
+        parse (Callable): parse(frame, ocr_result, known_captions) -> (label_coordinates,
+            parsed_content_list); with ocr_result None it runs its own OCR, and
+            known_captions, if given, maps the icon boxes to a caption or None each
+        last_mode (str): How the latest frame was parsed: 'full', 'incremental' or 'identical'
+    """
+
+    def __init__(self, ocr: Callable, parse: Callable, pixel_threshold: int = 8, max_dirty_ratio: float = 0.5,
+                 max_regions: int = 16, caption_iou: float = 0.9):
+        self.ocr = ocr
+        self.parse = parse
+        self.pixel_threshold = pixel_threshold
+        self.max_dirty_ratio = max_dirty_ratio
+        self.max_regions = max_regions
+        self.caption_iou = caption_iou
+        self.state = None
+        self.last_mode = None
+
+    def reset(self):
+        self.state = None
+
+    def __call__(self, frame: np.ndarray):
+        """Parses an RGB frame; returns (label_coordinates, parsed_content_list) like process_image."""
+        digest = frame_digest(frame)
+        previous = self.state
+        if previous is None or previous.frame.shape != frame.shape:
+            return self._full(frame, digest)
+        if previous.digest == digest:
+            return self._identical(previous)
+
+        regions = dirty_regions(previous.frame, frame, self.pixel_threshold)
+        if not regions:
+            return self._identical(previous)
+        regions = grow_regions(regions, previous.ocr_bbox)
+        h, w = frame.shape[:2]
+        dirty_area = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions)
+        if dirty_area > self.max_dirty_ratio * w * h or len(regions) > self.max_regions:
+            return self._full(frame, digest)
+
+        # carry forward the text boxes away from the changes, re-read the changed rectangles
+        texts, boxes = [], []
+        for text, box in zip(previous.ocr_text, previous.ocr_bbox):
+            if not any(_intersects(region, box) for region in regions):
+                texts.append(text)
+                boxes.append(box)
+        for x1, y1, x2, y2 in regions:
+            crop_texts, crop_boxes = self.ocr(np.ascontiguousarray(frame[y1:y2, x1:x2]))
+            for text, (bx1, by1, bx2, by2) in zip(crop_texts, crop_boxes):
+                box = [bx1 + x1, by1 + y1, bx2 + x1, by2 + y1]
+                # a neighbour cut by the crop edge is still carried forward whole
+                if x1 <= (box[0] + box[2]) / 2 < x2 and y1 <= (box[1] + box[3]) / 2 < y2:
+                    texts.append(text)
+                    boxes.append(box)
+        # reading order, as OCR returns them
+        order = sorted(range(len(boxes)), key=lambda i: (boxes[i][1], boxes[i][0]))
+        texts, boxes = [texts[i] for i in order], [boxes[i] for i in order]
+
+        def known_captions(icon_boxes):
+            return [self._known_caption(box, regions, w, h) for box in icon_boxes.tolist()]
+
+        label_coordinates, parsed_content_list = self.parse(frame, (texts, boxes), known_captions)
+        self.state = self._state(frame, digest, label_coordinates, parsed_content_list)
+        self.last_mode = 'incremental'
+        return label_coordinates, parsed_content_list
+
+    def _full(self, frame, digest):
+        label_coordinates, parsed_content_list = self.parse(frame, None, None)
+        self.state = self._state(frame, digest, label_coordinates, parsed_content_list)
+        self.last_mode = 'full'
+        return label_coordinates, parsed_content_list
+
+    def _identical(self, previous):
+        self.last_mode = 'identical'
+        return dict(previous.label_coordinates), list(previous.parsed_content_list)
+
+    def _known_caption(self, box, regions, w, h):
+        # icon boxes come normalized, like in get_som_labeled_img
+        box = [box[0] * w, box[1] * h, box[2] * w, box[3] * h]
+        if any(_intersects(region, box) for region in regions) or not self.state.icon_boxes:
+            return None
+        iou = _iou(np.array([box]), np.array(self.state.icon_boxes))[0]
+        best = int(iou.argmax())
+        return self.state.icon_captions[best] if iou[best] >= self.caption_iou else None
+
+    @staticmethod
+    def _state(frame, digest, label_coordinates, parsed_content_list):
+        # the parse lists the text boxes first, then the icons, with [x, y, w, h] pixel coordinates
+        ocr_text, ocr_bbox, icon_boxes, icon_captions = [], [], [], []
+        for line in parsed_content_list:
+            head, text = line.split(': ', 1)
+            kind, element_id = head.rsplit(' ID ', 1)
+            x, y, bw, bh = (float(v) for v in label_coordinates[element_id])
+            if kind == 'Text Box':
+                ocr_text.append(text)
+                ocr_bbox.append([x, y, x + bw, y + bh])
+            else:
+                icon_boxes.append([x, y, x + bw, y + bh])
+                icon_captions.append(text)
+        return ParseState(frame, digest, ocr_text, ocr_bbox, icon_boxes, icon_captions,
+                          label_coordinates, parsed_content_list)
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[2] <= a[2] and b[3] <= a[3]
+
+
+def _union(a, b):
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+
+def _iou(a, b):
+    """Pairwise IoU between two [n, 4] and [m, 4] arrays of xyxy boxes."""
+    w = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    h = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    intersection = w * h
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return intersection / np.maximum(area_a[:, None] + area_b[None] - intersection, 1e-6)
@@ -0,0 +1,203 @@
+import bisect
+import contextvars
+import json
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL = nullcontext()
+_current_step = contextvars.ContextVar('current_step', default=None)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus sense."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}'
+        braces = f'{{{labels}}}' if labels else ''
+        yield f'{name}_sum{braces} {self.sum:.6f}'
+        yield f'{name}_count{braces} {self.count}'
+
+
+class StepRecord:
+    """The stage times and counters of one step, written as one JSON line when the step ends."""
+
+    def __init__(self, step_id, labels):
+        self.step_id = step_id
+        self.labels = labels
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def to_json(self, seconds):
+        return {'step_id': self.step_id, **self.labels, 'start': self.start, 'seconds': round(seconds, 6),
+                'stages': {name: round(value, 6) for name, value in self.stages.items()}, 'counters': self.counters}
+
+
+class _Stage:
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Step:
+
+    def __init__(self, instrumentation, record):
+        self.instrumentation = instrumentation
+        self.record = record
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.token = _current_step.set(self.record)
+        return self.record
+
+    def __exit__(self, *exc):
+        _current_step.reset(self.token)
+        self.instrumentation._end_step(self.record, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation:
+    """
+    Stage timers and counters for the parse-and-plan loop.
+
+    Code is instrumented with `with metrics.stage('ocr'): ...` and
+    `metrics.count('crops', n)`. While disabled (the default) `stage` returns a shared
+    no-op context manager and `count` returns at once, so the hooks cost a method call.
+    Once enabled, every stage and counter is added to process-wide totals, exported in
+    the Prometheus text format by `prometheus()`, and to the step open in the current
+    context (see `step`), which is appended to `log_path` as one JSON line when it ends.
+    Stages that run on other threads, such as caption batches, count towards the totals
+    only unless the step's context is carried over (contextvars.copy_context).
+
+    Attributes:
+        enabled (bool): Whether the hooks record anything
+        log_path (str): The JSON-lines file steps are appended to, if any
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.log_path = None
+        self._log = None
+        self._lock = threading.Lock()
+        self._stages = {}  # stage -> Histogram
+        self._counters = {}  # counter -> total
+        self._steps = Histogram()
+
+    def enable(self, log_path: Optional[str] = None):
+        with self._lock:
+            self.enabled = True
+            if log_path and log_path != self.log_path:
+                if self._log is not None:
+                    self._log.close()
+                self._log = open(log_path, 'a', buffering=1)
+                self.log_path = log_path
+
+    def stage(self, name: str):
+        """Context manager timing one stage."""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def observe(self, name: str, seconds: float):
+        """Records `seconds` spent in stage `name`."""
+        if not self.enabled:
+            return
+        record = _current_step.get()
+        with self._lock:
+            self._stages.setdefault(name, Histogram()).observe(seconds)
+            if record is not None:
+                record.stages[name] = record.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, value=1):
+        if not self.enabled:
+            return
+        record = _current_step.get()
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            if record is not None:
+                record.counters[name] = record.counters.get(name, 0) + value
+
+    def step(self, step_id: str, **labels):
+        """Context manager for one step; stages and counters recorded in its context are attributed to it."""
+        if not self.enabled:
+            return _NULL
+        return _Step(self, StepRecord(step_id, labels))
+
+    def prometheus(self) -> str:
+        with self._lock:
+            lines = ['# HELP cat_step_seconds Wall time of a whole step', '# TYPE cat_step_seconds histogram']
+            lines.extend(self._steps.lines('cat_step_seconds'))
+            lines += ['# HELP cat_stage_seconds Wall time spent in each stage', '# TYPE cat_stage_seconds histogram']
+            for name, histogram in sorted(self._stages.items()):
+                lines.extend(histogram.lines('cat_stage_seconds', f'stage="{name}"'))
+            for name, total in sorted(self._counters.items()):
+                lines += [f'# TYPE cat_{name}_total counter', f'cat_{name}_total {total}']
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _end_step(self, record, seconds):
+        with self._lock:
+            self._steps.observe(seconds)
+            if self._log is not None:
+                self._log.write(json.dumps(record.to_json(seconds)) + '\n')
+
+
+def serve_metrics(instrumentation: Instrumentation, host: str = '127.0.0.1', port: int = 9100) -> ThreadingHTTPServer:
+    """Serves GET /metrics on a daemon thread, for the front ends that have no HTTP server of their own."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            data = instrumentation.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    return httpd
+
+
+# the process-wide instance the hooks report to
+metrics = Instrumentation()
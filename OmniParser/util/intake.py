@@ -0,0 +1,167 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+# inotify event masks, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class ScreenshotIntake:
+    """
+    Watches a directory and reports files as soon as their writer has closed them.
+
+    On Linux the directory is watched with inotify and a file counts as complete on
+    IN_CLOSE_WRITE (scp, cp) or IN_MOVED_TO (atomic rename). Elsewhere, or when
+    inotify is unavailable, the directory is polled and a file counts as complete
+    once its size and mtime are unchanged between two polls; a file rewritten in
+    place (new size or mtime) is reported again. Only the `max_unclaimed` latest
+    files nobody has waited for yet are remembered.
+
+    Attributes:
+        directory (str): The directory to watch
+        poll_interval (float): Seconds between two scans in polling mode
+        backend (str): 'inotify' or 'polling', whichever is actually in use
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 0.1, use_inotify: bool = True, max_unclaimed: int = 64):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.max_unclaimed = max_unclaimed
+        # completed files nobody has waited for yet, oldest first
+        self._ready = OrderedDict()
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._inotify_fd = None
+        if use_inotify:
+            self._inotify_fd = _inotify_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+        self.backend = 'inotify' if self._inotify_fd is not None else 'polling'
+
+        # files already present when we started watching, they may still be in flight
+        self._pending = {}
+        for name in os.listdir(directory):
+            self._pending[name] = _stat_signature(os.path.join(directory, name))
+
+        target = self._run_inotify if self._inotify_fd is not None else self._run_polling
+        self._thread = threading.Thread(target=target, name='screenshot-intake', daemon=True)
+        self._thread.start()
+
+    def wait_for(self, filename, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Blocks until `filename` has been completely written to the watched directory.
+
+        Args:
+            filename (str or tuple): The file name, or alternative names of which the first written one is taken
+            timeout (float): Seconds to wait at most, None to wait forever
+
+        Returns:
+            str: The full path of the file, or None if `timeout` expired first
+        """
+        names = (filename,) if isinstance(filename, str) else tuple(filename)
+        with self._cond:
+            if not self._cond.wait_for(lambda: any(name in self._ready for name in names), timeout=timeout):
+                return None
+            name = next(name for name in self._ready if name in names)
+            del self._ready[name]
+        return os.path.join(self.directory, name)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _mark_ready(self, name):
+        with self._cond:
+            self._ready.pop(name, None)
+            self._ready[name] = True
+            while len(self._ready) > self.max_unclaimed:
+                self._ready.popitem(last=False)
+            self._cond.notify_all()
+
+    def _run_inotify(self):
+        while self._pending and not self._stopped.is_set():
+            time.sleep(self.poll_interval)
+            self._settle_pending()
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self._inotify_fd], [], [], 0.5)
+            if not readable:
+                continue
+            try:
+                buffer = os.read(self._inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0').decode()
+                offset += length
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self._pending.pop(name, None)
+                    self._mark_ready(name)
+
+    def _settle_pending(self, reported=None):
+        for name, signature in list(self._pending.items()):
+            current = _stat_signature(os.path.join(self.directory, name))
+            if current is None:
+                del self._pending[name]
+            elif current == signature:
+                del self._pending[name]
+                if reported is not None:
+                    reported[name] = current
+                self._mark_ready(name)
+            else:
+                self._pending[name] = current
+
+    def _run_polling(self):
+        # (size, mtime) of every file when it was reported, so that a rewrite is reported again
+        reported = {}
+        while not self._stopped.is_set():
+            time.sleep(self.poll_interval)
+            self._settle_pending(reported)
+            names = os.listdir(self.directory)
+            for name in names:
+                if name in self._pending:
+                    continue
+                signature = _stat_signature(os.path.join(self.directory, name))
+                if signature is not None and reported.get(name) != signature:
+                    self._pending[name] = signature
+            for name in set(reported) - set(names):
+                del reported[name]
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _inotify_watch(directory, mask):
+    """ returns a non-blocking inotify fd watching `directory`, or None if inotify is not available """
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
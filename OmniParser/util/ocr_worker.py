@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import tempfile
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+
+class OCRWorker:
+    """
+    Runs `utils.check_ocr_box` in a dedicated process.
+
+    PaddleOCR is CPU bound and holds the GIL for long stretches, so running it in a
+    thread next to YOLO and the caption model buys nothing. A separate process lets
+    OCR and icon detection actually overlap; `submit` returns a future that is
+    joined right before overlap removal.
+
+    Decoded frames are handed over through a memory-mapped file (in /dev/shm when
+    available) so the worker reads the pixels without decoding or unpickling them.
+    The worker builds and warms up the `engines` (utils.OCR_ENGINES names) as it starts.
+    """
+
+    def __init__(self, engines=('paddle',)):
+        # spawn, not fork: the parent already holds CUDA/torch state
+        self._pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_worker, initargs=(tuple(engines),))
+        # start the process and build the OCR engine now rather than on the first step
+        self._pool.submit(_ping)
+
+    def submit(self, image, **ocr_args) -> Future:
+        """Runs check_ocr_box(image, **ocr_args) in the worker process, `image` is a path or an RGB ndarray."""
+        if not isinstance(image, np.ndarray):
+            return self._pool.submit(_check_ocr_box, image, ocr_args)
+        shared = SharedFrame.create(image)
+        future = self._pool.submit(_check_ocr_box, shared, ocr_args)
+        future.add_done_callback(lambda _: shared.unlink())
+        return future
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+class SharedFrame:
+    """A frame copied once into a memory-mapped file that other processes can map read-only."""
+
+    def __init__(self, path, shape):
+        self.path = path
+        self.shape = shape
+
+    @classmethod
+    def create(cls, frame):
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        shared = cls(os.path.join(directory, f'cat_frame_{uuid.uuid4().hex}'), frame.shape)
+        buffer = np.memmap(shared.path, dtype=np.uint8, mode='w+', shape=frame.shape)
+        buffer[:] = frame
+        del buffer
+        return shared
+
+    def open(self):
+        return np.memmap(self.path, dtype=np.uint8, mode='r', shape=self.shape)
+
+    def unlink(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _init_worker(engines):
+    from utils import warm_up
+    warm_up(ocr_engines=engines)
+
+
+def _ping():
+    return True
+
+
+def _check_ocr_box(image, ocr_args):
+    from utils import check_ocr_box
+    if isinstance(image, SharedFrame):
+        image = image.open()
+    return check_ocr_box(image, **ocr_args)
@@ -0,0 +1,140 @@
+import os
+from types import SimpleNamespace
+from typing import Optional, Sequence
+
+import cv2
+import numpy as np
+import torch
+from torchvision.ops import nms
+
+
+def export_onnx(model_path: str, imgsz: int = 640, int8: bool = False) -> str:
+    """
+    Exports the ultralytics icon detector at `model_path` (weights/icon_detect/model.safetensors
+    or best.pt) to ONNX next to it (model.onnx or best.onnx), unless an export newer than
+    the weights is already there.
+
+    The graph takes any input size that is a multiple of 32, so that frames can be
+    letterboxed exactly as the PyTorch predictor does. With `int8` the weights are
+    also quantized to 8 bits (onnxruntime dynamic quantization) into model.int8.onnx
+    (best.int8.onnx for best.pt).
+
+    Returns:
+        str: The path of the ONNX file
+    """
+    base, _ = os.path.splitext(model_path)
+    onnx_path = base + '.onnx'
+    if not _is_fresh(onnx_path, model_path):
+        if model_path.endswith('.safetensors'):
+            from util.detector_weights import load_detector
+            model = load_detector(model_path, share=False)
+        else:
+            from ultralytics import YOLO
+            model = YOLO(model_path)
+        exported = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        if os.path.abspath(exported) != os.path.abspath(onnx_path):
+            os.replace(exported, onnx_path)
+    if not int8:
+        return onnx_path
+    int8_path = base + '.int8.onnx'
+    if not _is_fresh(int8_path, onnx_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+
+def _is_fresh(path, source):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+class OnnxDetector:
+    """
+    Runs the exported icon detector with ONNX Runtime, as a stand-in for the ultralytics
+    model in utils.predict_yolo: `predict` takes the same arguments and returns results
+    with the same `boxes.xyxy` and `boxes.conf` tensors.
+
+    Pre- and post-processing follow the ultralytics predictor for .pt weights (minimal
+    letterbox padding to a multiple of 32, class-aware NMS at IoU 0.7, at most 300
+    boxes, boxes scaled back and clipped to the frame), so the boxes match those of the
+    PyTorch path up to numerical differences of the runtime.
+
+    Attributes:
+        session (onnxruntime.InferenceSession): The inference session
+        stride (int): Input sizes are padded to a multiple of this
+    """
+
+    def __init__(self, onnx_path: str, providers: Optional[Sequence[str]] = None, threads: Optional[int] = None,
+                 stride: int = 32, iou: float = 0.7, max_det: int = 300):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=list(providers or ['CPUExecutionProvider']))
+        self.input_name = self.session.get_inputs()[0].name
+        self.stride = stride
+        self.iou = iou
+        self.max_det = max_det
+
+    def to(self, device):
+        # ONNX Runtime picks its device through the execution providers
+        return self
+
+    def predict(self, source, conf: float = 0.25, imgsz: int = 640, iou: Optional[float] = None, **kwargs):
+        """`source`: a BGR ndarray or an image path, like YOLO.predict."""
+        frame = cv2.imread(source, cv2.IMREAD_COLOR) if isinstance(source, str) else source
+        image, gain, pad = letterbox(frame, imgsz, self.stride)
+        blob = np.ascontiguousarray(image[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255
+        output = self.session.run(None, {self.input_name: blob})[0]
+        xyxy, scores = postprocess(output[0], conf, self.iou if iou is None else iou, self.max_det)
+        # back to frame coordinates
+        xyxy[:, [0, 2]] = ((xyxy[:, [0, 2]] - pad[0]) / gain).clamp(0, frame.shape[1])
+        xyxy[:, [1, 3]] = ((xyxy[:, [1, 3]] - pad[1]) / gain).clamp(0, frame.shape[0])
+        return [SimpleNamespace(boxes=SimpleNamespace(xyxy=xyxy, conf=scores))]
+
+
+def letterbox(frame: np.ndarray, imgsz: int, stride: int = 32):
+    """
+    Resizes `frame` to fit `imgsz` and pads it with grey to the next multiple of `stride`,
+    centred, like ultralytics' LetterBox(auto=True).
+
+    Returns:
+        tuple: (image, gain, (left padding, top padding))
+    """
+    h, w = frame.shape[:2]
+    gain = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * gain)), int(round(h * gain))
+    dw, dh = (imgsz - new_w) % stride / 2, (imgsz - new_h) % stride / 2
+    if (w, h) != (new_w, new_h):
+        frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    image = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    # ultralytics' scale_boxes recomputes the gain and padding from the padded shape
+    gain = min(image.shape[0] / h, image.shape[1] / w)
+    pad = (round((image.shape[1] - w * gain) / 2 - 0.1), round((image.shape[0] - h * gain) / 2 - 0.1))
+    return image, gain, pad
+
+
+def postprocess(output: np.ndarray, conf: float, iou: float, max_det: int):
+    """
+    Non-maximum suppression of one YOLOv8 output of shape [4 + classes, anchors]
+    (centre x, centre y, width, height, class scores).
+
+    Returns:
+        tuple: (xyxy float tensor [n, 4], confidence tensor [n]), by decreasing confidence
+    """
+    scores = output[4:]
+    classes = scores.argmax(axis=0)
+    confidence = scores[classes, np.arange(scores.shape[1])]
+    keep = confidence > conf
+    cxcywh, classes, confidence = output[:4, keep].T, classes[keep], confidence[keep]
+    order = np.argsort(-confidence, kind='stable')[:30000]
+    cxcywh, classes, confidence = cxcywh[order], classes[order], confidence[order]
+    xyxy = torch.from_numpy(np.concatenate([cxcywh[:, :2] - cxcywh[:, 2:] / 2, cxcywh[:, :2] + cxcywh[:, 2:] / 2], axis=1))
+    confidence = torch.from_numpy(np.ascontiguousarray(confidence))
+    # offset the boxes by class so that NMS does not suppress across classes
+    offsets = torch.from_numpy(classes.astype(np.float32))[:, None] * 7680
+    kept = nms(xyxy + offsets, confidence, iou)[:max_det]
+    return xyxy[kept], confidence[kept]
@@ -0,0 +1,161 @@
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Collection, Optional
+
+from util.instrumentation import Instrumentation
+from util.sessions import SessionManager
+
+
+class StepOutOfOrder(Exception):
+    """A step posted with an X-Step index ahead of the session's next step."""
+
+
+class ParseService:
+    """
+    Long-lived HTTP front end for the parse-and-plan loop.
+
+    The executor keeps one HTTP/1.1 connection open and, for every step, posts the
+    raw screenshot bytes and gets the action JSON back in the same response. Each
+    executor gets its own session, so several of them can share one server.
+
+    Endpoints:
+        POST   /sessions             body {"task": str, "caption_profile": str (optional),
+                                           "screen_scale": float (optional)}
+                                                         -> {"session_id": str}
+        POST   /sessions/<id>/steps  body screenshot     -> action JSON
+
+        DELETE /sessions/<id>                            -> {"session_id": str}
+        GET    /metrics                                  -> Prometheus text, if `metrics` is set
+
+    The screenshot may be PNG, WebP or JPEG. An executor that scales its screenshots
+    down by a factor before sending them gives it as "screen_scale"; COORDINATES in
+    the actions are then in screen pixels again. If the previous action carried a
+    PLAN, the executor reports how far it got through it in an X-Plan-Report header,
+    {"executed": int, "planned": int, "stopped": str or null}.
+
+    The executor also sends the index of the step in an X-Step header, so that a step
+    it posts again after losing the response (e.g. the connection dropped) is not
+    parsed twice: a step the session already answered gets the same result back, and
+    a step ahead of the session's next one is refused with 409.
+
+    Attributes:
+        run_step (Callable): Called as run_step(session, image_bytes, plan_report) from the
+            request thread and returns the action dict; `session` is a util.sessions.Session,
+            `plan_report` the decoded X-Plan-Report or None
+        sessions (SessionManager): The open sessions
+        caption_profiles (Collection): The caption profiles a session may ask for, if restricted
+        metrics (Instrumentation): Served as GET /metrics, if set (see util.instrumentation)
+    """
+
+    def __init__(self, run_step: Callable, sessions: SessionManager, host: str = '127.0.0.1', port: int = 8000,
+                 caption_profiles: Optional[Collection] = None, metrics: Optional[Instrumentation] = None):
+        self.run_step = run_step
+        self.sessions = sessions
+        self.caption_profiles = caption_profiles
+        self.metrics = metrics
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def create_session(self, task, caption_profile=None, screen_scale=1.0):
+        if caption_profile is not None and self.caption_profiles is not None and caption_profile not in self.caption_profiles:
+            raise ValueError(f"unknown caption profile {caption_profile!r}, expected one of {', '.join(self.caption_profiles)}")
+        return self.sessions.create(task, caption_profile=caption_profile, screen_scale=screen_scale)
+
+    def close_session(self, session_id):
+        return self.sessions.close(session_id)
+
+    def step(self, session_id, image_bytes, plan_report=None, step=None):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        with session.step_lock:
+            if step is not None and step < session.step:
+                # the executor did not get the response to this step and sent it again
+                return session.results[step]
+            if step is not None and step > session.step:
+                raise StepOutOfOrder(f'step {step} posted, the session expects step {session.step}')
+            return self.run_step(session, image_bytes, plan_report)
+
+
+_STEP_PATH = re.compile(r'^/sessions/([0-9a-f]+)/steps$')
+_SESSION_PATH = re.compile(r'^/sessions/([0-9a-f]+)$')
+
+
+def _make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so that the executor can reuse one connection for every step
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/sessions':
+                try:
+                    request = json.loads(body)
+                    task = request['task']
+                except (ValueError, KeyError, TypeError):
+                    return self._send_json(400, {'error': 'expected {"task": ...}'})
+                try:
+                    session = service.create_session(task, caption_profile=request.get('caption_profile'),
+                                                     screen_scale=float(request.get('screen_scale', 1.0)))
+                except (ValueError, TypeError) as e:
+                    return self._send_json(400, {'error': str(e)})
+                return self._send_json(200, {'session_id': session.id})
+
+            match = _STEP_PATH.match(self.path)
+            if not match:
+                return self._send_json(404, {'error': f'unknown path {self.path}'})
+            try:
+                plan_report = json.loads(self.headers.get('X-Plan-Report') or 'null')
+            except ValueError:
+                return self._send_json(400, {'error': 'X-Plan-Report is not JSON'})
+            try:
+                step = int(self.headers['X-Step']) if self.headers.get('X-Step') else None
+            except ValueError:
+                return self._send_json(400, {'error': 'X-Step is not an integer'})
+            try:
+                result = service.step(match.group(1), body, plan_report, step)
+            except StepOutOfOrder as e:
+                return self._send_json(409, {'error': str(e)})
+            except Exception as e:
+                return self._send_json(500, {'error': str(e)})
+            if result is None:
+                return self._send_json(404, {'error': f'unknown session {match.group(1)}'})
+            self._send_json(200, result)
+
+        def do_GET(self):
+            if self.path != '/metrics' or service.metrics is None:
+                return self._send_json(404, {'error': f'unknown path {self.path}'})
+            data = service.metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_DELETE(self):
+            match = _SESSION_PATH.match(self.path)
+            if not match or service.close_session(match.group(1)) is None:
+                return self._send_json(404, {'error': f'unknown path {self.path}'})
+            self._send_json(200, {'session_id': match.group(1)})
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
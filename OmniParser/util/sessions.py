@@ -0,0 +1,157 @@
+import os
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from util.element_tracker import ElementTracker
+from util.step_history import StepHistory
+
+
+class Session:
+    """
+    The state of one task being automated by one executor.
+
+    Attributes:
+        id (str): The session id
+        task (str): The task as entered by the user
+        step (int): The index of the next screenshot
+        history (StepHistory): What was done in the previous steps, as replayed to the analyzer
+        results (list): The action dicts sent back, in step order
+        screen_elements (list): The elements parsed from the latest screenshot, with stable IDs
+        tracker (ElementTracker): Keeps element IDs stable across this session's screenshots
+        parser (IncrementalParser): Reuses the previous parse of this session's screenshots, if enabled
+        caption_profile (str): The icon caption decoding profile for this session, None for the server's default
+        screen_scale (float): How much the executor scaled its screenshots down before sending them; results
+            are mapped back to screen pixels
+        imgs_dir (str): Where this session's screenshots are stored
+        results_dir (str): Where this session's results and labeled screenshots are stored
+        step_lock (threading.Lock): Held while one of this session's steps is handled, so that a
+            repeated request for a step waits for the first one
+    """
+
+    def __init__(self, task: str, session_id: Optional[str] = None, imgs_dir: str = 'imgs', results_dir: str = 'results',
+                 history_tokens: int = 2000, caption_profile: Optional[str] = None, screen_scale: float = 1.0):
+        self.id = session_id or uuid.uuid4().hex
+        self.task = task
+        self.step = 0
+        self.history = StepHistory(history_tokens)
+        self.results = []
+        self.screen_elements = None
+        self.tracker = ElementTracker()
+        self.parser = None
+        self.caption_profile = caption_profile
+        self.screen_scale = screen_scale
+        self.imgs_dir = imgs_dir
+        self.results_dir = results_dir
+        self.closed = False
+        self.step_lock = threading.Lock()
+        self._cond = threading.Condition()
+
+    def record(self, json_result):
+        """Stores the action sent for the current step, and the actions planned after it, and moves on to the next one."""
+        plan = [{key: action.get(key) for key in ('ACTION', 'ELEMENT', 'DETAILS')} for action in json_result.get('PLAN', [])]
+        with self._cond:
+            self.history.add(self.step, json_result.get('ACTION'), json_result.get('ELEMENT'), json_result.get('DETAILS'),
+                             plan=plan)
+            self.results.append(json_result)
+            self.step += 1
+            self._cond.notify_all()
+
+    def wait_for_result(self, step: int, timeout: Optional[float] = None):
+        """Blocks until the result of `step` is available; returns None on timeout or once the session is closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.results) > step or self.closed, timeout=timeout)
+            return self.results[step] if len(self.results) > step else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class SessionManager:
+    """
+    Owns the open sessions and runs their parse jobs on a single worker thread.
+
+    All sessions share one set of models, so parse jobs run one at a time. Jobs of a
+    session run in the order they were submitted, and sessions with pending jobs are
+    served round-robin, so a busy executor cannot starve the others.
+    """
+
+    def __init__(self, base_imgs_dir: str = 'imgs', base_results_dir: str = 'results', history_tokens: int = 2000):
+        self.base_imgs_dir = base_imgs_dir
+        self.base_results_dir = base_results_dir
+        self.history_tokens = history_tokens
+        self.sessions = {}
+        self._queues = {}
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='parse-scheduler', daemon=True)
+        self._thread.start()
+
+    def create(self, task: str, session_id: Optional[str] = None, per_session_dirs: bool = True,
+               caption_profile: Optional[str] = None, screen_scale: float = 1.0) -> Session:
+        """Opens a session; with `per_session_dirs` its files go to imgs/<id>/ and results/<id>/."""
+        if not 0 < screen_scale <= 1:
+            raise ValueError(f"screen_scale must be in (0, 1], got {screen_scale!r}")
+        session = Session(task, session_id, history_tokens=self.history_tokens, caption_profile=caption_profile,
+                          screen_scale=screen_scale)
+        if per_session_dirs:
+            session.imgs_dir = os.path.join(self.base_imgs_dir, session.id)
+            session.results_dir = os.path.join(self.base_results_dir, session.id)
+        else:
+            session.imgs_dir, session.results_dir = self.base_imgs_dir, self.base_results_dir
+        os.makedirs(session.imgs_dir, exist_ok=True)
+        os.makedirs(session.results_dir, exist_ok=True)
+        with self._cond:
+            self.sessions[session.id] = session
+            self._queues[session.id] = deque()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def close(self, session_id: str) -> Optional[Session]:
+        """Closes a session and cancels its jobs that have not started yet."""
+        with self._cond:
+            session = self.sessions.pop(session_id, None)
+            pending = self._queues.pop(session_id, deque())
+        for _, _, future in pending:
+            future.cancel()
+        if session is not None:
+            session.close()
+        return session
+
+    def submit(self, session: Session, fn: Callable, *args, **kwargs) -> Future:
+        """Schedules fn(*args, **kwargs) on the worker thread, in `session`'s turn."""
+        future = Future()
+        with self._cond:
+            queue = self._queues.get(session.id)
+            if queue is None:
+                raise KeyError(f"unknown session {session.id}")
+            if not queue:
+                self._ready.append(session.id)
+            queue.append((fn, (args, kwargs), future))
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready)
+                session_id = self._ready.popleft()
+                queue = self._queues.get(session_id)
+                if not queue:
+                    continue
+                fn, (args, kwargs), future = queue.popleft()
+                if queue:
+                    # the session goes to the back of the line for its next job
+                    self._ready.append(session_id)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
@@ -0,0 +1,136 @@
+import json
+from collections import Counter
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def plan_outcome(report, outcome):
+    """The outcome of a step whose result planned several actions, from the executor's report on them."""
+    text = f"executed {report.get('executed')} of {report.get('planned')} planned actions"
+    if report.get('stopped'):
+        text += f", stopped because {report['stopped']}"
+    return f"{text}; {outcome}"
+
+
+class StepRecord:
+    """What the analyzer asked for in one step, and what came of it.
+
+    `plan` holds the actions planned after the first one, as dicts with ACTION, ELEMENT
+    and DETAILS, if the analyzer returned several.
+    """
+
+    def __init__(self, step, action, element, details, outcome='pending', plan=None):
+        self.step = step
+        self.action = action
+        self.element = element
+        self.details = details
+        self.outcome = outcome
+        self.plan = plan or []
+
+    def action_text(self):
+        # same layout the system prompt asks for, so the analyzer keeps answering in it
+        action = {"ACTION": self.action, "ELEMENT": self.element, "DETAILS": self.details}
+        if self.plan:
+            return json.dumps([action] + self.plan, indent=4)
+        return json.dumps(action, indent=4)
+
+    def outcome_text(self):
+        return f"Step {self.step} outcome: {self.outcome}"
+
+    def tokens(self):
+        return estimate_tokens(self.action_text()) + estimate_tokens(self.outcome_text())
+
+    def summary_line(self):
+        line = f"step {self.step}: {self.action} {self.element}"
+        if self.details:
+            line += f" ({self.details})"
+        if self.plan:
+            line += f" and {len(self.plan)} more planned"
+        return line + f" -> {self.outcome}"
+
+
+class StepHistory:
+    """
+    Compact, bounded memory of the steps taken so far in a task.
+
+    Each step is kept as a StepRecord and replayed to the analyzer as an assistant
+    turn (the action it chose) followed by a user turn (the outcome). Once the
+    replayed steps exceed `token_budget`, the oldest ones are folded into a short
+    summary sent with the task; if the summary itself grows past a quarter of the
+    budget, it is reduced to a count of earlier actions.
+
+    Attributes:
+        token_budget (int): Approximate number of tokens the history may use
+        records (list): The steps still replayed turn by turn, oldest first
+        summary (list): The evicted steps still summarized one line each, oldest first
+    """
+
+    def __init__(self, token_budget: int = 2000):
+        self.token_budget = token_budget
+        self.records = []
+        self.summary = []
+        self._evicted_actions = Counter()
+
+    def add(self, step, action, element, details, outcome='pending', plan=None):
+        self.records.append(StepRecord(step, action, element, details, outcome, plan))
+        self._enforce_budget()
+
+    def set_outcome(self, step, outcome):
+        """Updates the outcome of `step`, e.g. once the next screenshot shows whether the screen changed."""
+        for record in reversed(self.records):
+            if record.step == step:
+                record.outcome = outcome
+                break
+        self._enforce_budget()
+
+    def tokens(self):
+        return sum(record.tokens() for record in self.records) + estimate_tokens(self.summary_text())
+
+    def summary_text(self):
+        parts = []
+        if self._evicted_actions:
+            counts = ", ".join(f"{n} x {action}" for action, n in self._evicted_actions.most_common())
+            parts.append(f"Earlier actions: {counts}.")
+        if self.summary:
+            parts.append("Earlier steps:\n" + "\n".join(record.summary_line() for record in self.summary))
+        return "\n".join(parts)
+
+    def to_messages(self, first_content, last_content: str):
+        """
+        Builds the message list for the analyzer.
+
+        Args:
+            first_content (str or list): The opening user message, typically the task; a
+                list of content blocks is kept as is, e.g. to carry cache_control
+            last_content (str): The closing user message, typically the current screen
+        Returns:
+            list: Alternating user/assistant messages, starting and ending with a user turn
+        """
+        turns = [('user', first_content)]
+        summary = self.summary_text()
+        if summary:
+            turns.append(('user', summary))
+        for record in self.records:
+            turns.append(('assistant', record.action_text()))
+            turns.append(('user', record.outcome_text()))
+        turns.append(('user', last_content))
+
+        messages = []
+        for role, content in turns:
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            if messages and messages[-1]['role'] == role:
+                messages[-1]['content'] = messages[-1]['content'] + content
+            else:
+                messages.append({"role": role, "content": content})
+        return messages
+
+    def _enforce_budget(self):
+        # always keep the latest step verbatim
+        while len(self.records) > 1 and self.tokens() > self.token_budget:
+            self.summary.append(self.records.pop(0))
+        while self.summary and estimate_tokens(self.summary_text()) > self.token_budget // 4:
+            self._evicted_actions[self.summary.pop(0).action] += 1
@@ -5,30 +5,15 @@ import base64
 import time
 from PIL import Image, ImageDraw, ImageFont
 import json
-import requests
 # utility function
 import os
-from openai import AzureOpenAI
 
 import json
 import sys
 import os
+import threading
 import cv2
 import numpy as np
-# %matplotlib inline
-from matplotlib import pyplot as plt
-import easyocr
-from paddleocr import PaddleOCR
-reader = easyocr.Reader(['en'])
-paddle_ocr = PaddleOCR(
-    lang='en',  # other lang also available
-    use_angle_cls=False,
-    use_gpu=False,  # using cuda will conflict with pytorch in the same process
-    show_log=False,
-    max_batch_size=1024,
-    use_dilation=True,  # improves accuracy
-    det_db_score_mode='slow',  # improves accuracy
-    rec_batch_num=1024)
 import time
 import base64
 
@@ -39,11 +24,115 @@ from typing import Tuple, List
 from torchvision.ops import box_convert
 import re
 from torchvision.transforms import ToPILImage
-import supervision as sv
 import torchvision.transforms as T
+from util.caption_scheduler import CaptionScheduler, resized_bucket
+from util.instrumentation import metrics
 
 
-def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None):
+def _easyocr_reader():
+    import easyocr
+    return easyocr.Reader(['en'])
+
+
+def _paddle_ocr():
+    from paddleocr import PaddleOCR
+    return PaddleOCR(
+        lang='en',  # other lang also available
+        use_angle_cls=False,
+        use_gpu=False,  # using cuda will conflict with pytorch in the same process
+        show_log=False,
+        max_batch_size=1024,
+        use_dilation=True,  # improves accuracy
+        det_db_score_mode='slow',  # improves accuracy
+        rec_batch_num=1024)
+
+
+# OCR engine name -> factory; engines are built on first use by get_ocr_engine
+OCR_ENGINES = {
+    'easyocr': _easyocr_reader,
+    'paddle': _paddle_ocr,
+}
+_ocr_engines = {}
+_ocr_lock = threading.Lock()
+
+
+def get_ocr_engine(name):
+    """ the OCR engine `name` (an OCR_ENGINES key), built on the first call and shared afterwards
+    """
+    engine = _ocr_engines.get(name)
+    if engine is None:
+        with _ocr_lock:
+            if name not in _ocr_engines:
+                _ocr_engines[name] = OCR_ENGINES[name]()
+            engine = _ocr_engines[name]
+    return engine
+
+
+def __getattr__(name):
+    # the engines used to be built at import as utils.reader and utils.paddle_ocr
+    if name == 'reader':
+        return get_ocr_engine('easyocr')
+    if name == 'paddle_ocr':
+        return get_ocr_engine('paddle')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def warm_up(som_model=None, caption_model_processor=None, ocr_engines=('paddle',)):
+    """ runs one dummy inference through each given model so that lazy initialisation (engine construction,
+        weight loading, kernel selection) happens now rather than in the first request
+        returns {model: seconds}
+    """
+    frame = np.full((640, 640, 3), 255, dtype=np.uint8)
+    cv2.putText(frame, 'Warm up 123', (40, 80), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2)
+    cv2.rectangle(frame, (40, 200), (120, 280), (30, 90, 200), cv2.FILLED)
+    timings = {}
+    for name in ocr_engines:
+        start = time.perf_counter()
+        check_ocr_box(frame, display_img=False, output_bb_format='xyxy', use_paddleocr=name == 'paddle')
+        timings[f'ocr:{name}'] = time.perf_counter() - start
+    if som_model is not None:
+        start = time.perf_counter()
+        predict_yolo(som_model, frame, box_threshold=0.05, imgsz=640)
+        timings['detector'] = time.perf_counter() - start
+    if caption_model_processor is not None:
+        start = time.perf_counter()
+        model = caption_model_processor['model']
+        crop = Image.fromarray(frame[200:280, 40:120])
+        if 'phi3_v' in model.config.model_type:
+            get_parsed_content_icon_phi3v(torch.tensor([[40 / 640, 200 / 640, 120 / 640, 280 / 640]]), None, frame, caption_model_processor)
+        else:
+            caption_images([crop], caption_model_processor, "<CAPTION>" if 'florence' in model.config.name_or_path else "The image shows")
+        timings['caption'] = time.perf_counter() - start
+    return timings
+
+
+# generate() arguments for the icon caption models, by profile and model family.
+# 'accurate' is the original OmniParser setting; icon labels are a few tokens long, so
+# 'balanced' and 'fast' cap the length and narrow or drop the beam search.
+CAPTION_PROFILES = {
+    'accurate': {
+        'florence': {'max_new_tokens': 1024, 'num_beams': 3, 'do_sample': False},
+        'blip2': {'max_length': 100, 'num_beams': 5, 'no_repeat_ngram_size': 2, 'early_stopping': True, 'num_return_sequences': 1},
+        'phi3_v': {'max_new_tokens': 25, 'temperature': 0.01, 'do_sample': False},
+    },
+    'balanced': {
+        'florence': {'max_new_tokens': 20, 'num_beams': 2, 'early_stopping': True, 'do_sample': False},
+        'blip2': {'max_new_tokens': 20, 'num_beams': 2, 'no_repeat_ngram_size': 2, 'early_stopping': True},
+        'phi3_v': {'max_new_tokens': 20, 'do_sample': False},
+    },
+    'fast': {
+        'florence': {'max_new_tokens': 12, 'num_beams': 1, 'do_sample': False},
+        'blip2': {'max_new_tokens': 12, 'num_beams': 1, 'no_repeat_ngram_size': 2, 'do_sample': False},
+        'phi3_v': {'max_new_tokens': 12, 'do_sample': False},
+    },
+}
+
+
+def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None, precision='fp32'):
+    """ precision: on CPU, 'int8' (dynamically quantized linear layers) or 'bf16' Florence-2, converted once and cached
+        on disk as a state_dict (see util.caption_quantization); 'fp32' is the unmodified model. bf16 falls back to fp32
+        on CPUs without native bfloat16 (caption_quantization.cpu_precision). Ignored on GPU, which uses fp16.
+    """
     if not device:
         device = "cuda" if torch.cuda.is_available() else "cpu"
     if model_name == "blip2":
@@ -61,158 +150,310 @@ def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2
         from transformers import AutoProcessor, AutoModelForCausalLM 
         processor = AutoProcessor.from_pretrained("microsoft/Florence-2-base", trust_remote_code=True)
         if device == 'cpu':
-            model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
+            from util.caption_quantization import cpu_precision, load_cpu_caption_model
+            precision = cpu_precision(precision)
+            model = load_cpu_caption_model(model_name_or_path, precision)
         else:
             model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float16, trust_remote_code=True).to(device)
-    return {'model': model.to(device), 'processor': processor}
-
-
-def get_yolo_model(model_path):
+    caption_model_processor = {'model': model.to(device), 'processor': processor}
+    if device == 'cpu' and model_name == "florence2" and precision != 'fp32':
+        caption_model_processor['precision'] = precision
+    return caption_model_processor
+
+
+def get_yolo_model(model_path, backend='torch', int8=False, share=False):
+    """ model_path: ultralytics weights (best.pt), or model.safetensors next to its model.yaml (see util.detector_weights)
+        share: for model.safetensors, keep the weights memory-mapped so that processes on one host share them,
+        and unfused on CPU; by default they are copied into the process and fused
+        backend: 'torch' (ultralytics), 'onnx' (ONNX Runtime on CPU) or 'openvino' (ONNX Runtime with the OpenVINO execution provider)
+        int8: for the ONNX backends, use 8-bit quantized weights
+        the ONNX backends export the weights once, next to model_path (see util.onnx_detector)
+    """
+    if backend != 'torch':
+        from util.onnx_detector import OnnxDetector, export_onnx
+        providers = ['OpenVINOExecutionProvider', 'CPUExecutionProvider'] if backend == 'openvino' else None
+        return OnnxDetector(export_onnx(model_path, int8=int8), providers=providers)
+    if model_path.endswith('.safetensors'):
+        from util.detector_weights import load_detector
+        return load_detector(model_path, share=share)
     from ultralytics import YOLO
     # Load the model.
     model = YOLO(model_path)
     return model
 
 
-@torch.inference_mode()
-def get_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=None):
-    to_pil = ToPILImage()
+def crop_icons(filtered_boxes, ocr_bbox, image_source):
+    """ Crops the non-OCR boxes (normalized xyxy) out of image_source; returns RGB ndarrays
+    """
     if ocr_bbox:
         non_ocr_boxes = filtered_boxes[len(ocr_bbox):]
     else:
         non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
+    crops = []
     for i, coord in enumerate(non_ocr_boxes):
         xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
         ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-        croped_pil_image.append(to_pil(cropped_image))
+        crops.append(image_source[ymin:ymax, xmin:xmax, :])
+    return crops
 
-    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+
+def lookup_captions(caption_model_processor, prompt, crops, profile='accurate'):
+    """ Looks the crops up in caption_model_processor['cache'] (a util.caption_cache.CaptionCache), if any
+        returns (captions with None for the crops to caption, cache keys or None)
+    """
+    cache = caption_model_processor.get('cache')
+    if cache is None:
+        return [None] * len(crops), None
+    model_name = caption_model_processor['model'].config.name_or_path
+    if 'precision' in caption_model_processor:
+        # quantized models may caption differently, keep their captions apart
+        model_name += f":{caption_model_processor['precision']}"
+    keys = [cache.key(model_name, f'{profile}:{prompt}', crop) for crop in crops]
+    captions = [cache.get(key) for key in keys]
+    metrics.count('caption_cache_hits', sum(caption is not None for caption in captions))
+    return captions, keys
+
+
+@torch.inference_mode()
+def get_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=None, profile='accurate'):
+    """ caption_model_processor: {'model', 'processor'} and optionally 'cache', a CaptionCache consulted before generating
+        profile: a CAPTION_PROFILES name
+    """
+    to_pil = ToPILImage()
+    crops = crop_icons(filtered_boxes, ocr_bbox, image_source)
+    metrics.count('crops', len(crops))
+
+    model = caption_model_processor['model']
     if not prompt:
         if 'florence' in model.config.name_or_path:
             prompt = "<CAPTION>"
         else:
             prompt = "The image shows"
 
-    batch_size = 10  # Number of samples per batch
-    generated_texts = []
+    captions, keys = lookup_captions(caption_model_processor, prompt, crops, profile)
+    missing = [i for i, caption in enumerate(captions) if caption is None]
+    croped_pil_image = [to_pil(crops[i]) for i in missing]
+    generated_texts = caption_images(croped_pil_image, caption_model_processor, prompt, profile)
+
+    return fill_captions(caption_model_processor, captions, keys, missing, generated_texts)
+
+
+def caption_images(images, caption_model_processor, prompt, profile='accurate'):
+    """ Captions PIL images with Florence-2 or BLIP-2, batched by the model's CaptionScheduler;
+        their processors resize every crop to one size, so crops of any shape share batches
+    """
+    model = caption_model_processor['model']
+    family = 'florence' if 'florence' in model.config.name_or_path else 'blip2'
+    generate_args = CAPTION_PROFILES[profile][family]
+    run_batch = lambda batch: caption_batch(caption_model_processor, prompt, batch, generate_args)
+    return caption_scheduler(caption_model_processor).run(
+        images, run_batch, key=(id(model), prompt, profile), device=model.device, bucket=resized_bucket)
+
+
+@torch.inference_mode()
+def caption_batch(caption_model_processor, prompt, batch, generate_args):
+    """ Captions one batch of PIL crops with Florence-2 or BLIP-2
+    """
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
     device = model.device
+    if model.device.type == 'cuda':
+        inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device, dtype=torch.float16)
+    elif model.dtype == torch.bfloat16:
+        inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device, dtype=torch.bfloat16)
+    else:
+        inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
+    if 'florence' in model.config.name_or_path:
+        generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"],**generate_args)
+    else:
+        generated_ids = model.generate(**inputs, **generate_args)
+    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
+    return [gen.strip() for gen in generated_text]
 
-    for i in range(0, len(croped_pil_image), batch_size):
-        batch = croped_pil_image[i:i+batch_size]
-        if model.device.type == 'cuda':
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device, dtype=torch.float16)
-        else:
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
-        if 'florence' in model.config.name_or_path:
-            generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"],max_new_tokens=1024,num_beams=3, do_sample=False)
-        else:
-            generated_ids = model.generate(**inputs, max_length=100, num_beams=5, no_repeat_ngram_size=2, early_stopping=True, num_return_sequences=1) # temperature=0.01, do_sample=True,
-        generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
-        generated_text = [gen.strip() for gen in generated_text]
-        generated_texts.extend(generated_text)
 
-    return generated_texts
+def caption_scheduler(caption_model_processor):
+    """ The CaptionScheduler batching crops for this caption model, created on first use
+    """
+    if 'scheduler' not in caption_model_processor:
+        caption_model_processor['scheduler'] = CaptionScheduler()
+    return caption_model_processor['scheduler']
+
+
+def fill_captions(caption_model_processor, captions, keys, missing, generated_texts):
+    """ Puts the generated captions in place of the missing ones, and stores them in the cache if any
+    """
+    for i, caption in zip(missing, generated_texts):
+        captions[i] = caption
+    if keys is not None:
+        caption_model_processor['cache'].put_many((keys[i], captions[i]) for i in missing)
+    return captions
 
 
 
-def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor):
+def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor, profile='accurate'):
     to_pil = ToPILImage()
-    if ocr_bbox:
-        non_ocr_boxes = filtered_boxes[len(ocr_bbox):]
-    else:
-        non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
-    for i, coord in enumerate(non_ocr_boxes):
-        xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
-        ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-        croped_pil_image.append(to_pil(cropped_image))
+    crops = crop_icons(filtered_boxes, ocr_bbox, image_source)
+    metrics.count('crops', len(crops))
 
     model, processor = caption_model_processor['model'], caption_model_processor['processor']
     device = model.device
     messages = [{"role": "user", "content": "<|image_1|>\ndescribe the icon in one sentence"}] 
     prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
 
-    batch_size = 5  # Number of samples per batch
-    generated_texts = []
-
-    for i in range(0, len(croped_pil_image), batch_size):
-        images = croped_pil_image[i:i+batch_size]
-        image_inputs = [processor.image_processor(x, return_tensors="pt") for x in images]
-        inputs ={'input_ids': [], 'attention_mask': [], 'pixel_values': [], 'image_sizes': []}
-        texts = [prompt] * len(images)
-        for i, txt in enumerate(texts):
-            input = processor._convert_images_texts_to_inputs(image_inputs[i], txt, return_tensors="pt")
-            inputs['input_ids'].append(input['input_ids'])
-            inputs['attention_mask'].append(input['attention_mask'])
-            inputs['pixel_values'].append(input['pixel_values'])
-            inputs['image_sizes'].append(input['image_sizes'])
-        max_len = max([x.shape[1] for x in inputs['input_ids']])
-        for i, v in enumerate(inputs['input_ids']):
-            inputs['input_ids'][i] = torch.cat([processor.tokenizer.pad_token_id * torch.ones(1, max_len - v.shape[1], dtype=torch.long), v], dim=1)
-            inputs['attention_mask'][i] = torch.cat([torch.zeros(1, max_len - v.shape[1], dtype=torch.long), inputs['attention_mask'][i]], dim=1)
-        inputs_cat = {k: torch.concatenate(v).to(device) for k, v in inputs.items()}
-
-        generation_args = { 
-            "max_new_tokens": 25, 
-            "temperature": 0.01, 
-            "do_sample": False, 
-        } 
-        generate_ids = model.generate(**inputs_cat, eos_token_id=processor.tokenizer.eos_token_id, **generation_args) 
-        # # remove input tokens 
-        generate_ids = generate_ids[:, inputs_cat['input_ids'].shape[1]:]
-        response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        response = [res.strip('\n').strip() for res in response]
-        generated_texts.extend(response)
-
-    return generated_texts
-
-def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
+    captions, keys = lookup_captions(caption_model_processor, prompt, crops, profile)
+    missing = [i for i, caption in enumerate(captions) if caption is None]
+    croped_pil_image = [to_pil(crops[i]) for i in missing]
+
+    generate_args = CAPTION_PROFILES[profile]['phi3_v']
+    run_batch = lambda images: caption_batch_phi3v(caption_model_processor, prompt, images, generate_args)
+    generated_texts = caption_scheduler(caption_model_processor).run(
+        croped_pil_image, run_batch, key=(id(model), prompt, profile), device=device)
+
+    return fill_captions(caption_model_processor, captions, keys, missing, generated_texts)
+
+
+@torch.inference_mode()
+def caption_batch_phi3v(caption_model_processor, prompt, images, generate_args):
+    """ Captions one batch of PIL crops with Phi-3-vision
+    """
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    device = model.device
+    image_inputs = [processor.image_processor(x, return_tensors="pt") for x in images]
+    inputs ={'input_ids': [], 'attention_mask': [], 'pixel_values': [], 'image_sizes': []}
+    texts = [prompt] * len(images)
+    for i, txt in enumerate(texts):
+        input = processor._convert_images_texts_to_inputs(image_inputs[i], txt, return_tensors="pt")
+        inputs['input_ids'].append(input['input_ids'])
+        inputs['attention_mask'].append(input['attention_mask'])
+        inputs['pixel_values'].append(input['pixel_values'])
+        inputs['image_sizes'].append(input['image_sizes'])
+    max_len = max([x.shape[1] for x in inputs['input_ids']])
+    for i, v in enumerate(inputs['input_ids']):
+        inputs['input_ids'][i] = torch.cat([processor.tokenizer.pad_token_id * torch.ones(1, max_len - v.shape[1], dtype=torch.long), v], dim=1)
+        inputs['attention_mask'][i] = torch.cat([torch.zeros(1, max_len - v.shape[1], dtype=torch.long), inputs['attention_mask'][i]], dim=1)
+    inputs_cat = {k: torch.concatenate(v).to(device) for k, v in inputs.items()}
+
+    generate_ids = model.generate(**inputs_cat, eos_token_id=processor.tokenizer.eos_token_id, **generate_args) 
+    # # remove input tokens 
+    generate_ids = generate_ids[:, inputs_cat['input_ids'].shape[1]:]
+    response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    return [res.strip('\n').strip() for res in response]
+
+
+def remove_overlap(boxes, iou_threshold, ocr_bbox=None, grid_size=None):
+    """ Drops the boxes that overlap a smaller box, or an OCR box, by more than iou_threshold.
+        The overlap of two boxes is the largest of their IoU and the share of either box covered
+        by the other. Returns the OCR boxes followed by the kept boxes, as a tensor.
+        boxes: tensor of xyxy boxes; ocr_bbox: list of xyxy boxes
+        grid_size: bucket the boxes on a grid_size x grid_size grid of the unit square (normalized
+            coordinates) and only compare boxes that share a cell; worth it for thousands of boxes
+    """
     assert ocr_bbox is None or isinstance(ocr_bbox, List)
 
-    def box_area(box):
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def intersection_area(box1, box2):
-        x1 = max(box1[0], box2[0])
-        y1 = max(box1[1], box2[1])
-        x2 = min(box1[2], box2[2])
-        y2 = min(box1[3], box2[3])
-        return max(0, x2 - x1) * max(0, y2 - y1)
-
-    def IoU(box1, box2):
-        intersection = intersection_area(box1, box2)
-        union = box_area(box1) + box_area(box2) - intersection + 1e-6
-        if box_area(box1) > 0 and box_area(box2) > 0:
-            ratio1 = intersection / box_area(box1)
-            ratio2 = intersection / box_area(box2)
-        else:
-            ratio1, ratio2 = 0, 0
-        return max(intersection / union, ratio1, ratio2)
+    # float64, like the Python floats of boxes.tolist(), so that the comparisons come out the same
+    boxes = boxes.detach().cpu().double().numpy().reshape(-1, 4)
+    ocr = np.asarray(ocr_bbox, dtype=np.float64).reshape(-1, 4) if ocr_bbox else None
+    if grid_size and iou_threshold < 0:
+        # every pair overlaps by more than a negative threshold, bucketing would miss some
+        grid_size = None
+
+    # a box is dropped if it overlaps a smaller box
+    area = box_area(boxes)
+    dropped = np.zeros(len(boxes), dtype=bool)
+    for i, j, iou in overlap_pairs(boxes, boxes, grid_size):
+        hit = (i != j) & (iou > iou_threshold) & (area[i] > area[j])
+        dropped[np.broadcast_to(i, hit.shape)[hit]] = True
+    # or any OCR box
+    if ocr is not None:
+        for i, j, iou in overlap_pairs(boxes, ocr, grid_size):
+            hit = iou > iou_threshold
+            dropped[np.broadcast_to(i, hit.shape)[hit]] = True
 
-    boxes = boxes.tolist()
     filtered_boxes = []
     if ocr_bbox:
         filtered_boxes.extend(ocr_bbox)
-    # print('ocr_bbox!!!', ocr_bbox)
-    for i, box1 in enumerate(boxes):
-        # if not any(IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2) for j, box2 in enumerate(boxes) if i != j):
-        is_valid_box = True
-        for j, box2 in enumerate(boxes):
-            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
-                is_valid_box = False
-                break
-        if is_valid_box:
-            # add the following 2 lines to include ocr bbox
-            if ocr_bbox:
-                if not any(IoU(box1, box3) > iou_threshold for k, box3 in enumerate(ocr_bbox)):
-                    filtered_boxes.append(box1)
-            else:
-                filtered_boxes.append(box1)
+    filtered_boxes.extend(boxes[~dropped].tolist())
     return torch.tensor(filtered_boxes)
 
+
+def box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def box_overlap(a, b):
+    """ Elementwise overlap of xyxy boxes a and b: max(IoU, intersection / area a, intersection / area b)
+    """
+    intersection = (np.maximum(0, np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]))
+                    * np.maximum(0, np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])))
+    area_a, area_b = box_area(a), box_area(b)
+    union = area_a + area_b - intersection + 1e-6
+    positive = (area_a > 0) & (area_b > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_a = np.where(positive, intersection / area_a, 0)
+        ratio_b = np.where(positive, intersection / area_b, 0)
+    return np.maximum(np.maximum(intersection / union, ratio_a), ratio_b)
+
+
+def overlap_pairs(a, b, grid_size=None, chunk=1 << 22):
+    """ Yields (i, j, box_overlap(a[i], b[j])) index/value arrays (broadcastable) covering the pairs of boxes
+        from a and b: all pairs, as blocks of about `chunk` pairs; with grid_size, only the pairs that share a grid cell
+    """
+    if len(a) == 0 or len(b) == 0:
+        return
+    if not grid_size:
+        rows = max(1, chunk // len(b))
+        j = np.arange(len(b))[None]
+        for start in range(0, len(a), rows):
+            i = np.arange(start, min(start + rows, len(a)))[:, None]
+            yield i, j, box_overlap(a[start:start + rows, None], b[None])
+        return
+
+    def cells(boxes):
+        # the grid cells each box touches, as (box index, cell id) pairs
+        lo = np.clip(np.floor(boxes[:, :2] * grid_size), 0, grid_size - 1).astype(np.int64)
+        hi = np.clip(np.floor(boxes[:, 2:] * grid_size), 0, grid_size - 1).astype(np.int64)
+        hi = np.maximum(hi, lo)
+        counts = (hi[:, 0] - lo[:, 0] + 1) * (hi[:, 1] - lo[:, 1] + 1)
+        index = np.repeat(np.arange(len(boxes)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        width = (hi[:, 0] - lo[:, 0] + 1)[index]
+        cx, cy = lo[index, 0] + offset % width, lo[index, 1] + offset // width
+        return index, cy * grid_size + cx
+
+    a_index, a_cell = cells(a)
+    b_index, b_cell = cells(b)
+    order = np.argsort(b_cell, kind='stable')
+    b_index, b_cell = b_index[order], b_cell[order]
+    # for every (a box, cell), the range of b boxes in that cell
+    first = np.searchsorted(b_cell, a_cell, side='left')
+    counts = np.searchsorted(b_cell, a_cell, side='right') - first
+    i = np.repeat(a_index, counts)
+    j = b_index[np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    # boxes sharing several cells are paired once
+    pairs = np.unique(i * len(b) + j)
+    i, j = pairs // len(b), pairs % len(b)
+    for start in range(0, len(i), chunk):
+        part = slice(start, start + chunk)
+        yield i[part], j[part], box_overlap(a[i[part]], b[j[part]])
+
+
+def load_frame(image) -> np.ndarray:
+    """ decode a screenshot once so that every parse stage can share it
+        image: a file path, the encoded file content (bytes), a PIL image, or an already decoded RGB ndarray (returned as is)
+        returns an HxWx3 uint8 RGB ndarray
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("RGB"))
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        frame = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        frame = cv2.imread(image, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError(f"could not decode image {image if isinstance(image, str) else '<bytes>'}")
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+
+
 def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     transform = T.Compose(
         [
@@ -246,6 +487,7 @@ def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor
     boxes = boxes * torch.Tensor([w, h, w, h])
     xyxy = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xyxy").numpy()
     xywh = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xywh").numpy()
+    import supervision as sv
     detections = sv.Detections(xyxy=xyxy)
 
     labels = [f"{phrase}" for phrase in range(boxes.shape[0])]
@@ -259,6 +501,32 @@ def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor
     return annotated_frame, label_coordinates
 
 
+def draw_som_labels(image_source: np.ndarray, label_coordinates: dict, text_scale: float = 0.4,
+                    text_padding=5, text_thickness=2, thickness=3, resolve_labels=False) -> np.ndarray:
+    """
+    Draws the labeled boxes returned by get_som_labeled_img(..., render=False) on a copy of the image,
+    so that the annotated screenshot can be produced later, off the critical path.
+
+    Parameters:
+    image_source (np.ndarray): The RGB source image.
+    label_coordinates (dict): Box ID -> [x, y, w, h] in pixels.
+    resolve_labels (bool): Also keep the labels from covering each other (see BoxAnnotator).
+
+    Returns:
+    np.ndarray: The annotated image.
+    """
+    h, w, _ = image_source.shape
+    xywh = np.array(list(label_coordinates.values()), dtype=np.float32).reshape(-1, 4)
+    xyxy = np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], axis=1)
+    import supervision as sv
+    detections = sv.Detections(xyxy=xyxy)
+
+    from util.box_annotator import BoxAnnotator
+    box_annotator = BoxAnnotator(text_scale=text_scale, text_padding=text_padding,text_thickness=text_thickness,thickness=thickness,
+                                 resolve_labels=resolve_labels)
+    return box_annotator.annotate(scene=image_source.copy(), detections=detections, labels=list(label_coordinates), image_size=(w,h))
+
+
 def predict(model, image, caption, box_threshold, text_threshold):
     """ Use huggingface model to replace the original model
     """
@@ -282,8 +550,12 @@ def predict(model, image, caption, box_threshold, text_threshold):
 
 def predict_yolo(model, image_path, box_threshold, imgsz):
     """ Use huggingface model to replace the original model
+        image_path: a file path or a decoded RGB ndarray (see load_frame)
     """
     # model = model['model']
+    if isinstance(image_path, np.ndarray):
+        # ultralytics expects BGR arrays, like cv2.imread
+        image_path = cv2.cvtColor(image_path, cv2.COLOR_RGB2BGR)
     
     result = model.predict(
     source=image_path,
@@ -298,40 +570,58 @@ def predict_yolo(model, image_path, box_threshold, imgsz):
     return boxes, conf, phrases
 
 
-def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None,imgsz=640):
-    """ ocr_bbox: list of xyxy format bbox
+def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None,imgsz=640,yolo_result=None,render=True,known_captions=None,caption_profile='accurate'):
+    """ img_path: a file path or a decoded RGB ndarray (see load_frame)
+        ocr_bbox: list of xyxy format bbox
+        yolo_result: (xyxy, logits, phrases) from predict_yolo if detection already ran, e.g. concurrently with OCR
+        render: if False, skip drawing and PNG/base64 encoding and return None as the image; draw_som_labels can render it later
+        known_captions: optional callable mapping the icon boxes (normalized xyxy tensor) to a caption or None each; only the None ones are captioned
+        caption_profile: the CAPTION_PROFILES decoding settings for the icon captions
     """
     TEXT_PROMPT = "clickable buttons on the screen"
     # BOX_TRESHOLD = 0.02 # 0.05/0.02 for web and 0.1 for mobile
     TEXT_TRESHOLD = 0.01 # 0.9 # 0.01
-    image_source = Image.open(img_path).convert("RGB")
-    w, h = image_source.size
+    image_source = load_frame(img_path)
+    h, w, _ = image_source.shape
     # import pdb; pdb.set_trace()
-    if False: # TODO
-        xyxy, logits, phrases = predict(model=model, image=image_source, caption=TEXT_PROMPT, box_threshold=BOX_TRESHOLD, text_threshold=TEXT_TRESHOLD)
+    if yolo_result is not None:
+        xyxy, logits, phrases = yolo_result
+    elif False: # TODO
+        xyxy, logits, phrases = predict(model=model, image=Image.fromarray(image_source), caption=TEXT_PROMPT, box_threshold=BOX_TRESHOLD, text_threshold=TEXT_TRESHOLD)
     else:
-        xyxy, logits, phrases = predict_yolo(model=model, image_path=img_path, box_threshold=BOX_TRESHOLD, imgsz=imgsz)
+        with metrics.stage('detect'):
+            xyxy, logits, phrases = predict_yolo(model=model, image_path=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz)
     xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
-    image_source = np.asarray(image_source)
     phrases = [str(i) for i in range(len(phrases))]
 
     # annotate the image with labels
-    h, w, _ = image_source.shape
     if ocr_bbox:
-        ocr_bbox = torch.tensor(ocr_bbox) / torch.Tensor([w, h, w, h])
-        ocr_bbox=ocr_bbox.tolist()
+        ocr_bbox = [[x1 / w, y1 / h, x2 / w, y2 / h] for x1, y1, x2, y2 in ocr_bbox]
     else:
         print('no ocr bbox!!!')
         ocr_bbox = None
-    filtered_boxes = remove_overlap(boxes=xyxy, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox)
+    # same result either way, bucketing only pays off on very busy screens
+    with metrics.stage('overlap'):
+        filtered_boxes = remove_overlap(boxes=xyxy, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox, grid_size=32 if len(xyxy) > 500 else None)
     
     # get parsed icon local semantics
     if use_local_semantics:
         caption_model = caption_model_processor['model']
         if 'phi3_v' in caption_model.config.model_type: 
-            parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor)
+            caption_icons = lambda boxes, ocr_bbox: get_parsed_content_icon_phi3v(boxes, ocr_bbox, image_source, caption_model_processor, profile=caption_profile)
         else:
-            parsed_content_icon = get_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=prompt)
+            caption_icons = lambda boxes, ocr_bbox: get_parsed_content_icon(boxes, ocr_bbox, image_source, caption_model_processor, prompt=prompt, profile=caption_profile)
+        with metrics.stage('caption'):
+            if known_captions is None:
+                parsed_content_icon = caption_icons(filtered_boxes, ocr_bbox)
+            else:
+                # only caption the icons that have no known caption
+                icon_boxes = filtered_boxes[len(ocr_bbox):] if ocr_bbox else filtered_boxes
+                parsed_content_icon = known_captions(icon_boxes)
+                missing = [i for i, caption in enumerate(parsed_content_icon) if caption is None]
+                if missing:
+                    for i, caption in zip(missing, caption_icons(icon_boxes[missing], None)):
+                        parsed_content_icon[i] = caption
         ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
         icon_start = len(ocr_text)
         parsed_content_icon_ls = []
@@ -346,16 +636,27 @@ def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_
 
     phrases = [i for i in range(len(filtered_boxes))]
     
+    if not render:
+        # same coordinates as annotate, without drawing anything
+        xywh = box_convert(boxes=filtered_boxes * torch.Tensor([w, h, w, h]), in_fmt="cxcywh", out_fmt="xywh").numpy()
+        label_coordinates = {f"{phrase}": v for phrase, v in zip(phrases, xywh)}
+        encoded_image = None
+        if output_coord_in_ratio:
+            label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
+        return encoded_image, label_coordinates, parsed_content_merged
+
     # draw boxes
-    if draw_bbox_config:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, **draw_bbox_config)
-    else:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
+    with metrics.stage('annotate'):
+        if draw_bbox_config:
+            annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, **draw_bbox_config)
+        else:
+            annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
     
-    pil_img = Image.fromarray(annotated_frame)
-    buffered = io.BytesIO()
-    pil_img.save(buffered, format="PNG")
-    encoded_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+    with metrics.stage('encode'):
+        pil_img = Image.fromarray(annotated_frame)
+        buffered = io.BytesIO()
+        pil_img.save(buffered, format="PNG")
+        encoded_image = base64.b64encode(buffered.getvalue()).decode('ascii')
     if output_coord_in_ratio:
         # h, w, _ = image_source.shape
         label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
@@ -382,21 +683,28 @@ def get_xywh_yolo(input):
 
 
 def check_ocr_box(image_path, display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False):
+    """ image_path: a file path or a decoded RGB ndarray (see load_frame)
+    """
     if use_paddleocr:
-        result = paddle_ocr.ocr(image_path, cls=False)[0]
+        # PaddleOCR expects BGR arrays, like cv2.imread
+        paddle_input = cv2.cvtColor(image_path, cv2.COLOR_RGB2BGR) if isinstance(image_path, np.ndarray) else image_path
+        result = get_ocr_engine('paddle').ocr(paddle_input, cls=False)[0]
         coord = [item[0] for item in result]
         text = [item[1][0] for item in result]
     else:  # EasyOCR
         if easyocr_args is None:
             easyocr_args = {}
-        result = reader.readtext(image_path, **easyocr_args)
+        result = get_ocr_engine('easyocr').readtext(image_path, **easyocr_args)
         # print('goal filtering pred:', result[-5:])
         coord = [item[0] for item in result]
         text = [item[1] for item in result]
     # read the image using cv2
     if display_img:
-        opencv_img = cv2.imread(image_path)
-        opencv_img = cv2.cvtColor(opencv_img, cv2.COLOR_RGB2BGR)
+        if isinstance(image_path, np.ndarray):
+            opencv_img = image_path.copy()
+        else:
+            opencv_img = cv2.imread(image_path)
+            opencv_img = cv2.cvtColor(opencv_img, cv2.COLOR_RGB2BGR)
         bb = []
         for item in coord:
             x, y, a, b = get_xywh(item)
@@ -405,6 +713,7 @@ def check_ocr_box(image_path, display_img = True, output_bb_format='xywh', goal_
             cv2.rectangle(opencv_img, (x, y), (x+a, y+b), (0, 255, 0), 2)
         
         # Display the image
+        from matplotlib import pyplot as plt
         plt.imshow(opencv_img)
     else:
         if output_bb_format == 'xywh':
@@ -8,11 +8,13 @@ from datetime import datetime
 import threading
 import cv2
 import numpy as np
-from PIL import ImageGrab
 import subprocess
 from collections import deque
 import platform
 
+# the screen capture backends are shared with the LocalExecutor (pip install -e ../../screen_capture)
+from screen_capture import open_capture
+
 # Update the path for recordings
 RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Recordings')
 
@@ -31,7 +33,8 @@ class SmartTaskRecorder:
         os.makedirs(self.session_dir, exist_ok=True)
         os.makedirs(self.frames_dir, exist_ok=True)
         
-        # Frame capture
+        # Frame capture; CAPTURE_BACKEND picks xshm, mss or pil, by default the fastest that works
+        self.capture = open_capture(os.getenv('CAPTURE_BACKEND') or None)
         self.frame_buffer = deque(maxlen=30)  # 3 seconds at 10 FPS
         self.last_frame_time = time.time()
         
@@ -119,9 +122,8 @@ class SmartTaskRecorder:
     def capture_frame(self):
         """Capture a single frame"""
         try:
-            frame = ImageGrab.grab()
-            frame_np = np.array(frame)
-            frame_rgb = cv2.cvtColor(frame_np, cv2.COLOR_BGR2RGB)
+            # the grab is a BGRA view of a reused buffer, keep a BGR copy for cv2
+            frame_rgb = np.ascontiguousarray(self.capture.grab()[:, :, :3])
             
             # Add timestamp to frame
             timestamp = self.get_timestamp()
@@ -0,0 +1,241 @@
+import ctypes
+import ctypes.util
+import sys
+import threading
+
+import numpy as np
+from PIL import Image, ImageGrab
+
+# in order of preference
+BACKENDS = ("xshm", "mss", "pil")
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+def open_capture(backend=None):
+    """
+    Opens a screen capture backend: 'xshm' (X11 with the MIT-SHM extension), 'mss'
+    (pip install mss) or 'pil' (PIL.ImageGrab). Without `backend`, the first of them
+    that works on this machine.
+    """
+    if backend:
+        return _BACKEND_CLASSES[backend]()
+    for name in BACKENDS:
+        try:
+            return _BACKEND_CLASSES[name]()
+        except Exception:
+            continue
+    raise CaptureError("no screen capture backend works here")
+
+
+def to_image(frame):
+    """An RGB PIL image of a BGRA frame from `grab`; this copies it, unlike the frame it outlives the next grab."""
+    height, width = frame.shape[:2]
+    return Image.frombuffer("RGB", (width, height), np.ascontiguousarray(frame), "raw", "BGRX", 0, 1)
+
+
+def _region_size(region, size):
+    left, top, right, bottom = region or (0, 0, *size)
+    if not (0 <= left < right <= size[0] and 0 <= top < bottom <= size[1]):
+        raise ValueError(f"region {region} is not within the {size[0]}x{size[1]} screen")
+    return left, top, right - left, bottom - top
+
+
+class _XImage(ctypes.Structure):
+    # the leading fields of Xlib's XImage, up to those used here
+    _fields_ = [
+        ("width", ctypes.c_int), ("height", ctypes.c_int), ("xoffset", ctypes.c_int), ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p), ("byte_order", ctypes.c_int), ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int), ("bitmap_pad", ctypes.c_int), ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int), ("bits_per_pixel", ctypes.c_int),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [("shmseg", ctypes.c_ulong), ("shmid", ctypes.c_int), ("shmaddr", ctypes.c_void_p),
+                ("readOnly", ctypes.c_int)]
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+_x_errors = []
+
+
+@_X_ERROR_HANDLER
+def _record_x_error(display, event):
+    # Xlib's default handler exits the process; remember the error and carry on
+    _x_errors.append(event)
+    return 0
+
+
+class XShmCapture:
+    """
+    Grabs the X11 root window into shared memory (MIT-SHM), without a copy through the X socket.
+
+    One shared-memory XImage is allocated per region size and reused: `grab` returns a
+    HxWx4 BGRA view of it, which the next grab of the same size overwrites. Copy it
+    (or use to_image) to keep it.
+    """
+
+    name = "xshm"
+
+    def __init__(self, display=None):
+        if not sys.platform.startswith("linux"):
+            raise CaptureError("MIT-SHM capture needs X11 on Linux")
+        x11 = ctypes.CDLL(ctypes.util.find_library("X11") or "libX11.so.6")
+        xext = ctypes.CDLL(ctypes.util.find_library("Xext") or "libXext.so.6")
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        for name in ("XDefaultScreen", "XDefaultDepth", "XDisplayWidth", "XDisplayHeight"):
+            getattr(x11, name).argtypes = [ctypes.c_void_p] + ([ctypes.c_int] if name != "XDefaultScreen" else [])
+        x11.XRootWindow.restype = ctypes.c_ulong
+        x11.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+        x11.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+                                         ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int,
+                                      ctypes.c_int, ctypes.c_ulong]
+        self._libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        self._libc.shmat.restype = ctypes.c_void_p
+        self._libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        self._libc.shmdt.argtypes = [ctypes.c_void_p]
+        self._libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+        self._x11, self._xext = x11, xext
+
+        self._display = x11.XOpenDisplay(display.encode() if display else None)
+        if not self._display:
+            raise CaptureError("cannot open the X display")
+        if not xext.XShmQueryExtension(self._display):
+            x11.XCloseDisplay(self._display)
+            raise CaptureError("the X server has no MIT-SHM extension")
+        screen = x11.XDefaultScreen(self._display)
+        self._root = x11.XRootWindow(self._display, screen)
+        self._visual = x11.XDefaultVisual(self._display, screen)
+        self._depth = x11.XDefaultDepth(self._display, screen)
+        self.size = (x11.XDisplayWidth(self._display, screen), x11.XDisplayHeight(self._display, screen))
+        # (width, height) -> (XImage pointer, segment info, BGRA view)
+        self._buffers = {}
+
+    def _buffer(self, width, height):
+        if (width, height) in self._buffers:
+            return self._buffers[width, height]
+        info = _XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(self._display, self._visual, self._depth, 2, None,  # 2: ZPixmap
+                                           ctypes.byref(info), width, height)
+        if not image:
+            raise CaptureError("XShmCreateImage failed")
+        if image.contents.bits_per_pixel != 32:
+            raise CaptureError(f"unsupported X visual with {image.contents.bits_per_pixel} bits per pixel")
+        size = image.contents.bytes_per_line * height
+        info.shmid = self._libc.shmget(0, size, 0o1600)  # IPC_PRIVATE, IPC_CREAT | 0600
+        if info.shmid < 0:
+            raise CaptureError(f"shmget failed: errno {ctypes.get_errno()}")
+        info.shmaddr = self._libc.shmat(info.shmid, None, 0)
+        if info.shmaddr in (None, ctypes.c_void_p(-1).value):
+            raise CaptureError(f"shmat failed: errno {ctypes.get_errno()}")
+        info.readOnly = 0
+        image.contents.data = info.shmaddr
+        del _x_errors[:]
+        previous = self._x11.XSetErrorHandler(ctypes.cast(_record_x_error, ctypes.c_void_p))
+        self._xext.XShmAttach(self._display, ctypes.byref(info))
+        self._x11.XSync(self._display, 0)
+        self._x11.XSetErrorHandler(previous)
+        # the segment goes away once both this process and the X server have detached it
+        self._libc.shmctl(info.shmid, 0, None)  # IPC_RMID
+        if _x_errors:
+            self._libc.shmdt(info.shmaddr)
+            raise CaptureError("XShmAttach failed, is the X server remote?")
+        rows = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(info.shmaddr))
+        frame = rows.reshape(height, image.contents.bytes_per_line)[:, :4 * width].reshape(height, width, 4)
+        self._buffers[width, height] = (image, info, frame)
+        return self._buffers[width, height]
+
+    def grab(self, region=None):
+        """The screen, or `region` (left, top, right, bottom) of it, as a HxWx4 BGRA view of a reused buffer."""
+        left, top, width, height = _region_size(region, self.size)
+        image, _, frame = self._buffer(width, height)
+        if not self._xext.XShmGetImage(self._display, self._root, image, left, top, 0xFFFFFFFF):  # AllPlanes
+            raise CaptureError("XShmGetImage failed")
+        return frame
+
+    def close(self):
+        for image, info, _ in self._buffers.values():
+            self._xext.XShmDetach(self._display, ctypes.byref(info))
+            self._libc.shmdt(info.shmaddr)
+        self._buffers.clear()
+        if self._display:
+            self._x11.XCloseDisplay(self._display)
+            self._display = None
+
+
+class MssCapture:
+    """
+    Grabs the screen with mss (which uses MIT-SHM itself where it can). `grab` returns a
+    HxWx4 BGRA view of the bytes mss returns, without copying them.
+
+    mss handles are bound to the thread that created them (on X11 in particular), so
+    every thread that grabs gets its own, created on its first grab.
+    """
+
+    name = "mss"
+
+    def __init__(self):
+        import mss
+        self._new_handle = mss.mss
+        with mss.mss() as handle:
+            monitor = handle.monitors[1] if len(handle.monitors) > 1 else handle.monitors[0]
+        self._origin = (monitor["left"], monitor["top"])
+        self.size = (monitor["width"], monitor["height"])
+        self._local = threading.local()
+        self._handles = []
+
+    def _handle(self):
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            handle = self._local.handle = self._new_handle()
+            self._handles.append(handle)
+        return handle
+
+    def grab(self, region=None):
+        """The screen, or `region` (left, top, right, bottom) of it, as a HxWx4 BGRA array."""
+        left, top, width, height = _region_size(region, self.size)
+        shot = self._handle().grab({"left": self._origin[0] + left, "top": self._origin[1] + top,
+                                    "width": width, "height": height})
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+    def close(self):
+        for handle in self._handles:
+            handle.close()
+        self._handles.clear()
+        self._local = threading.local()
+
+
+class PilCapture:
+    """PIL.ImageGrab, where nothing faster works; every grab allocates a new image and converts it."""
+
+    name = "pil"
+
+    def __init__(self):
+        self.size = ImageGrab.grab().size
+
+    def grab(self, region=None):
+        """The screen, or `region` (left, top, right, bottom) of it, as a HxWx4 BGRA array."""
+        image = ImageGrab.grab(bbox=region)
+        return np.frombuffer(image.tobytes("raw", "BGRX"), dtype=np.uint8).reshape(image.height, image.width, 4)
+
+    def close(self):
+        pass
+
+
+_BACKEND_CLASSES = {"xshm": XShmCapture, "mss": MssCapture, "pil": PilCapture}